@@ -0,0 +1,188 @@
+import argparse
+import sqlite3
+
+import numpy as np
+from termcolor import colored
+
+# FEstats keeps every game as one row, with the blue team as a dash joined string. The analytics tables normalize it:
+#   games(game_number, victory, survival_rank, tactic_rank) -> one row per game, victory is 1 for an S rank
+#   game_units(game_number, character, died) -> one row per blue unit per game; died is NULL for games recorded
+#                                               before FEData kept track of dead units
+# They are built incrementally by sync, so only games added since the last sync are read.
+_schema = (
+    '''CREATE TABLE IF NOT EXISTS games (
+        game_number integer PRIMARY KEY,
+        victory integer,
+        survival_rank integer,
+        tactic_rank integer
+    )''',
+    '''CREATE TABLE IF NOT EXISTS game_units (
+        game_number integer,
+        character text,
+        died integer
+    )''',
+    'CREATE INDEX IF NOT EXISTS game_units_game ON game_units (game_number)',
+    'CREATE INDEX IF NOT EXISTS game_units_character ON game_units (character, game_number)'
+)
+
+
+def connect(run_name):
+    """
+    Opens the results database of a run and brings its analytics tables up to date
+
+    :return: an sqlite3 connection
+    """
+    conn = sqlite3.connect(f'data/{run_name}.db')
+    sync(conn)
+    return conn
+
+
+def has_tables(conn):
+    return conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'games'").fetchone()[0] > 0
+
+
+def sync(conn, chunk_size=50000):
+    """
+    Adds the games recorded in FEstats since the last sync to the analytics tables, reading chunk_size rows at a time
+
+    :return: how many games were added
+    """
+    c = conn.cursor()
+    for statement in _schema:
+        c.execute(statement)
+
+    last_game = c.execute('SELECT COALESCE(MAX(game_number), -1) FROM games').fetchone()[0]
+    columns = [row[1] for row in c.execute('PRAGMA table_info(FEstats)')]
+    dead_column = 'dead_units' if 'dead_units' in columns else 'NULL'
+
+    reader = conn.cursor()
+    reader.execute(f'''SELECT game_number, victory_rank, survival_rank, tactic_rank, units, {dead_column}
+                       FROM FEstats WHERE game_number > ? ORDER BY game_number''', (last_game,))
+    added = 0
+    while True:
+        rows = reader.fetchmany(chunk_size)
+        if len(rows) == 0:
+            break
+
+        games = []
+        game_units = []
+        for game_number, victory_rank, survival_rank, tactic_rank, units, dead_units in rows:
+            games.append((game_number, int(victory_rank == 'S'), survival_rank, tactic_rank))
+            dead = set(dead_units.split('-')) if dead_units else set()
+            for name in units.split('-'):
+                game_units.append((game_number, name, int(name in dead) if dead_units is not None else None))
+
+        c.executemany('INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?)', games)
+        c.executemany('INSERT INTO game_units VALUES (?, ?, ?)', game_units)
+        added += len(games)
+
+    conn.commit()
+    reader.close()
+    c.close()
+    return added
+
+
+def truncate(conn, game_num):
+    """
+    Deletes every game from game_num onwards from the analytics tables, if the database has them. Called by
+    FEData.truncate, so games played again after resuming a run are synced again.
+    """
+    if not has_tables(conn):
+        return
+    conn.execute('DELETE FROM games WHERE game_number >= ?', (game_num,))
+    conn.execute('DELETE FROM game_units WHERE game_number >= ?', (game_num,))
+
+
+def rolling_win_rate(conn, window=1000):
+    """
+    The win rate over the last `window` games, after every game. Computed by SQLite and streamed row by row.
+
+    :return: a generator of (game_number, win_rate)
+    """
+    return iter(conn.execute('''SELECT game_number,
+                                       AVG(victory) OVER (ORDER BY game_number
+                                                          ROWS BETWEEN ? PRECEDING AND CURRENT ROW)
+                                FROM games ORDER BY game_number''', (window - 1,)))
+
+
+def windowed_summary(conn, window=1000):
+    """
+    Aggregates consecutive, non overlapping windows of games
+
+    :return: a generator of dictionaries with the first game, game count, win rate, and mean survival and tactic
+    ranks of every window
+    """
+    rows = conn.execute('''SELECT MIN(game_number), COUNT(*), AVG(victory), AVG(survival_rank), AVG(tactic_rank)
+                           FROM games GROUP BY game_number / ? ORDER BY game_number / ?''', (window, window))
+    for first_game, games, win_rate, survival, tactic in rows:
+        yield {'first_game': first_game, 'games': games, 'win_rate': win_rate, 'mean_survival_rank': survival,
+               'mean_tactic_rank': tactic}
+
+
+def character_survival(conn, first_game=0, last_game=None):
+    """
+    How often each character was deployed, how often it died, and how its games went, between two games
+
+    :return: a dictionary of character name -> dictionary with games, deaths (None if no game recorded deaths),
+    survival_rate and win_rate
+    """
+    last_game = last_game if last_game is not None else np.iinfo(np.int64).max
+    rows = conn.execute('''SELECT u.character, COUNT(*), SUM(u.died), COUNT(u.died), AVG(g.victory)
+                           FROM game_units u JOIN games g ON g.game_number = u.game_number
+                           WHERE u.game_number BETWEEN ? AND ?
+                           GROUP BY u.character ORDER BY u.character''', (first_game, last_game))
+
+    survival = {}
+    for character, games, deaths, recorded, win_rate in rows:
+        survival[character] = {
+            'games': games,
+            'deaths': deaths,
+            'survival_rate': 1 - deaths / recorded if recorded > 0 else None,
+            'win_rate': win_rate
+        }
+    return survival
+
+
+def rank_histograms(conn, window=1000):
+    """
+    Histograms of survival ranks (dead blue units) and tactic ranks (turns) for every window of games
+
+    :return: a dictionary with 'windows' (the first game of every window), and 'survival' and 'tactic', arrays of
+    shape (windows, highest rank + 1) with how many games of each window had each rank
+    """
+    histograms = {}
+    for rank in ('survival_rank', 'tactic_rank'):
+        rows = conn.execute(f'''SELECT game_number / ?, {rank}, COUNT(*) FROM games
+                                GROUP BY game_number / ?, {rank}''', (window, window)).fetchall()
+        histograms[rank] = np.array(rows, dtype=np.int64).reshape(-1, 3)
+
+    blocks = np.union1d(histograms['survival_rank'][:, 0], histograms['tactic_rank'][:, 0])
+    result = {'windows': blocks * window}
+    for rank, key in (('survival_rank', 'survival'), ('tactic_rank', 'tactic')):
+        counts = histograms[rank]
+        table = np.zeros((len(blocks), int(counts[:, 1].max(initial=0)) + 1), dtype=np.int64)
+        table[np.searchsorted(blocks, counts[:, 0]), counts[:, 1]] = counts[:, 2]
+        result[key] = table
+
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize the results database of a run')
+    parser.add_argument('run_name', help='run name (data/<run name>.db)')
+    parser.add_argument('--window', type=int, default=1000, help='games per window')
+    args = parser.parse_args()
+
+    connection = connect(args.run_name.strip().lower())
+
+    print(colored('WINDOWS', 'yellow'))
+    for summary in windowed_summary(connection, args.window):
+        print(f"games {summary['first_game']}+ ({summary['games']}): win rate {summary['win_rate']:.3f}, "
+              f"dead units {summary['mean_survival_rank']:.2f}, turns {summary['mean_tactic_rank']:.1f}")
+
+    print(colored('CHARACTERS', 'yellow'))
+    for name, stats in character_survival(connection).items():
+        survival_text = f"{stats['survival_rate']:.3f}" if stats['survival_rate'] is not None else 'not recorded'
+        print(f"{name}: {stats['games']} games, win rate {stats['win_rate']:.3f}, survival rate {survival_text}")
+
+    connection.close()
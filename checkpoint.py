@@ -0,0 +1,80 @@
+import os
+import pickle
+import random
+import numpy as np
+
+
+class TrainingCheckpoint:
+    """
+    Everything needed to continue an interrupted training run where it left off:
+    the episode counter, the q-store's tensor, both random number generator streams, the convergence monitor
+    (if the run uses one) and the random number generator states of the episode prefetcher (if the run uses one).
+
+    The run's results database is flushed whenever a checkpoint is taken, so on resume any rows for games played
+    after the checkpoint are dropped and those games are played again.
+    """
+    def __init__(self, episode, q_store, monitor=None, prefetch_random_states=None):
+        self.episode = episode
+        self.q = q_store.q.copy()
+        self.loaded = q_store.loaded.copy()
+        self.python_random_state = random.getstate()
+        self.numpy_random_state = np.random.get_state()
+        self.monitor = monitor
+        # See prefetch.EpisodePrefetcher.random_states
+        self.prefetch_random_states = prefetch_random_states
+
+    def restore(self, q_store):
+        """
+        Restores the q-store and the random number generators to the state they were in when the checkpoint was taken
+
+        :param q_store: The QStore to restore the q-tables into
+        :return: the convergence monitor saved with the checkpoint, attached to q_store (or None)
+        """
+        q_store.flush()
+        q_store.q[...] = self.q
+        q_store.loaded[...] = self.loaded
+        random.setstate(self.python_random_state)
+        np.random.set_state(self.numpy_random_state)
+
+        if self.monitor is not None:
+            self.monitor.q_store = q_store
+        return self.monitor
+
+
+def checkpoint_path(run_name):
+    return f'checkpoints/{run_name}.pkl'
+
+
+def save_checkpoint(run_name, episode, q_store, monitor=None, prefetch_random_states=None):
+    """
+    Writes a checkpoint for the run. The file is replaced atomically, so a crash while writing never leaves a
+    corrupt checkpoint behind.
+
+    :param run_name: The name of the run
+    :param episode: The number of the next game to play
+    :param q_store: The run's QStore; pending transitions are flushed first
+    :param monitor: The run's convergence monitor, if any
+    :param prefetch_random_states: The random states of the run's episode prefetcher, if any
+    """
+    q_store.flush()
+    path = checkpoint_path(run_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        pickle.dump(TrainingCheckpoint(episode, q_store, monitor, prefetch_random_states), f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+
+def load_checkpoint(run_name):
+    """
+    :param run_name: The name of the run
+    :return: The run's TrainingCheckpoint, or None if it has no checkpoint
+    """
+    path = checkpoint_path(run_name)
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        return pickle.load(f)
@@ -1,4 +1,6 @@
 import random
+import numpy as np
+import kernels
 from unit import Unit
 from item import Item
 from item_type import *
@@ -248,6 +250,91 @@ def get_combat_stats(attacker: Unit, defender: Unit, tile_map: Map):
     return CombatSummary(attacker, defender, attacker_combat, defender_combat)
 
 
+def combat_features(unit: Unit, tile_map: Map, x=None, y=None):
+    """
+    Packs everything get_combat_stats reads from a unit into a feature vector for kernels.combat_forecast
+
+    :param unit: The unit
+    :param tile_map: The map the combat is taking place on
+    :param x: optional x the unit fights from. Defaults to the unit's current x
+    :param y: optional y the unit fights from. Defaults to the unit's current y
+    :return: a float array of size kernels.FEATURE_COUNT
+    """
+    if x is None or y is None:
+        x, y = unit.x, unit.y
+
+    item = unit.inventory[0]
+    is_weapon = item.item_type == ItemType.WEAPON
+    tile = tile_map.get_tile(x, y)
+
+    # Only ranges written as plain integers match the str(distance) check of calculate_hit_chance
+    atk_range = [int(r) for r in item.info['range'].split(',') if r.isdigit() and str(int(r)) == r]
+
+    features = np.zeros(kernels.FEATURE_COUNT)
+    features[kernels.FEATURE_X], features[kernels.FEATURE_Y] = x, y
+    features[kernels.FEATURE_POWER] = unit.strength if is_weapon else unit.magic
+    features[kernels.FEATURE_DEFENSE] = unit.defense
+    features[kernels.FEATURE_RESISTANCE] = unit.res
+    features[kernels.FEATURE_SKILL] = unit.skill
+    features[kernels.FEATURE_LUCK] = unit.luck
+    features[kernels.FEATURE_SPEED] = unit.speed
+    features[kernels.FEATURE_CON] = unit.con
+    features[kernels.FEATURE_MIGHT] = item.info['might']
+    features[kernels.FEATURE_HIT] = item.info['hit']
+    features[kernels.FEATURE_CRIT] = item.info['crit']
+    features[kernels.FEATURE_WEIGHT] = item.info['weight']
+    features[kernels.FEATURE_RANGE_BITS] = kernels.range_bits(atk_range)
+    features[kernels.FEATURE_MAGIC] = 0 if is_weapon else 1
+    features[kernels.FEATURE_CRIT_BONUS] = 0.15 if 'Swordmaster' in unit.job or 'Berserker' in unit.job else 0.0
+    features[kernels.FEATURE_TILE_DEFENSE] = tile.defense
+    features[kernels.FEATURE_TILE_AVOID] = tile.avoid
+    return features
+
+
+def get_combat_stats_batch(attacker: Unit, candidates, tile_map: Map):
+    """
+    get_combat_stats for many battles of one attacker at once, using kernels.combat_forecast. The results are
+    identical to calling get_combat_stats with the attacker moved to each tile.
+
+    :param attacker: The unit who is initiating combat
+    :param candidates: list of (tile, defender) pairs; tile is the x,y tuple the attacker fights from
+    :param tile_map: The map that the battles are taking place on
+    :return: A list of CombatSummary objects, one per candidate
+    """
+    if len(candidates) == 0:
+        return []
+
+    attacker_features = {}
+    defender_features = {}
+    attackers = np.zeros((len(candidates), kernels.FEATURE_COUNT))
+    defenders = np.zeros((len(candidates), kernels.FEATURE_COUNT))
+    triangles = np.zeros((len(candidates), 4))
+
+    for i, (tile, defender) in enumerate(candidates):
+        if tile not in attacker_features:
+            attacker_features[tile] = combat_features(attacker, tile_map, tile[0], tile[1])
+        if defender not in defender_features:
+            defender_features[defender] = combat_features(defender, tile_map)
+        attackers[i] = attacker_features[tile]
+        defenders[i] = defender_features[defender]
+        triangles[i, 0:2] = calculate_triangle_bonus(attacker, defender)
+        triangles[i, 2:4] = calculate_triangle_bonus(defender, attacker)
+
+    forecast = kernels.combat_forecast(attackers, defenders, triangles)
+
+    summaries = []
+    for (tile, defender), row in zip(candidates, forecast):
+        attacker_combat = Combat(float(row[kernels.FORECAST_HIT]), int(row[kernels.FORECAST_MIGHT]),
+                                 float(row[kernels.FORECAST_CRIT]), bool(row[kernels.FORECAST_DOUBLING]))
+        defender_row = row[4:]
+        defender_combat = Combat(float(defender_row[kernels.FORECAST_HIT]), int(defender_row[kernels.FORECAST_MIGHT]),
+                                 float(defender_row[kernels.FORECAST_CRIT]),
+                                 bool(defender_row[kernels.FORECAST_DOUBLING]))
+        summaries.append(CombatSummary(attacker, defender, attacker_combat, defender_combat))
+
+    return summaries
+
+
 def roll_random_chance():
     """
     Averages two random floats between 0.0 and 1.0, n and k
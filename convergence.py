@@ -0,0 +1,133 @@
+import csv
+import numpy as np
+import feutils
+
+
+class ConvergenceMonitor:
+    """
+    Watches a training run and decides when it has plateaued so it can be stopped early.
+
+    After every episode the monitor records how much each character's q-table moved (the L2 norm of the change)
+    and the episode's ranks from Environment.obtain_metrics. Every `window` episodes it takes a checkpoint of
+    the rolling statistics. A checkpoint is "stable" when no character's q-table moved more than
+    delta_tolerance per episode on average, and the win rate moved less than win_rate_tolerance since the last
+    checkpoint. The run should stop after `patience` stable checkpoints in a row (and never before min_episodes).
+    """
+    def __init__(self, q_store, window=1000, min_episodes=10000, delta_tolerance=1e-3, win_rate_tolerance=0.01,
+                 patience=3, turn_limit=65):
+        self.q_store = q_store
+        self.window = window
+        self.min_episodes = min_episodes
+        self.delta_tolerance = delta_tolerance
+        self.win_rate_tolerance = win_rate_tolerance
+        self.patience = patience
+
+        self.episodes = 0
+        self.stable_checkpoints = 0
+        self.previous_q = q_store.q.copy()
+
+        # Rolling window of per episode statistics
+        n_characters = len(feutils.playable_characters())
+        self.delta_norms = np.zeros((window, n_characters))
+        self.wins = np.zeros(window, dtype=bool)
+        self.survival_ranks = np.zeros(window, dtype=int)
+        self.tactic_ranks = np.zeros(window, dtype=int)
+        self.turn_limit = turn_limit
+
+        self.previous_win_rate = None
+        self.checkpoints = []
+
+    def __getstate__(self):
+        # The q-store is saved separately in checkpoints; it is reattached on restore
+        state = self.__dict__.copy()
+        state['q_store'] = None
+        return state
+
+    def update(self, ranks):
+        """
+        Records an episode that just finished. Call this after the q-tables were updated for the episode.
+
+        :param ranks: The ranks from Environment.obtain_metrics (victory, survival, tactic)
+        :return: True if the run has converged and should stop
+        """
+        i = self.episodes % self.window
+        self.delta_norms[i] = np.sqrt(np.sum(np.square(self.q_store.q - self.previous_q), axis=(1, 2, 3)))
+        self.previous_q[...] = self.q_store.q
+        self.wins[i] = ranks[0] == 'S'
+        self.survival_ranks[i] = ranks[1]
+        self.tactic_ranks[i] = ranks[2]
+        self.episodes += 1
+
+        if self.episodes % self.window != 0:
+            return False
+
+        return self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Summarizes the current window and checks the stopping criteria.
+
+        :return: True if the run has converged and should stop
+        """
+        win_rate = float(np.mean(self.wins))
+        max_delta = float(np.max(np.mean(self.delta_norms, axis=0)))
+
+        stable = max_delta <= self.delta_tolerance
+        if self.previous_win_rate is not None:
+            stable = stable and abs(win_rate - self.previous_win_rate) <= self.win_rate_tolerance
+        else:
+            stable = False
+
+        if stable:
+            self.stable_checkpoints += 1
+        else:
+            self.stable_checkpoints = 0
+
+        self.previous_win_rate = win_rate
+        self.checkpoints.append({
+            'episode': self.episodes,
+            'win_rate': win_rate,
+            'max_delta_norm': max_delta,
+            'mean_survival_rank': float(np.mean(self.survival_ranks)),
+            'mean_tactic_rank': float(np.mean(self.tactic_ranks)),
+            'stable_checkpoints': self.stable_checkpoints
+        })
+
+        return self.episodes >= self.min_episodes and self.stable_checkpoints >= self.patience
+
+    def delta_norms_by_character(self):
+        """
+        :return: a dictionary of character name -> mean q-table delta norm per episode over the current window
+        """
+        count = min(self.episodes, self.window)
+        means = np.mean(self.delta_norms[:count], axis=0) if count > 0 else np.zeros(self.delta_norms.shape[1])
+        return {name: float(means[feutils.character_id(name)]) for name in feutils.playable_characters()}
+
+    def rank_distributions(self):
+        """
+        Rank distributions over the current window
+
+        :return: a dictionary with the victory rank counts, and histograms of survival and tactic ranks
+        (survival: count of games with that many dead blue units; tactic: count of games that lasted that many turns)
+        """
+        count = min(self.episodes, self.window)
+        wins = int(np.sum(self.wins[:count]))
+        return {
+            'victory': {'S': wins, 'F': count - wins},
+            'survival': np.bincount(self.survival_ranks[:count]),
+            'tactic': np.bincount(self.tactic_ranks[:count], minlength=self.turn_limit + 2)
+        }
+
+    def write_checkpoints(self, path):
+        """
+        Writes every checkpoint taken so far to a csv file
+
+        :param path: where to write the csv file
+        """
+        if len(self.checkpoints) == 0:
+            return
+
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(self.checkpoints[0].keys()))
+            writer.writeheader()
+            writer.writerows(self.checkpoints)
@@ -1,25 +1,68 @@
 import math
 
 import feutils
+import kernels
 import map_factory
 import combat
+import red_planner
+import snapshot
 from combat import CombatResults
 import numpy as np
 from unit import BlueUnit, RedUnit
+from termcolor import colored
+
+
+class UnitOptions:
+    """
+    Everything a unit can do on its turn, as enumerated by Environment.enumerate_options
+    """
+    def __init__(self, action_mask, moves, attack_moves, targets):
+        self.action_mask = action_mask      # Masked actions are True, as in Map.get_all_valid_actions
+        self.moves = moves                  # Tiles the unit can move to (and wait or use an item at)
+        self.attack_moves = attack_moves    # The tiles of moves from which the unit can attack
+        self.targets = targets              # attack tile -> enemy units attackable from it, in enemy team order
+
+    def valid_moves(self, action):
+        """
+        :return: The tiles the unit can move to and do action at
+        """
+        return self.attack_moves if action == 2 else self.moves
 
 
 class Environment:
-    def __init__(self, x_min, x_max, y_min, y_max):
+    def __init__(self, x_min, x_max, y_min, y_max, red_policy='random', turn_limit=65):
         self.map_factory = map_factory.OutdoorMapFactory(x_min, x_max, y_min, y_max)
         self.map, self.number_map = self.map_factory.generate_map()
 
         self.turn_count = 1
-        self.turn_limit = 65
+        self.turn_limit = turn_limit
         self.blue_victory = False
         self.red_victory = False
         self.dead_blue_units = 0
         self.total_battles = 0
 
+        # How the red team plays; see red_planner.RedPhasePlanner.policies
+        self.red_policy = red_policy
+
+        # Optional trajectory.TrajectoryWriter; if set every step is recorded
+        self.recorder = None
+
+        # The last options enumerated, and the board they were enumerated on; see enumerate_options
+        self.options_key = None
+        self.options = None
+
+        # Whether the teams could ever engage, and the teams it was decided for; see is_stalemate
+        self.engagement_key = None
+        self.can_ever_engage = True
+
+    def __getstate__(self):
+        # The options cache can still hold the map and units of an earlier game; a copy (ie, in a rollout worker)
+        # enumerates its own
+        state = self.__dict__.copy()
+        state['options_key'] = None
+        state['options'] = None
+        return state
+
     def obtain_state(self, unit, ally_team, enemy_team):
         """
         Obtains the state of the given unit, given the unit's allied and enemy team
@@ -37,14 +80,20 @@ class Environment:
 
         E = 0
         for enemy_unit in enemy_team:
+            # Moving a tile costs at least 1, so an enemy further away than its move and range can't attack the unit
+            attack_range = enemy_unit.get_attack_range()
+            if len(attack_range) == 0 or \
+                    abs(enemy_unit.x - unit.x) + abs(enemy_unit.y - unit.y) > enemy_unit.move + attack_range[-1]:
+                continue
+
             valid_moves = self.map.get_valid_move_coordinates(enemy_unit, enemy_team, ally_team)
-            for move in valid_moves:
-                x = move[0]
-                y = move[1]
-                attackable_units = feutils.get_attackable_units(enemy_unit, ally_team, x, y)
-                if unit in attackable_units:
-                    E += 1
-                    break  # Each enemy unit counts for, at most, ONE increment of E
+            if len(valid_moves) == 0:
+                continue
+
+            # Each enemy unit counts for, at most, ONE increment of E
+            xs, ys = zip(*valid_moves)
+            if np.any(self.map.get_attack_tile_mask(enemy_unit, [unit])[list(xs), list(ys)]):
+                E += 1
 
             if E == 9:
                 break
@@ -54,6 +103,42 @@ class Environment:
 
         return E, N
 
+    def enumerate_options(self, unit, ally_team, enemy_team):
+        """
+        Works out, in one pass, which actions the unit can take, the tiles it can take each one at, and the enemy
+        units it could attack from each tile.
+
+        The options of the last call are kept until a unit moves, dies, or uses up an item, so deciding an action,
+        a move and a target for the same unit only enumerates its options once.
+
+        :param unit: The unit we are checking
+        :param ally_team: The allied team to unit (blue or red)
+        :param enemy_team: The adversarial team to unit (blue or red)
+        :return: a UnitOptions
+        """
+        key = (self.map, unit, len(unit.inventory), tuple((u, u.x, u.y) for u in ally_team),
+               tuple((u, u.x, u.y) for u in enemy_team))
+        if key == self.options_key:
+            return self.options
+
+        moves = self.map.get_valid_move_coordinates(unit, ally_team, enemy_team)
+
+        targets = {}
+        if len(moves) > 0 and len(enemy_team) > 0:
+            tiles = np.array(moves, dtype=np.int64)
+            enemies = np.array([(u.x, u.y) for u in enemy_team], dtype=np.int64)
+            distances = np.abs(tiles[:, np.newaxis, :] - enemies[np.newaxis, :, :]).sum(axis=2)
+            in_range = np.isin(distances, unit.get_attack_range())
+            for i in np.nonzero(np.any(in_range, axis=1))[0].tolist():
+                targets[moves[i]] = [enemy_team[j] for j in np.nonzero(in_range[i])[0].tolist()]
+
+        attack_moves = [tile for tile in moves if tile in targets]
+        action_mask = np.array([False, not unit.has_consumable(), len(attack_moves) == 0])
+
+        self.options_key = key
+        self.options = UnitOptions(action_mask, moves, attack_moves, targets)
+        return self.options
+
     def generate_valid_moves(self, action, unit, ally_team, enemy_team):
         """
         Generates a list of valid move coordinates given an action. The unit will be able to do
@@ -66,29 +151,18 @@ class Environment:
         :return: A list of tuples representing x,y pairs. The unit will be able to execute the action passed in
         at every coordinate in the list.
         """
-        all_valid_move_coordinates = self.map.get_valid_move_coordinates(unit, ally_team, enemy_team)
-
-        if action == 0 or action == 1:  # The unit will be able to wait/use an item at every coordinate they can move to
-            return all_valid_move_coordinates
-
-        valid_move_actions = []
-        for x, y in all_valid_move_coordinates:
-            attackable = feutils.get_attackable_units(unit, enemy_team, x, y)
-            if len(attackable) > 0:
-                valid_move_actions.append((x,y))
-
-        return valid_move_actions
+        return self.enumerate_options(unit, ally_team, enemy_team).valid_moves(action)
 
     def generate_action_mask(self, unit, ally_team, enemy_team):
         """
+        Generates the action mask of the unit; see Map.get_all_valid_actions
 
-        :param ally_team:
-        :param unit:
-        :param enemy_team:
-        :return:
+        :param ally_team: The allied team to unit (blue or red)
+        :param unit: The unit we are checking
+        :param enemy_team: The adversarial team to unit (blue or red)
+        :return: An action mask; a boolean array of size 3. True means the unit CANNOT take the action
         """
-        valid_coords = self.map.get_valid_move_coordinates(unit, ally_team, enemy_team)
-        return self.map.get_all_valid_actions(unit, enemy_team, valid_coords)
+        return self.enumerate_options(unit, ally_team, enemy_team).action_mask
 
     def execute_red_phase(self, blue_team, red_team):
         """
@@ -106,10 +180,13 @@ class Environment:
         done = False
         info = {}
 
+        # Reach and target maps are computed once for the whole phase
+        planner = red_planner.RedPhasePlanner(self, red_team, blue_team, self.red_policy)
+
         for red_unit in red_team:
-            action = red_unit.determine_action(None, self, red_team, blue_team)
-            move = red_unit.determine_move(action, red_team, blue_team, self)
-            _, _, done, info = self.step(red_unit, move, action, red_team, blue_team)
+            action, move, target = planner.plan(red_unit)
+            _, _, done, info = self.step(red_unit, move, action, red_team, blue_team, target)
+            planner.update(red_unit, target)
 
             if done:
                 break
@@ -122,7 +199,71 @@ class Environment:
 
         return None, done, info
 
-    def step(self, unit, move, action, ally_team, enemy_team):
+    def is_stalemate(self, blue_team, red_team):
+        """
+        Decides whether the game is provably static: no unit of either team could attack a unit of the other before
+        the turn limit, however both teams play. Only the terrain is taken into account, so the distances used are
+        lower bounds and a stalemate is never reported when an engagement is still possible.
+
+        :return: True if nothing can happen before the turn limit
+        """
+        # Units never leave their region, so whether the teams could ever engage only changes when a unit dies
+        key = (self.map, tuple(blue_team), tuple(red_team))
+        if key != self.engagement_key:
+            self.engagement_key = key
+            self.can_ever_engage = self.can_engage(blue_team, red_team)
+        if not self.can_ever_engage:
+            return True
+
+        # Counting the turns left only makes a difference once the units could not cross the map anymore
+        turns_left = self.turn_limit - self.turn_count
+        if turns_left * max(u.move for u in blue_team + red_team) > self.map.x + self.map.y:
+            return False
+
+        return not self.can_engage(blue_team, red_team, turns_left)
+
+    def can_engage(self, blue_team, red_team, turns_left=None):
+        """
+        Could any unit attack a unit of the other team, going by the terrain alone?
+
+        :param turns_left: How many turns the units have to get in range, or None for any number of turns
+        """
+        def possible_tiles(unit):
+            # Every tile the unit could be standing on at some point
+            if turns_left is None or turns_left * unit.move > kernels.MAX_DISTANCE:
+                regions = self.map.get_regions(unit.terrain_group)
+                return regions == regions[unit.x, unit.y]
+            return self.map.get_distance_field(unit.terrain_group, unit.x, unit.y) <= turns_left * unit.move
+
+        blue_tiles = np.zeros((self.map.x, self.map.y), dtype=bool)
+        for unit in blue_team:
+            blue_tiles |= possible_tiles(unit)
+
+        # Attacks work both ways, so every range of every unit counts
+        bits = 0
+        for unit in blue_team + red_team:
+            bits |= kernels.range_bits(unit.get_attack_range())
+
+        xs, ys = np.nonzero(blue_tiles)
+        engagement_tiles = kernels.attack_tile_mask(self.map.x, self.map.y, np.stack((xs, ys), axis=1).astype(np.int64),
+                                                    bits)
+
+        return any(np.any(possible_tiles(unit) & engagement_tiles) for unit in red_team)
+
+    def fast_forward(self):
+        """
+        Ends a game in a stalemate (see is_stalemate) the way it would have ended anyway: at the turn limit, with a
+        red victory. The skipped turns are not played, so obtain_metrics reports the same ranks as if they had been.
+
+        :return: info -> as returned by execute_red_phase, plus info['turns_skipped']
+        """
+        turns_skipped = self.turn_limit - self.turn_count
+        self.turn_count = self.turn_limit
+        print(colored(f'Stalemate: skipped the last {turns_skipped} turns', 'yellow'))
+
+        return {'method': 'Turn limit exceeded', 'winner': 'Red', 'turns_skipped': turns_skipped}
+
+    def step(self, unit, move, action, ally_team, enemy_team, target=None):
         """
         Steps the environment given the unit, move, and action to be executed by said unit
 
@@ -131,6 +272,7 @@ class Environment:
         :param unit: The unit who will affect the environment in some way
         :param move: The coordinates the unit will move to (tuple as x,y)
         :param action: The action the unit will take (attack, wait, item)
+        :param target: The unit to attack if action is attack. If None the unit picks its own target
         :return: next_state, reward, done, info
             next_state -> the unit's state given the action and move they just did
             reward -> The reward the environment gave the unit for taking said action
@@ -138,20 +280,34 @@ class Environment:
             info -> dictionary with information about the step:
                         info['winner'] -> if done is True, this will hold the team that won (blue or red)
                         info['method'] -> if done is True, this will hold how the winning team won
+                        info['target'] -> if action is attack, the unit that was attacked
+                        info['combat_result'] -> if action is attack, the CombatResults of the battle
         """
         done = False
         heal_total = None
         killed_enemy = False
+        target_unit = None
+        result = None
         info = {}
 
+        # The state the unit chose its action in; the trajectory records it with the action and its reward
+        recorded_state = self.obtain_state(unit, ally_team, enemy_team) if self.recorder is not None else None
+
+        # The targets of the move tile, if the unit's options were enumerated on this board
+        targets = None
+        if action == 2 and target is None:
+            targets = self.enumerate_options(unit, ally_team, enemy_team).targets.get(tuple(move))
+
         # Always move
         unit.goto(move[0], move[1])
 
         if action == 2:  # Attack
-            target_unit = unit.determine_target(self, enemy_team)
+            target_unit = target if target is not None else unit.determine_target(self, enemy_team, targets)
             combat_stats = combat.get_combat_stats(unit, target_unit, self.map)
             result = combat.simulate_combat(combat_stats)
             self.total_battles += 1
+            info['target'] = target_unit
+            info['combat_result'] = result
             if result is CombatResults.DEFENDER_DEATH:
                 print(f"{unit.name} killed {target_unit.name}")
                 # Defender is a blue unit that is dying (defender is enemy team)
@@ -199,6 +355,10 @@ class Environment:
         state = self.obtain_state(unit, ally_team, enemy_team)
         reward = self.reward(unit, action, killed_enemy, heal_total)
 
+        if self.recorder is not None:
+            self.recorder.record_step(self.turn_count, unit, action, move, target_unit, result, recorded_state,
+                                      reward)
+
         return state, reward, done, info
 
     def reward(self, unit, action, killed_enemy, heal_total=None):
@@ -219,19 +379,38 @@ class Environment:
 
         return 0.0
 
-    def reset(self):
+    def reset(self, generated_map=None):
         """
         Resets the environment to be ready for a new game
 
+        :param generated_map: Optional (map, number_map) to play on, as returned by map_factory.generate_map.
+        If None a new map is generated
         :return:
         """
         self.turn_count = 0
         self.blue_victory = False
         self.red_victory = False
-        self.map, self.number_map = self.map_factory.generate_map()
+        self.map, self.number_map = generated_map if generated_map is not None else self.map_factory.generate_map()
+        self.map.precompute_terrain()
         self.dead_blue_units = 0
         self.total_battles = 0
 
+    def snapshot(self, blue_team, red_team):
+        """
+        Takes a snapshot of the game being played, to be restored with Environment.restore
+
+        :return: a snapshot.GameSnapshot
+        """
+        return snapshot.GameSnapshot(self, blue_team, red_team)
+
+    def restore(self, game_snapshot):
+        """
+        Rewinds the game to a snapshot taken with Environment.snapshot
+
+        :return: blue_team, red_team
+        """
+        return game_snapshot.restore(self)
+
     def obtain_metrics(self):
         victory_rank = feutils.blue_victory(self.blue_victory)
         survival_rank = self.dead_blue_units
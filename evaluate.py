@@ -0,0 +1,153 @@
+import argparse
+import contextlib
+import math
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from termcolor import colored
+
+import feutils
+import main
+
+
+class FEEvaluationError(Exception):
+    pass
+
+
+def play_evaluation_games(simulation_mode, run_name, seeds, hyperparameters=None):
+    """
+    Plays one seeded game per seed with a frozen policy: the q-tables are loaded read only, epsilon is 0, and nothing
+    is learned or written to disk. Game output is silenced.
+
+    :param simulation_mode: 'mini' or 'big'
+    :param run_name: The run whose q-tables are evaluated
+    :param seeds: The seed of each game
+    :param hyperparameters: Optional BlueUnit hyper-parameter overrides. epsilon is always 0
+    :return: an array of shape (len(seeds), 3); each row is (blue won, dead blue units, turns taken)
+    """
+    hyperparameters = {**(hyperparameters or {}), 'epsilon': 0.0}
+    results = np.zeros((len(seeds), 3), dtype=int)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        env, unit_factory = main.create_simulation(simulation_mode, run_name, hyperparameters, read_only=True)
+
+        for i, seed in enumerate(seeds):
+            random.seed(seed)
+            np.random.seed(seed)
+
+            blue_team, red_team = main.setup_episode(env, unit_factory)
+            main.play_episode(env, blue_team, red_team, unit_factory.q_store, learning=False)
+
+            victory_rank, survival_rank, tactic_rank = env.obtain_metrics()
+            results[i] = (victory_rank == 'S', survival_rank, tactic_rank)
+
+    return results
+
+
+def wilson_interval(successes, n, z=1.96):
+    """
+    Wilson score interval for a binomial proportion
+
+    :return: (low, high)
+    """
+    if n == 0:
+        return 0.0, 1.0
+
+    p = successes / n
+    center = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half_width = (z / (1 + z * z / n)) * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n))
+    return center - half_width, center + half_width
+
+
+def mean_interval(values, z=1.96):
+    """
+    Normal approximation confidence interval for a mean
+
+    :return: (mean, low, high)
+    """
+    mean = float(np.mean(values))
+    if len(values) < 2:
+        return mean, mean, mean
+
+    half_width = z * float(np.std(values, ddof=1)) / math.sqrt(len(values))
+    return mean, mean - half_width, mean + half_width
+
+
+def evaluate(simulation_mode, run_name, games, seed=0, workers=None, hyperparameters=None, z=1.96):
+    """
+    Evaluates the trained policy of a run in a tournament of seeded games played in parallel.
+
+    :param simulation_mode: 'mini' or 'big'
+    :param run_name: The run whose q-tables are evaluated
+    :param games: How many games to play
+    :param seed: Game i is played with seed + i, so results are reproducible
+    :param workers: How many processes to use. Defaults to every core
+    :param hyperparameters: Optional BlueUnit hyper-parameter overrides (ie, the alpha and gamma of the run)
+    :param z: z score of the confidence intervals (1.96 is 95%)
+    :return: a dictionary with the win rate, dead blue units per game and turns per game, each as a tuple
+    (estimate, low, high), plus the raw per game results
+    """
+    # A missing q-table is silently all zeros; make sure the run (with these alpha and gamma) has any to evaluate
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        _, unit_factory = main.create_simulation(simulation_mode, run_name, hyperparameters, read_only=True)
+    q_store = unit_factory.q_store
+    saved = q_store.saved_characters()
+    if len(saved) == 0:
+        raise FEEvaluationError(f'{run_name} has no q-tables to evaluate in {q_store.directory}/ (expected files like '
+                                f'{q_store.table_name("Lyn")}); check the run name, alpha and gamma')
+    untrained = [name for name in feutils.playable_characters() if name not in saved]
+    if len(untrained) > 0:
+        print(colored(f'No q-table for {", ".join(untrained)}; they play with all zero q-values', 'yellow'))
+
+    seeds = list(range(seed, seed + games))
+    workers = workers or os.cpu_count()
+    chunks = [chunk.tolist() for chunk in np.array_split(seeds, min(workers * 4, games)) if len(chunk) > 0]
+
+    # Read the game data before forking, so every worker inherits it
+    feutils.preload_game_data()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(play_evaluation_games, simulation_mode, run_name, chunk, hyperparameters)
+                   for chunk in chunks]
+        results = np.concatenate([future.result() for future in futures])
+
+    wins = int(np.sum(results[:, 0]))
+    return {
+        'games': games,
+        'win_rate': (wins / games,) + wilson_interval(wins, games, z),
+        'dead_units': mean_interval(results[:, 1], z),
+        'turns': mean_interval(results[:, 2], z),
+        'flawless_rate': (float(np.mean(results[:, 1] == 0)),) + wilson_interval(int(np.sum(results[:, 1] == 0)),
+                                                                                games, z),
+        'results': results
+    }
+
+
+def print_report(run_name, report):
+    print(colored(f'Evaluation of {run_name} over {report["games"]} games (frozen policy, epsilon 0)', 'green'))
+    for key, label in (('win_rate', 'WIN RATE'), ('flawless_rate', 'NO DEATHS'),
+                       ('dead_units', 'DEAD UNITS / GAME (SURVIVAL RANK)'), ('turns', 'TURNS / GAME (TACTIC RANK)')):
+        estimate, low, high = report[key]
+        print(colored(f'{label}: ', 'yellow') + f'{estimate:.3f} [{low:.3f}, {high:.3f}]')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluate trained q-tables without learning')
+    parser.add_argument('mode', help=f'simulation mode: {", ".join(main.scenarios)}')
+    parser.add_argument('run_name', help='run name of the q-tables to evaluate')
+    parser.add_argument('games', type=int, help='how many games to play')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None, help='processes to use (defaults to every core)')
+    parser.add_argument('--alpha', type=float, default=None, help='alpha of the run (part of the q-table names)')
+    parser.add_argument('--gamma', type=float, default=None, help='gamma of the run (part of the q-table names)')
+    args = parser.parse_args()
+
+    run_hyperparameters = {name: getattr(args, name) for name in ('alpha', 'gamma') if getattr(args, name) is not None}
+
+    evaluation_start = datetime.now()
+    evaluation = evaluate(args.mode.strip().lower(), args.run_name.strip().lower(), args.games, args.seed,
+                          args.workers, run_hyperparameters)
+    print_report(args.run_name, evaluation)
+    print(f'Evaluation took {(datetime.now() - evaluation_start).total_seconds()} seconds')
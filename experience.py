@@ -0,0 +1,180 @@
+import argparse
+import os
+from datetime import datetime
+
+import numpy as np
+from termcolor import colored
+
+import feutils
+import qstore
+
+
+class ReplayBuffer:
+    """
+    A fixed size ring buffer of transitions (state, action, reward, next state, done) for every playable character.
+    Once a character's ring is full its oldest transitions are overwritten.
+
+    Attach one to a QStore (QStore.replay_buffer) to keep a copy of every transition the blue team learns from.
+    """
+    def __init__(self, capacity=10000):
+        """
+        :param capacity: How many transitions to keep per character
+        """
+        n_characters = len(feutils.playable_characters())
+        self.capacity = capacity
+        self.states = np.zeros((n_characters, capacity, 2), dtype=np.int8)
+        self.actions = np.zeros((n_characters, capacity), dtype=np.int8)
+        self.rewards = np.zeros((n_characters, capacity), dtype=np.float32)
+        self.next_states = np.zeros((n_characters, capacity, 2), dtype=np.int8)
+        self.dones = np.zeros((n_characters, capacity), dtype=bool)
+
+        # How many transitions each character has stored, and where its next one goes
+        self.sizes = np.zeros(n_characters, dtype=np.int64)
+        self.positions = np.zeros(n_characters, dtype=np.int64)
+
+    def __len__(self):
+        return int(np.sum(self.sizes))
+
+    def add(self, name, state, action, reward, next_state, done=False):
+        """
+        Stores a transition of a character, overwriting its oldest one if its ring is full
+        """
+        c = feutils.character_id(name)
+        i = self.positions[c]
+        self.states[c, i] = state
+        self.actions[c, i] = action
+        self.rewards[c, i] = reward
+        self.next_states[c, i] = next_state
+        self.dones[c, i] = done
+
+        self.positions[c] = (i + 1) % self.capacity
+        self.sizes[c] = min(self.sizes[c] + 1, self.capacity)
+
+    def indexes(self):
+        """
+        :return: characters, slots -> the index arrays of every stored transition
+        """
+        characters = np.repeat(np.arange(len(self.sizes)), self.sizes)
+        slots = np.concatenate([np.arange(size) for size in self.sizes]) if len(self) > 0 else np.zeros(0, np.int64)
+        return characters, slots
+
+    def sample(self, batch_size, rng):
+        """
+        Samples transitions uniformly (with replacement) across every character's stored transitions
+
+        :param batch_size: How many transitions to sample
+        :param rng: a numpy Generator
+        :return: characters, slots -> index arrays of the sampled transitions; see transitions
+        """
+        characters, slots = self.indexes()
+        picks = rng.integers(0, len(characters), size=batch_size)
+        return characters[picks], slots[picks]
+
+    def transitions(self, characters, slots):
+        """
+        :return: characters, states, actions, rewards, next_states, dones of the given transitions, ready for
+        QStore.update
+        """
+        return (characters.astype(np.intp), self.states[characters, slots].astype(np.intp),
+                self.actions[characters, slots].astype(np.intp), self.rewards[characters, slots].astype(float),
+                self.next_states[characters, slots].astype(np.intp), self.dones[characters, slots])
+
+    def save(self, path):
+        """
+        Saves the buffer to a .npz file. The file is replaced atomically
+        """
+        temp_path = path + '.tmp.npz'
+        np.savez(temp_path, states=self.states, actions=self.actions, rewards=self.rewards,
+                 next_states=self.next_states, dones=self.dones, sizes=self.sizes, positions=self.positions)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a buffer saved with ReplayBuffer.save
+        """
+        with np.load(path) as data:
+            buffer = cls(data['actions'].shape[1])
+            for name in ('states', 'actions', 'rewards', 'next_states', 'dones', 'sizes', 'positions'):
+                getattr(buffer, name)[...] = data[name]
+        return buffer
+
+
+class OfflineTrainer:
+    """
+    Learns from the transitions in a ReplayBuffer in vectorized batches, using QStore.update.
+
+    The q-store decides alpha and gamma, so the same experience can be replayed into q-stores with other alphas and
+    gammas (the q-table file names include them) without simulating any games.
+    """
+    def __init__(self, q_store, buffer, seed=0):
+        self.q_store = q_store
+        self.buffer = buffer
+        self.rng = np.random.default_rng(seed)
+
+        # Load the table of every character with experience, so its updates are saved with the store
+        for name in feutils.playable_characters():
+            if buffer.sizes[feutils.character_id(name)] > 0:
+                q_store.table(name)
+
+    def train(self, batches, batch_size=256):
+        """
+        Replays randomly sampled batches of transitions
+
+        :param batches: How many batches to replay
+        :param batch_size: Transitions per batch
+        :return: the mean absolute TD error of the last batch (0 if the buffer is empty)
+        """
+        if len(self.buffer) == 0:
+            return 0.0
+
+        td_error = np.zeros(0)
+        for _ in range(batches):
+            td_error = self.q_store.update(*self.buffer.transitions(*self.buffer.sample(batch_size, self.rng)))
+
+        return float(np.mean(np.abs(td_error)))
+
+    def epoch(self, batch_size=256):
+        """
+        Replays every stored transition once, in a random order
+
+        :return: the mean absolute TD error over the epoch (0 if the buffer is empty)
+        """
+        characters, slots = self.buffer.indexes()
+        order = self.rng.permutation(len(characters))
+        total_error = 0.0
+
+        for start in range(0, len(order), batch_size):
+            picks = order[start:start + batch_size]
+            td_error = self.q_store.update(*self.buffer.transitions(characters[picks], slots[picks]))
+            total_error += float(np.sum(np.abs(td_error)))
+
+        return total_error / len(order) if len(order) > 0 else 0.0
+
+
+def replay_buffer_path(run_name):
+    return f'data/{run_name}_replay.npz'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Retrain q-tables offline from the replay buffer of a run')
+    parser.add_argument('source_run', help='run whose replay buffer is replayed (data/<run>_replay.npz)')
+    parser.add_argument('run_name', help='run name the retrained q-tables are saved under')
+    parser.add_argument('epochs', type=int, help='how many times to replay every stored transition')
+    parser.add_argument('--alpha', type=float, default=0.1)
+    parser.add_argument('--gamma', type=float, default=0.6)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    retrain_start = datetime.now()
+    replay_buffer = ReplayBuffer.load(replay_buffer_path(args.source_run.strip().lower()))
+    target_store = qstore.QStore(args.run_name.strip().lower(), args.alpha, args.gamma)
+    trainer = OfflineTrainer(target_store, replay_buffer, args.seed)
+
+    print(colored(f'Replaying {len(replay_buffer)} transitions into {target_store.table_name("<name>")}', 'green'))
+    for e in range(args.epochs):
+        print(f'Epoch {e + 1}: mean |TD error| {trainer.epoch(args.batch_size):.4f}')
+
+    target_store.save()
+    print(f'Retraining took {(datetime.now() - retrain_start).total_seconds()} seconds')
@@ -1,34 +1,82 @@
-import pandas as pd
 import numpy as np
 import sqlite3
+import analytics
 
 
 class FEData:
-    def __init__(self, data_name):
+    def __init__(self, data_name, resume=False, buffer_size=1):
+        """
+        Opens the results database of a run
+
+        :param data_name: The name of the run; the database is 'data/<data_name>.db'
+        :param resume: If True an existing database is reused. Otherwise the database must not exist yet
+        :param buffer_size: How many entries to hold in memory before writing them in one transaction
+        """
         self.conn = sqlite3.connect(f'data/{data_name}.db')
 
         c = self.conn.cursor()
-        c.execute('''CREATE TABLE FEstats (
+        c.execute(f'''CREATE TABLE {'IF NOT EXISTS ' if resume else ''}FEstats (
                     game_number integer,
                     victory_rank text,
                     survival_rank integer,
                     tactic_rank integer,
-                    units text
+                    units text,
+                    dead_units text
                     )''')
+
+        # Databases from before dead units were recorded get the column; their old games have no dead units (NULL)
+        columns = [row[1] for row in c.execute('PRAGMA table_info(FEstats)')]
+        if 'dead_units' not in columns:
+            c.execute('ALTER TABLE FEstats ADD COLUMN dead_units text')
         self.conn.commit()
         c.close()
         self.data_name = data_name
 
-    def add_entry(self, game_num, victory_rank, survival_rank, tactic_rank, unit_names: list):
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def add_entry(self, game_num, victory_rank, survival_rank, tactic_rank, unit_names: list, dead_unit_names=None):
         unit_entry = '-'.join(unit_names)
+        dead_entry = '-'.join(dead_unit_names) if dead_unit_names is not None else None
+        self.buffer.append((game_num, victory_rank, survival_rank, tactic_rank, unit_entry, dead_entry))
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes every buffered entry to the database
+        """
+        if len(self.buffer) == 0:
+            return
+
         c = self.conn.cursor()
-        c.execute('INSERT INTO FEstats VALUES (?, ?, ?, ?, ?)',
-                  (game_num, victory_rank, survival_rank, tactic_rank, unit_entry))
+        c.executemany('INSERT INTO FEstats VALUES (?, ?, ?, ?, ?, ?)', self.buffer)
         self.conn.commit()
         c.close()
+        self.buffer = []
+
+    def truncate(self, game_num):
+        """
+        Deletes every entry from game_num onwards. Used when resuming a run from a checkpoint, since the games after
+        the checkpoint will be played again.
+
+        :param game_num: The first game number to delete
+        """
+        self.buffer = [entry for entry in self.buffer if entry[0] < game_num]
+        c = self.conn.cursor()
+        c.execute('DELETE FROM FEstats WHERE game_number >= ?', (game_num,))
+        analytics.truncate(self.conn, game_num)
+        self.conn.commit()
+        c.close()
+
 
+def sqlite_data_to_csv(run_name, chunk_size=100000):
+    import pandas as pd
 
-def sqlite_data_to_csv(run_name):
     conn = sqlite3.connect(f'data/{run_name}.db')
-    db_df = pd.read_sql_query("SELECT * FROM FEstats", conn)
-    db_df.to_csv(f'data/{run_name}.csv', index=False)
+    # Written chunk by chunk, so the whole table is never in memory
+    chunks = pd.read_sql_query("SELECT * FROM FEstats ORDER BY game_number", conn, chunksize=chunk_size)
+    for i, db_df in enumerate(chunks):
+        db_df.to_csv(f'data/{run_name}.csv', index=False, mode='w' if i == 0 else 'a', header=i == 0)
+    conn.close()
@@ -2,6 +2,7 @@ from item_type import ItemType
 import json
 import numpy as np
 import numpy.ma as npma
+import policy
 
 
 class FEActionError(Exception):
@@ -12,6 +13,10 @@ class FEAttackRangeError(Exception):
     pass
 
 
+class FEHyperparameterError(Exception):
+    pass
+
+
 _character_dict = {
     0xce4c: 'Eliwood', 0xce80: 'Hector', 0xceb4: 'Lyn', 0xcee8: 'Raven', 0xcf1c: 'Geitz',
     0xcf50: 'Guy', 0xcf84: 'Karel', 0xcfb8: 'Dorcas', 0xcfec: 'Bartre', 0xd020: 'Citizen',
@@ -73,6 +78,13 @@ _character_dict = {
     0xffa8: 'Lloyd', 0xffdc: 'Linus'
 }
 
+# Characters that can be deployed on the blue team. Their index in this list is their character id
+_playable_characters = ['Lyn', 'Eliwood', 'Hector', 'Sain', 'Kent', 'Florina', 'Wil', 'Dorcas', 'Erk', 'Rath',
+                        'Matthew', 'Lucius', 'Marcus', 'Lowen', 'Rebecca', 'Bartre', 'Oswin', 'Guy', 'Raven',
+                        'Canas', 'Dart', 'Heath']
+
+_character_id_dict = {name: i for i, name in enumerate(_playable_characters)}
+
 _item_dict = {
     0x0: 'Nothing', 0x1: 'Iron Sword', 0x2: 'Slim Sword', 0x3: 'Steel Sword', 0x4: 'Silver Sword',
     0x5: 'Iron Blade', 0x6: 'Steel Blade', 0x7: 'Silver Blade', 0x8: 'Poison Sword', 0x9: 'Rapier',
@@ -272,28 +284,40 @@ _job_constitution_dict = {
     'Archsage': 9, 'Dark Druid': 10, 'Bramimond': 6, 'Fire Dragon': 25
 }
 
+_game_data_files = {
+    'terrain': 'jsons/terrain.json',
+    ItemType.WEAPON: 'jsons/weapon.json',
+    ItemType.STAFF: 'jsons/staff.json',
+    ItemType.TOME: 'jsons/tomes.json',
+    ItemType.HEAL_CONSUMABLE: 'jsons/heal_consumable.json'
+}
+_game_data = {}
+
+
+def preload_game_data():
+    """
+    Reads every json data file once. Call it before forking worker processes so they inherit the data instead of
+    reading the files again; the lookups below load it on first use otherwise.
+    """
+    for key, file in _game_data_files.items():
+        if key not in _game_data:
+            with open(file) as f:
+                _game_data[key] = json.load(f)
+
+
 def tile_info_lookup(tile_name):
-    file = 'jsons/terrain.json'
-    with open(file) as f:
-        data = json.load(f)
-        return data[tile_name]
+    if 'terrain' not in _game_data:
+        preload_game_data()
+    # Copied, since tiles and items modify their data (Tile removes keys, consumables count down their uses)
+    return dict(_game_data['terrain'][tile_name])
 
 
 def item_info_lookup(item_name, item_type):
-    if item_type == ItemType.WEAPON:
-        file = 'jsons/weapon.json'
-    elif item_type == ItemType.STAFF:
-        file = 'jsons/staff.json'
-    elif item_type == ItemType.TOME:
-        file = 'jsons/tomes.json'
-    elif item_type == ItemType.HEAL_CONSUMABLE:
-        file = 'jsons/heal_consumable.json'
-    else:
+    if item_type not in _game_data_files:
         return None
-
-    with open(file) as f:
-        data = json.load(f)
-        return data[item_name]
+    if item_type not in _game_data:
+        preload_game_data()
+    return dict(_game_data[item_type][item_name])
 
 
 def job_terrain_group(job):
@@ -335,6 +359,14 @@ def character_name_table(character_code):
     return _character_dict[character_code]
 
 
+def playable_characters():
+    return _playable_characters
+
+
+def character_id(character_name):
+    return _character_id_dict[character_name]
+
+
 def movement_table(job):
     return _movement_dict[job]
 
@@ -410,15 +442,7 @@ def action_to_name(action_num):
 
 
 def get_random_unmasked_action(masked_action_space):
-    i = np.random.choice(masked_action_space.size)
-    found = False
-    while not found:
-        if masked_action_space[i] is not npma.masked:
-            found = True
-        else:
-            i = np.random.choice(masked_action_space.size)
-
-    return i
+    return policy.random_legal_action(npma.getmaskarray(masked_action_space))
 
 
 def rank_to_number(rank):
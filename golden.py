@@ -0,0 +1,205 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+from termcolor import colored
+
+import kernels
+import main
+import trajectory
+
+# A golden recording is a trajectory file of seeded reference games (every deployment, state, action, move, target,
+# combat result, reward and hp; see trajectory.STEP_COLUMNS) and, next to it in '<path>.json', how the games were
+# played (mode, seed, red policy), their final ranks and how long the engine took to play them.
+# Replaying plays the same games with the engine as it is now and checks it plays them bit for bit the same.
+
+# Golden games learn as they are played, but their q-tables are only ever saved to a temporary directory, so every
+# recording starts from empty q-tables
+GOLDEN_RUN_NAME = '__golden__'
+
+
+class FEGoldenError(Exception):
+    pass
+
+
+def metadata_path(path):
+    return path + '.json'
+
+
+def play_games(path, simulation_mode, games, seed, red_policy='random'):
+    """
+    Plays seeded games with learning on, recording them to a trajectory file. Game g is played with both random
+    number generators seeded with seed + g; the q-tables carry over from game to game, so the q-updates and traces
+    of every game decide the actions of the next ones.
+
+    :return: ranks (a list of [victory rank, survival rank, tactic rank] per game), seconds the games took
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            tempfile.TemporaryDirectory() as q_tables:
+        env, unit_factory = main.create_simulation(simulation_mode, GOLDEN_RUN_NAME, red_policy=red_policy)
+        unit_factory.q_store.directory = q_tables
+        env.recorder = trajectory.TrajectoryWriter(path)
+        ranks = []
+
+        start = time.perf_counter()
+        for game in range(games):
+            random.seed(seed + game)
+            np.random.seed(seed + game)
+
+            blue_team, red_team = main.setup_episode(env, unit_factory)
+            env.recorder.begin_game(game, env, blue_team, red_team)
+            main.play_episode(env, blue_team, red_team, unit_factory.q_store)
+            ranks.append(env.obtain_metrics())
+
+            for unit in blue_team:
+                unit.close()
+        seconds = time.perf_counter() - start
+
+        env.recorder.close()
+
+    return ranks, seconds
+
+
+def record(path, simulation_mode, games, seed=0, red_policy='random'):
+    """
+    Records golden games with the current engine, replacing any recording at path
+
+    :return: the recording's metadata
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+    ranks, seconds = play_games(path, simulation_mode, games, seed, red_policy)
+    metadata = {'mode': simulation_mode, 'games': games, 'seed': seed, 'red_policy': red_policy,
+                'kernel_backend': kernels.backend(), 'seconds': seconds, 'ranks': ranks}
+    with open(metadata_path(path), 'w') as f:
+        json.dump(metadata, f, indent=1)
+
+    return metadata
+
+
+def first_divergence(expected_path, actual_path):
+    """
+    Compares two trajectory files step by step (maps first, then steps), streaming both
+
+    :return: None if they are identical, or a dictionary describing the first difference: 'step' (its index in the
+    file), 'game', 'turn', 'unit', 'column', 'expected' and 'actual'. A missing step has None as its value; so does
+    the map of a game only one of them recorded (its column is 'games')
+    """
+    expected_maps = trajectory.TrajectoryReader(expected_path).maps()
+    actual_maps = trajectory.TrajectoryReader(actual_path).maps()
+    for expected, actual in itertools.zip_longest(expected_maps, actual_maps):
+        if expected is None or actual is None:
+            # One recording has more games than the other
+            present = expected if expected is not None else actual
+            return {'step': None, 'game': present[0], 'turn': None, 'unit': None, 'column': 'games',
+                    'expected': 'map' if expected is not None else None,
+                    'actual': 'map' if actual is not None else None}
+        if expected[0] != actual[0] or not np.array_equal(expected[1], actual[1]):
+            return {'step': None, 'game': expected[0], 'turn': None, 'unit': None, 'column': 'map',
+                    'expected': expected[1].tolist(), 'actual': actual[1].tolist()}
+
+    expected_blocks = trajectory.TrajectoryReader(expected_path).steps()
+    actual_blocks = trajectory.TrajectoryReader(actual_path).steps()
+    expected, actual = None, None
+    offset = 0
+
+    while True:
+        if expected is None or len(expected['game']) == 0:
+            expected = next(expected_blocks, None)
+        if actual is None or len(actual['game']) == 0:
+            actual = next(actual_blocks, None)
+        if expected is None and actual is None:
+            return None
+
+        if expected is None or actual is None:
+            # One recording has steps the other doesn't
+            present = expected if expected is not None else actual
+            return {'step': offset, 'game': int(present['game'][0]), 'turn': int(present['turn'][0]),
+                    'unit': int(present['unit'][0]), 'column': 'step',
+                    'expected': 'step' if expected is not None else None,
+                    'actual': 'step' if actual is not None else None}
+
+        rows = min(len(expected['game']), len(actual['game']))
+        different = np.zeros(rows, dtype=bool)
+        for name, _ in trajectory.STEP_COLUMNS:
+            different |= expected[name][:rows] != actual[name][:rows]
+
+        if np.any(different):
+            i = int(np.argmax(different))
+            name = next(name for name, _ in trajectory.STEP_COLUMNS if expected[name][i] != actual[name][i])
+            return {'step': offset + i, 'game': int(expected['game'][i]), 'turn': int(expected['turn'][i]),
+                    'unit': int(expected['unit'][i]), 'column': name, 'expected': expected[name][i].item(),
+                    'actual': actual[name][i].item()}
+
+        expected = {name: column[rows:] for name, column in expected.items()}
+        actual = {name: column[rows:] for name, column in actual.items()}
+        offset += rows
+
+
+def replay(path):
+    """
+    Plays the games of a golden recording with the current engine and compares them to the recording
+
+    :return: a dictionary with 'divergence' (see first_divergence; None if every step matched), 'rank_mismatches'
+    (game numbers whose final ranks differ), 'seconds' (how long the current engine took) and 'speedup' (recorded
+    seconds / current seconds)
+    """
+    if not os.path.exists(metadata_path(path)):
+        raise FEGoldenError(f'{path} has no golden metadata ({metadata_path(path)}); record it with golden.record')
+    with open(metadata_path(path)) as f:
+        metadata = json.load(f)
+
+    candidate_file, candidate_path = tempfile.mkstemp(suffix='.traj')
+    os.close(candidate_file)
+    try:
+        ranks, seconds = play_games(candidate_path, metadata['mode'], metadata['games'], metadata['seed'],
+                                    metadata['red_policy'])
+        divergence = first_divergence(path, candidate_path)
+    finally:
+        os.remove(candidate_path)
+
+    rank_mismatches = [game for game, (expected, actual) in enumerate(zip(metadata['ranks'], ranks))
+                       if expected != actual]
+    return {'divergence': divergence, 'rank_mismatches': rank_mismatches, 'seconds': seconds,
+            'speedup': metadata['seconds'] / seconds}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Record golden games, or check the engine still plays them the same')
+    parser.add_argument('command', choices=('record', 'replay'))
+    parser.add_argument('path', help='golden trajectory file')
+    parser.add_argument('--mode', default='mini', help='simulation mode to record (see main.scenarios)')
+    parser.add_argument('--games', type=int, default=50, help='games to record')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--red-policy', default='random', help='how the red team plays in the recorded games')
+    parser.add_argument('--backend', default='auto', help='kernel backend to play with: python, numba or auto')
+    args = parser.parse_args()
+
+    kernels.set_backend(args.backend)
+
+    if args.command == 'record':
+        recorded = record(args.path, args.mode, args.games, args.seed, args.red_policy)
+        print(colored('Recorded ', 'green') + f"{args.games} {args.mode} games in {recorded['seconds']:.2f} seconds "
+                                              f"({kernels.backend()} kernels)")
+    else:
+        result = replay(args.path)
+        print(f"Replayed in {result['seconds']:.2f} seconds ({kernels.backend()} kernels): "
+              f"{result['speedup']:.2f}x the recorded speed")
+        if result['divergence'] is None and len(result['rank_mismatches']) == 0:
+            print(colored('OK: ', 'green') + 'every step and rank matches the recording')
+        else:
+            if result['divergence'] is not None:
+                d = result['divergence']
+                print(colored('DIVERGED: ', 'red') + f"step {d['step']} (game {d['game']}, turn {d['turn']}, unit "
+                                                     f"{d['unit']}): {d['column']} was {d['actual']}, expected "
+                                                     f"{d['expected']}")
+            if len(result['rank_mismatches']) > 0:
+                print(colored('RANKS DIFFER: ', 'red') + f"games {result['rank_mismatches']}")
+            raise SystemExit(1)
@@ -0,0 +1,466 @@
+import argparse
+import collections
+import contextlib
+import json
+import os
+import queue
+import random
+import socket
+import socketserver
+import threading
+import time
+
+import numpy as np
+from termcolor import colored
+
+import environment
+import feutils
+import map
+import policy
+import unit_populator
+
+# The inference server speaks newline delimited JSON over a stream socket (a Unix socket or TCP), one request per line
+# and one response per line, in order. A request describes a board and the blue unit to decide for:
+#   {"id": 7,
+#    "terrain": [["Plain", "Forest", ...], ...],                    -> x rows of y tile names
+#    "units": [{"team": "blue", "name": "Lyn", "x": 0, "y": 0, "hp": 16},
+#              {"team": "red", "class": 1860, "level": 2, "hp_max": 25, "stats": [5, 4, 4, 3, 4, 2, 0],
+#               "items": [31], "x": 5, "y": 7, "hp": 25}, ...],     -> red stats: strength, skill, speed, luck, defense,
+#                                                                      resistance, magic
+#    "unit": 0,                                                     -> index in units of the blue unit to decide for
+#    "epsilon": 0.0}                                                -> optional exploration rate (default 0, greedy)
+# where blue units are named as in unit_populator's rosters, red classes and items are the game's codes,
+# and is answered with
+#   {"id": 7, "state": [E, N], "action": 0|1|2, "move": [x, y], "target": index in units or null, "item": index in
+#    the unit's inventory or null}
+# or {"id": 7, "error": "..."}. {"command": "stats"} is answered with the server's latency and batching statistics.
+DEFAULT_ADDRESS = '127.0.0.1:7654'
+
+
+class FEInferenceError(Exception):
+    pass
+
+
+def parse_address(address):
+    """
+    :param address: 'host:port' for TCP, or the path of a Unix socket
+    :return: (socket family, address as the socket module takes it)
+    """
+    host, _, port = address.rpartition(':')
+    if host != '' and port.isdigit():
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+class PendingRequest:
+    """
+    A request waiting for the batch it is answered in
+    """
+    def __init__(self, request):
+        self.request = request
+        self.received = time.perf_counter()
+        self.response = None
+        self.answered = threading.Event()
+
+
+class PolicyServer:
+    """
+    Answers decision requests with a run's q-tables, loaded once, and the blue units' move and target heuristics.
+
+    Requests from every connection are put in one queue. A batch thread takes up to max_batch of them at a time
+    (waiting at most max_wait seconds for more after the first), works out every request's state and action mask,
+    picks all of their actions with one policy.batch_select_actions call, then their moves and targets.
+    """
+    def __init__(self, run_name, max_batch=64, max_wait=0.002, map_cache_size=64, latency_capacity=100000):
+        """
+        :param run_name: The run whose q-tables decide the actions
+        :param max_batch: Most requests answered in one batch
+        :param max_wait: Seconds a batch waits for more requests after its first one
+        :param map_cache_size: How many boards' terrain (with its cost grids and distance fields) to keep
+        :param latency_capacity: How many of the latest request latencies the statistics are computed over
+        """
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            self.env = environment.Environment(1, 1, 1, 1)
+        self.unit_factory = unit_populator.UnitFactory(0, 0, 0, 0, run_name, read_only=True)
+        # Load every character's q-table now rather than on its first request
+        for name in feutils.playable_characters():
+            self.unit_factory.get_character(name)
+        self.red_units = []
+
+        # Terrain (tile names as bytes) -> Map, least recently used first
+        self.maps = collections.OrderedDict()
+        self.map_cache_size = map_cache_size
+
+        self.requests = queue.Queue()
+        self.latencies = np.zeros(latency_capacity, dtype=np.float64)
+        self.answered = 0
+        self.batches = 0
+        self.stopping = threading.Event()
+        self.batch_thread = None
+        self.server = None
+
+    def serve_forever(self, address=DEFAULT_ADDRESS):
+        """
+        Listens on address ('host:port' or the path of a Unix socket) until shutdown is called
+        """
+        family, socket_address = parse_address(address)
+        server_class = socketserver.ThreadingTCPServer if family == socket.AF_INET else \
+            socketserver.ThreadingUnixStreamServer
+        if family == socket.AF_UNIX and os.path.exists(socket_address):
+            os.remove(socket_address)
+
+        server_class.daemon_threads = True
+        server_class.allow_reuse_address = True
+        self.server = server_class(socket_address, self.handler())
+
+        self.batch_thread = threading.Thread(target=self.answer_batches, daemon=True)
+        self.batch_thread.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stopping.set()
+            self.batch_thread.join()
+            self.server.server_close()
+            if family == socket.AF_UNIX and os.path.exists(socket_address):
+                os.remove(socket_address)
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+    def handler(self):
+        policy_server = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if len(line.strip()) == 0:
+                        continue
+                    try:
+                        request = json.loads(line)
+                    except ValueError as e:
+                        response = {'error': f'Request is not JSON: {e}'}
+                    else:
+                        if isinstance(request, dict):
+                            response = policy_server.submit(request)
+                        else:
+                            response = {'error': 'Request is not a JSON object'}
+                    self.wfile.write(json.dumps(response).encode() + b'\n')
+                    self.wfile.flush()
+
+        return RequestHandler
+
+    def submit(self, request):
+        """
+        Answers a request, waiting for the batch it is put in
+
+        :return: the response
+        """
+        if request.get('command') == 'stats':
+            return self.statistics()
+
+        pending = PendingRequest(request)
+        self.requests.put(pending)
+        pending.answered.wait()
+        return pending.response
+
+    def answer_batches(self):
+        while not self.stopping.is_set():
+            try:
+                batch = [self.requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+
+            deadline = batch[0].received + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.perf_counter(), 0)))
+                except queue.Empty:
+                    break
+
+            # Every request of the batch is answered, even if deciding fails, or its client would wait forever
+            responses = [None] * len(batch)
+            error = 'Could not decide'
+            try:
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    responses = self.decide(batch)
+            except Exception as e:
+                error = f'Could not decide: {e!r}'
+
+            now = time.perf_counter()
+            for pending, response in zip(batch, responses):
+                pending.response = response if response is not None else {'id': pending.request.get('id'),
+                                                                           'error': error}
+                self.latencies[self.answered % len(self.latencies)] = now - pending.received
+                self.answered += 1
+                pending.answered.set()
+            self.batches += 1
+
+    def decide(self, batch):
+        """
+        :param batch: a list of PendingRequest
+        :return: the response of every request
+        """
+        responses = [None] * len(batch)
+        decisions = []
+        q_values = []
+        action_masks = []
+        epsilons = []
+
+        # Every request's state and action mask, so the actions of the whole batch are picked at once
+        for i, pending in enumerate(batch):
+            request = pending.request
+            try:
+                tile_map, blue_team, red_team, unit = self.board(request)
+                self.env.reset((tile_map, None))
+                state = self.env.obtain_state(unit, blue_team, red_team)
+                options = self.env.enumerate_options(unit, blue_team, red_team)
+                epsilon = float(request.get('epsilon', 0.0))
+                if not 0 <= epsilon <= 1:
+                    raise FEInferenceError(f'epsilon must be between 0 and 1, not {epsilon}')
+            except (FEInferenceError, KeyError, IndexError, TypeError, ValueError) as e:
+                responses[i] = {'id': request.get('id'), 'error': f'Bad request: {e!r}'}
+                continue
+
+            decisions.append((i, request, state))
+            q_values.append(unit.q_table[state])
+            action_masks.append(options.action_mask)
+            epsilons.append(epsilon)
+
+        if len(decisions) == 0:
+            return responses
+        actions, _ = policy.batch_select_actions(np.array(q_values), np.array(action_masks), np.array(epsilons))
+
+        # Moves, targets and items; the units of every request are rebuilt as the units are reused across requests
+        for (i, request, state), action in zip(decisions, actions.tolist()):
+            try:
+                responses[i] = self.answer(request, state, action)
+            except Exception as e:
+                responses[i] = {'id': request.get('id'), 'error': f'Could not decide: {e!r}'}
+
+        return responses
+
+    def answer(self, request, state, action):
+        """
+        Works out the move, target and item of a request whose action was picked
+
+        :return: the response to the request
+        """
+        tile_map, blue_team, red_team, unit = self.board(request)
+        self.env.reset((tile_map, None))
+        units = blue_team + red_team
+
+        move = unit.determine_move(action, blue_team, red_team, self.env)
+        target = None
+        item = None
+        if action == 2:
+            targets = self.env.enumerate_options(unit, blue_team, red_team).targets.get(tuple(move))
+            unit.goto(*move)
+            target = units.index(unit.determine_target(self.env, red_team, targets))
+        elif action == 1:
+            item = unit.determine_item_to_use(self.env, red_team)
+
+        return {'id': request.get('id'), 'state': list(state), 'action': action,
+                'move': [int(move[0]), int(move[1])], 'target': target, 'item': item}
+
+    def board(self, request):
+        """
+        Builds the board of a request
+
+        :return: tile_map, blue_team, red_team, the unit to decide for
+        """
+        terrain = np.array(request['terrain'], dtype='<U8')
+        if terrain.ndim != 2:
+            raise FEInferenceError('terrain must be a 2D list of tile names')
+
+        key = terrain.shape, terrain.tobytes()
+        if key in self.maps:
+            self.maps.move_to_end(key)
+        else:
+            self.maps[key] = map.Map(terrain.shape[0], terrain.shape[1], terrain)
+            self.maps[key].precompute_terrain()
+            if len(self.maps) > self.map_cache_size:
+                self.maps.popitem(last=False)
+        tile_map = self.maps[key]
+
+        blue_team = []
+        red_team = []
+        units = []
+        for spec in request['units']:
+            if not (0 <= spec['x'] < tile_map.x and 0 <= spec['y'] < tile_map.y):
+                raise FEInferenceError(f"unit at {spec['x']}, {spec['y']} is off the map")
+
+            if spec['team'] == 'blue':
+                unit = self.unit_factory.get_character(spec['name'])
+                if unit in blue_team:
+                    raise FEInferenceError(f"{spec['name']} is on the board more than once")
+                blue_team.append(unit)
+            elif spec['team'] == 'red':
+                if len(self.red_units) == len(red_team):
+                    self.red_units.append(None)
+                stats = (spec['class'], spec['hp_max'], *spec['stats'], spec['items'])
+                unit = self.unit_factory.get_red_unit(spec['level'], stats, self.red_units[len(red_team)])
+                self.red_units[len(red_team)] = unit
+                red_team.append(unit)
+            else:
+                raise FEInferenceError(f"team must be blue or red, not {spec['team']}")
+
+            unit.goto(spec['x'], spec['y'])
+            unit.current_hp = spec.get('hp', unit.hp_max)
+            units.append(unit)
+
+        unit = units[request['unit']]
+        if unit not in blue_team:
+            raise FEInferenceError('decisions are only made for blue units')
+        return tile_map, blue_team, red_team, unit
+
+    def statistics(self):
+        """
+        :return: dictionary with how many requests and batches were answered, the mean batch size, and the p50, p99
+        and max latency (from receiving a request to answering it) in milliseconds over the latest requests
+        """
+        latencies = self.latencies[:min(self.answered, len(self.latencies))] * 1000
+        if len(latencies) == 0:
+            latencies = np.zeros(1)
+        return {'requests': self.answered, 'batches': self.batches,
+                'mean_batch': self.answered / self.batches if self.batches > 0 else 0.0,
+                'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99)),
+                'max_ms': float(np.max(latencies))}
+
+
+def board_request(blue_team, red_team, tile_map, unit, roster_names, request_id=None, epsilon=0.0):
+    """
+    :param roster_names: dictionary from every blue unit to its name in unit_populator's rosters (which is not always
+    unit.name; Wil has Rebecca's character code)
+    :return: the request asking for unit's decision on a board of the simulator
+    """
+    units = []
+    for u in blue_team:
+        units.append({'team': 'blue', 'name': roster_names[u], 'x': u.x, 'y': u.y, 'hp': u.current_hp})
+    for u in red_team:
+        units.append({'team': 'red', 'class': u.job_code, 'level': u.level, 'hp_max': u.hp_max,
+                      'stats': [u.strength, u.skill, u.speed, u.luck, u.defense, u.res, u.magic],
+                      'items': [i.item_code for i in u.inventory], 'x': u.x, 'y': u.y, 'hp': u.current_hp})
+
+    return {'id': request_id, 'terrain': [[tile.name for tile in row] for row in tile_map.grid],
+            'units': units, 'unit': (blue_team + red_team).index(unit), 'epsilon': epsilon}
+
+
+class PolicyClient:
+    """
+    A connection to a PolicyServer
+    """
+    def __init__(self, address=DEFAULT_ADDRESS):
+        family, socket_address = parse_address(address)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.connect(socket_address)
+        self.file = self.socket.makefile('rwb')
+
+    def request(self, request):
+        self.file.write(json.dumps(request).encode() + b'\n')
+        self.file.flush()
+        return json.loads(self.file.readline())
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+def generate_requests(count, simulation_mode='mini', seed=0):
+    """
+    Deploys teams on generated maps and asks for a decision of one of their blue units
+
+    :return: a list of count requests
+    """
+    import main
+
+    random.seed(seed)
+    np.random.seed(seed)
+    requests = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        env, unit_factory = main.create_simulation(simulation_mode, 'zzinference', read_only=True)
+        while len(requests) < count:
+            blue_team, red_team = main.setup_episode(env, unit_factory)
+            roster_names = {u: name for name, u in unit_factory.blue_pool.items()}
+            unit = random.choice(blue_team)
+            requests.append(board_request(blue_team, red_team, env.map, unit, roster_names, len(requests)))
+
+    return requests
+
+
+def run_load(address, requests, clients=8, duration=10.0):
+    """
+    Sends requests from concurrent clients, each one waiting for its answer before sending its next request, for
+    duration seconds
+
+    :return: dictionary with requests per second, the p50 and p99 round trip latency in milliseconds, how many
+    responses were errors, and the server's statistics
+    """
+    latencies = [[] for _ in range(clients)]
+    errors = [0] * clients
+    stop = time.perf_counter() + duration
+
+    def client_loop(c):
+        client = PolicyClient(address)
+        i = c
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            response = client.request(requests[i % len(requests)])
+            latencies[c].append(time.perf_counter() - start)
+            errors[c] += 'error' in response
+            i += clients
+        client.close()
+
+    threads = [threading.Thread(target=client_loop, args=(c,)) for c in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    stats_client = PolicyClient(address)
+    server_statistics = stats_client.request({'command': 'stats'})
+    stats_client.close()
+
+    round_trips = np.concatenate([np.array(c) for c in latencies]) * 1000
+    return {'requests_per_second': len(round_trips) / elapsed, 'p50_ms': float(np.percentile(round_trips, 50)),
+            'p99_ms': float(np.percentile(round_trips, 99)), 'errors': sum(errors), 'server': server_statistics}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a run\'s policy over a socket, or benchmark a running server')
+    parser.add_argument('command', choices=('serve', 'load'))
+    parser.add_argument('--run-name', default=None, help='run whose q-tables are served (serve)')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help="'host:port' or the path of a Unix socket")
+    parser.add_argument('--max-batch', type=int, default=64, help='most requests answered in one batch (serve)')
+    parser.add_argument('--max-wait', type=float, default=0.002,
+                        help='seconds a batch waits for more requests (serve)')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients (load)')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to send requests for (load)')
+    parser.add_argument('--boards', type=int, default=200, help='distinct boards to send (load)')
+    parser.add_argument('--mode', default='mini', help='simulation mode the boards are made in (load)')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        if args.run_name is None:
+            parser.error('serve needs --run-name')
+        policy_server = PolicyServer(args.run_name.strip().lower(), args.max_batch, args.max_wait)
+        print(colored(f'Serving {args.run_name} on {args.address}', 'green'))
+        try:
+            policy_server.serve_forever(args.address)
+        except KeyboardInterrupt:
+            pass
+        print(policy_server.statistics())
+    else:
+        load = run_load(args.address, generate_requests(args.boards, args.mode), args.clients, args.duration)
+        print(colored('LOAD: ', 'yellow') + f"{load['requests_per_second']:.0f} requests/s, round trip p50 "
+                                            f"{load['p50_ms']:.2f}ms, p99 {load['p99_ms']:.2f}ms, "
+                                            f"{load['errors']} errors")
+        server = load['server']
+        print(colored('SERVER: ', 'yellow') + f"{server['requests']} requests in {server['batches']} batches "
+                                              f"(mean {server['mean_batch']:.1f}), p50 {server['p50_ms']:.2f}ms, "
+                                              f"p99 {server['p99_ms']:.2f}ms")
@@ -8,6 +8,15 @@ class Item:
         self.item_type = feutils.item_type_table(item_code)
 
         self.info = feutils.item_info_lookup(self.name, self.item_type)
+        # Consumables count their uses down in info; None for items that are never used up
+        self.starting_uses = self.info.get('uses') if self.info is not None else None
+
+    def reset(self):
+        """
+        Restores the uses of the item to what it had when it was made
+        """
+        if self.starting_uses is not None:
+            self.info['uses'] = self.starting_uses
 
     def __str__(self):
         return self.name
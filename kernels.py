@@ -0,0 +1,442 @@
+"""
+Hot-path kernels for reachability, terrain distance fields and regions, attack range scanning and combat
+forecasting.
+
+Every kernel has a pure Python/NumPy implementation and, when Numba is installed, a compiled one. The compiled
+backend is used automatically if it is available; set_backend (or the PYRE_KERNELS environment variable, 'python',
+'numba' or 'auto') switches between them at runtime. Both backends give identical results; validate_backends checks
+this on random boards, and scripts/kernel_check.py runs it.
+"""
+import os
+import time
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+class FEKernelBackendError(Exception):
+    pass
+
+
+# Columns of the per unit feature vectors used by the combat forecast kernel; see combat.combat_features
+FEATURE_X, FEATURE_Y = 0, 1
+FEATURE_POWER, FEATURE_DEFENSE, FEATURE_RESISTANCE = 2, 3, 4
+FEATURE_SKILL, FEATURE_LUCK, FEATURE_SPEED, FEATURE_CON = 5, 6, 7, 8
+FEATURE_MIGHT, FEATURE_HIT, FEATURE_CRIT, FEATURE_WEIGHT = 9, 10, 11, 12
+FEATURE_RANGE_BITS, FEATURE_MAGIC, FEATURE_CRIT_BONUS = 13, 14, 15
+FEATURE_TILE_DEFENSE, FEATURE_TILE_AVOID = 16, 17
+FEATURE_COUNT = 18
+
+# Columns of the forecast kernel output; the attacker's Combat, then the defender's
+FORECAST_HIT, FORECAST_MIGHT, FORECAST_CRIT, FORECAST_DOUBLING = 0, 1, 2, 3
+FORECAST_COUNT = 8
+
+# Terrain distances are stored as uint8; this marks tiles that are unreachable or further than MAX_DISTANCE
+UNREACHABLE = 255
+MAX_DISTANCE = UNREACHABLE - 1
+
+
+def _python_reachable_mask(costs, start_x, start_y, movement, blocked):
+    """
+    Every tile a unit could move to from (start_x, start_y): the cost of a path is the sum of the costs of the tiles
+    it enters, and paths cannot enter blocked tiles. The starting tile is always reachable.
+
+    Every tile costs at least 1, so a path within budget has at most `movement` steps and that many rounds of
+    relaxation find every shortest path.
+    """
+    x_tiles, y_tiles = costs.shape
+    entry_costs = np.where(blocked, np.inf, costs.astype(float))
+    distance = np.full((x_tiles, y_tiles), np.inf)
+    distance[start_x, start_y] = 0
+
+    for _ in range(movement):
+        relaxed = distance.copy()
+        np.minimum(relaxed[1:, :], distance[:-1, :] + entry_costs[1:, :], out=relaxed[1:, :])
+        np.minimum(relaxed[:-1, :], distance[1:, :] + entry_costs[:-1, :], out=relaxed[:-1, :])
+        np.minimum(relaxed[:, 1:], distance[:, :-1] + entry_costs[:, 1:], out=relaxed[:, 1:])
+        np.minimum(relaxed[:, :-1], distance[:, 1:] + entry_costs[:, :-1], out=relaxed[:, :-1])
+        if np.array_equal(relaxed, distance):
+            break
+        distance = relaxed
+
+    return distance <= movement
+
+
+def _python_distance_field(costs, sources):
+    """
+    The terrain only movement distance from the nearest of the sources to every tile: the cost of a path is the sum of
+    the costs of the tiles it enters. Distances over MAX_DISTANCE are UNREACHABLE.
+
+    :param sources: int array of (x, y) rows
+    :return: a uint8 array with the shape of costs
+    """
+    x_tiles, y_tiles = costs.shape
+    entry_costs = np.where(costs > MAX_DISTANCE, np.inf, costs.astype(float))
+    distance = np.full((x_tiles, y_tiles), np.inf)
+    distance[sources[:, 0], sources[:, 1]] = 0
+
+    # Every tile costs at least 1, so MAX_DISTANCE rounds always suffice
+    for _ in range(MAX_DISTANCE):
+        relaxed = distance.copy()
+        np.minimum(relaxed[1:, :], distance[:-1, :] + entry_costs[1:, :], out=relaxed[1:, :])
+        np.minimum(relaxed[:-1, :], distance[1:, :] + entry_costs[:-1, :], out=relaxed[:-1, :])
+        np.minimum(relaxed[:, 1:], distance[:, :-1] + entry_costs[:, 1:], out=relaxed[:, 1:])
+        np.minimum(relaxed[:, :-1], distance[:, 1:] + entry_costs[:, :-1], out=relaxed[:, :-1])
+        if np.array_equal(relaxed, distance):
+            break
+        distance = relaxed
+
+    return np.where(distance <= MAX_DISTANCE, distance, UNREACHABLE).astype(np.uint8)
+
+
+def _python_region_labels(passable):
+    """
+    Labels the connected regions of passable tiles: every tile of a region gets the highest flat index
+    (x * y_tiles + y) of the region's tiles. Impassable tiles are labelled -1.
+
+    :return: an int32 array with the shape of passable
+    """
+    x_tiles, y_tiles = passable.shape
+    labels = np.where(passable, np.arange(x_tiles * y_tiles, dtype=np.int32).reshape(x_tiles, y_tiles), -1)
+
+    # Spread the highest label of every region over it
+    while True:
+        spread = labels.copy()
+        np.maximum(spread[1:, :], labels[:-1, :], out=spread[1:, :])
+        np.maximum(spread[:-1, :], labels[1:, :], out=spread[:-1, :])
+        np.maximum(spread[:, 1:], labels[:, :-1], out=spread[:, 1:])
+        np.maximum(spread[:, :-1], labels[:, 1:], out=spread[:, :-1])
+        spread[~passable] = -1
+        if np.array_equal(spread, labels):
+            return labels
+        labels = spread
+
+
+def _python_attack_tile_mask(x_tiles, y_tiles, targets, range_bits):
+    """
+    Every tile from which at least one target is at a distance in range_bits (bit r is set if r is in range)
+    """
+    mask = np.zeros((x_tiles, y_tiles), dtype=bool)
+    if len(targets) == 0:
+        return mask
+
+    xs = np.arange(x_tiles)[:, np.newaxis, np.newaxis]
+    ys = np.arange(y_tiles)[np.newaxis, :, np.newaxis]
+    distances = np.abs(xs - targets[:, 0]) + np.abs(ys - targets[:, 1])
+    in_range = ((range_bits >> np.minimum(distances, 62)) & 1).astype(bool) & (distances < 63)
+    return np.any(in_range, axis=2)
+
+
+def _python_combat_forecast(attackers, defenders, triangles):
+    """
+    Vectorized combat.get_combat_stats. Each row of attackers/defenders is a feature vector from
+    combat.combat_features; each row of triangles is (attacker might bonus, attacker accuracy bonus,
+    defender might bonus, defender accuracy bonus).
+    """
+    forecast = np.zeros((attackers.shape[0], FORECAST_COUNT))
+    for side, (a, d, tri_might, tri_hit) in enumerate(((attackers, defenders, triangles[:, 0], triangles[:, 1]),
+                                                       (defenders, attackers, triangles[:, 2], triangles[:, 3]))):
+        offset = side * 4
+        distance = np.abs(a[:, FEATURE_X] - d[:, FEATURE_X]) + np.abs(a[:, FEATURE_Y] - d[:, FEATURE_Y])
+        in_range = ((a[:, FEATURE_RANGE_BITS].astype(np.int64) >> np.minimum(distance, 62).astype(np.int64)) & 1) == 1
+
+        accuracy = a[:, FEATURE_HIT] + ((a[:, FEATURE_SKILL] / 100) * 2) + ((a[:, FEATURE_LUCK] / 100) / 2) + tri_hit
+        attack_speed_a = a[:, FEATURE_SPEED] - np.maximum(a[:, FEATURE_WEIGHT] - a[:, FEATURE_CON], 0)
+        attack_speed_d = d[:, FEATURE_SPEED] - np.maximum(d[:, FEATURE_WEIGHT] - d[:, FEATURE_CON], 0)
+        avoid = ((attack_speed_d * 2) / 100) + (d[:, FEATURE_LUCK] / 100) + d[:, FEATURE_TILE_AVOID]
+        hit = np.minimum(np.maximum(0.0, accuracy - avoid), 1.0)
+        forecast[:, offset + FORECAST_HIT] = np.where(in_range & (distance < 63), hit, 0.0)
+
+        reduction = np.where(a[:, FEATURE_MAGIC] == 1, d[:, FEATURE_RESISTANCE], d[:, FEATURE_DEFENSE])
+        attack = a[:, FEATURE_POWER] + (a[:, FEATURE_MIGHT] + tri_might)
+        forecast[:, offset + FORECAST_MIGHT] = np.maximum(attack - (reduction + d[:, FEATURE_TILE_DEFENSE]), 0)
+
+        crit_rate = a[:, FEATURE_CRIT] + ((a[:, FEATURE_SKILL] / 100) / 2) + a[:, FEATURE_CRIT_BONUS]
+        forecast[:, offset + FORECAST_CRIT] = np.minimum(np.maximum(0, crit_rate - d[:, FEATURE_LUCK] / 100), 1.0)
+        forecast[:, offset + FORECAST_DOUBLING] = (attack_speed_a - attack_speed_d) >= 4
+
+    return forecast
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _numba_reachable_mask(costs, start_x, start_y, movement, blocked):
+        x_tiles, y_tiles = costs.shape
+        distance = np.full((x_tiles, y_tiles), np.inf)
+        distance[start_x, start_y] = 0
+        dxs = (1, -1, 0, 0)
+        dys = (0, 0, 1, -1)
+
+        # Bellman-Ford rounds, like the python kernel; at most `movement` of them are ever needed
+        for _ in range(movement):
+            relaxed = distance.copy()
+            changed = False
+            for x in range(x_tiles):
+                for y in range(y_tiles):
+                    if distance[x, y] > movement:
+                        continue
+                    for k in range(4):
+                        nx, ny = x + dxs[k], y + dys[k]
+                        if nx < 0 or nx >= x_tiles or ny < 0 or ny >= y_tiles or blocked[nx, ny]:
+                            continue
+                        candidate = distance[x, y] + costs[nx, ny]
+                        if candidate < relaxed[nx, ny]:
+                            relaxed[nx, ny] = candidate
+                            changed = True
+            distance = relaxed
+            if not changed:
+                break
+
+        return distance <= movement
+
+    @numba.njit(cache=True)
+    def _numba_distance_field(costs, sources):
+        x_tiles, y_tiles = costs.shape
+        distance = np.full((x_tiles, y_tiles), MAX_DISTANCE + 1, dtype=np.int64)
+        for s in range(sources.shape[0]):
+            distance[sources[s, 0], sources[s, 1]] = 0
+        dxs = (1, -1, 0, 0)
+        dys = (0, 0, 1, -1)
+
+        # Relaxed in place, so paths can grow by more than one tile per round; the result is the same
+        changed = True
+        while changed:
+            changed = False
+            for x in range(x_tiles):
+                for y in range(y_tiles):
+                    if distance[x, y] >= MAX_DISTANCE:
+                        continue
+                    for k in range(4):
+                        nx, ny = x + dxs[k], y + dys[k]
+                        if nx < 0 or nx >= x_tiles or ny < 0 or ny >= y_tiles:
+                            continue
+                        candidate = distance[x, y] + costs[nx, ny]
+                        if candidate < distance[nx, ny]:
+                            distance[nx, ny] = candidate
+                            changed = True
+
+        field = np.empty((x_tiles, y_tiles), dtype=np.uint8)
+        for x in range(x_tiles):
+            for y in range(y_tiles):
+                field[x, y] = distance[x, y] if distance[x, y] <= MAX_DISTANCE else UNREACHABLE
+        return field
+
+    @numba.njit(cache=True)
+    def _numba_region_labels(passable):
+        x_tiles, y_tiles = passable.shape
+        labels = np.full((x_tiles, y_tiles), -1, dtype=np.int32)
+        stack = np.empty((x_tiles * y_tiles, 2), dtype=np.int64)
+        region = np.empty((x_tiles * y_tiles, 2), dtype=np.int64)
+        dxs = (1, -1, 0, 0)
+        dys = (0, 0, 1, -1)
+
+        for sx in range(x_tiles):
+            for sy in range(y_tiles):
+                if not passable[sx, sy] or labels[sx, sy] != -1:
+                    continue
+
+                # Flood fill the region, then label it with its highest flat index
+                labels[sx, sy] = 0
+                stack[0, 0], stack[0, 1] = sx, sy
+                size, count, highest = 1, 0, 0
+                while size > 0:
+                    size -= 1
+                    x, y = stack[size, 0], stack[size, 1]
+                    region[count, 0], region[count, 1] = x, y
+                    count += 1
+                    highest = max(highest, x * y_tiles + y)
+                    for k in range(4):
+                        nx, ny = x + dxs[k], y + dys[k]
+                        if 0 <= nx < x_tiles and 0 <= ny < y_tiles and passable[nx, ny] and labels[nx, ny] == -1:
+                            labels[nx, ny] = 0
+                            stack[size, 0], stack[size, 1] = nx, ny
+                            size += 1
+
+                for i in range(count):
+                    labels[region[i, 0], region[i, 1]] = highest
+        return labels
+
+    @numba.njit(cache=True)
+    def _numba_attack_tile_mask(x_tiles, y_tiles, targets, range_bits):
+        mask = np.zeros((x_tiles, y_tiles), dtype=np.bool_)
+        for x in range(x_tiles):
+            for y in range(y_tiles):
+                for t in range(targets.shape[0]):
+                    distance = abs(x - targets[t, 0]) + abs(y - targets[t, 1])
+                    if distance < 63 and (range_bits >> distance) & 1:
+                        mask[x, y] = True
+                        break
+        return mask
+
+    @numba.njit(cache=True)
+    def _numba_combat_forecast(attackers, defenders, triangles):
+        n = attackers.shape[0]
+        forecast = np.zeros((n, 8))
+        for i in range(n):
+            for side in range(2):
+                if side == 0:
+                    a, d = attackers[i], defenders[i]
+                    tri_might, tri_hit = triangles[i, 0], triangles[i, 1]
+                else:
+                    a, d = defenders[i], attackers[i]
+                    tri_might, tri_hit = triangles[i, 2], triangles[i, 3]
+                offset = side * 4
+
+                distance = abs(a[0] - d[0]) + abs(a[1] - d[1])
+                attack_speed_a = a[7] - max(a[12] - a[8], 0)
+                attack_speed_d = d[7] - max(d[12] - d[8], 0)
+
+                if distance < 63 and (np.int64(a[13]) >> np.int64(distance)) & 1:
+                    accuracy = a[10] + ((a[5] / 100) * 2) + ((a[6] / 100) / 2) + tri_hit
+                    avoid = ((attack_speed_d * 2) / 100) + (d[6] / 100) + d[17]
+                    forecast[i, offset] = min(max(0.0, accuracy - avoid), 1.0)
+
+                reduction = d[4] if a[14] == 1 else d[3]
+                attack = a[2] + (a[9] + tri_might)
+                forecast[i, offset + 1] = max(attack - (reduction + d[16]), 0)
+
+                crit_rate = a[11] + ((a[5] / 100) / 2) + a[15]
+                forecast[i, offset + 2] = min(max(0, crit_rate - d[6] / 100), 1.0)
+                forecast[i, offset + 3] = 1.0 if (attack_speed_a - attack_speed_d) >= 4 else 0.0
+        return forecast
+
+
+_backends = {
+    'python': (_python_reachable_mask, _python_attack_tile_mask, _python_combat_forecast, _python_distance_field,
+               _python_region_labels)
+}
+if numba is not None:
+    _backends['numba'] = (_numba_reachable_mask, _numba_attack_tile_mask, _numba_combat_forecast,
+                          _numba_distance_field, _numba_region_labels)
+
+_active = None
+reachable_mask = None
+distance_field = None
+region_labels = None
+attack_tile_mask = None
+combat_forecast = None
+
+
+def available_backends():
+    return list(_backends.keys())
+
+
+def backend():
+    return _active
+
+
+def set_backend(name='auto'):
+    """
+    Switches the kernels to a backend
+
+    :param name: 'python', 'numba', or 'auto' (numba if it is installed, python otherwise)
+    :except FEKernelBackendError if the backend is unknown or not installed
+    """
+    global _active, reachable_mask, attack_tile_mask, combat_forecast, distance_field, region_labels
+
+    if name == 'auto':
+        name = 'numba' if 'numba' in _backends else 'python'
+    if name not in _backends:
+        raise FEKernelBackendError(f'Kernel backend must be one of {available_backends()} or auto, not: [ {name} ]')
+
+    _active = name
+    reachable_mask, attack_tile_mask, combat_forecast, distance_field, region_labels = _backends[name]
+
+
+def range_bits(attack_range):
+    """
+    Encodes a list of attack ranges as a bit mask (bit r is set if r is in range)
+    """
+    bits = 0
+    for r in attack_range:
+        bits |= 1 << r
+    return bits
+
+
+def _random_board(rng, x_tiles, y_tiles):
+    costs = rng.choice(np.array([1, 1, 1, 2, 3, 999]), size=(x_tiles, y_tiles))
+    blocked = rng.random((x_tiles, y_tiles)) < 0.05
+    start_x, start_y = int(rng.integers(x_tiles)), int(rng.integers(y_tiles))
+    blocked[start_x, start_y] = False
+    return costs, start_x, start_y, int(rng.integers(0, 9)), blocked
+
+
+def _random_features(rng, n):
+    features = rng.integers(0, 20, size=(n, FEATURE_COUNT)).astype(float)
+    features[:, FEATURE_X:FEATURE_Y + 1] = rng.integers(0, 4, size=(n, 2))
+    features[:, FEATURE_HIT] = rng.random(n)
+    features[:, FEATURE_CRIT] = rng.random(n) / 4
+    features[:, FEATURE_RANGE_BITS] = rng.choice(np.array([2, 6, 4, 12]), size=n)
+    features[:, FEATURE_MAGIC] = rng.integers(0, 2, size=n)
+    features[:, FEATURE_CRIT_BONUS] = rng.choice(np.array([0.0, 0.15]), size=n)
+    features[:, FEATURE_TILE_AVOID] = rng.choice(np.array([0.0, 0.1, 0.2, 0.3]), size=n)
+    return features
+
+
+def validate_backends(trials=200, seed=0):
+    """
+    Runs every kernel of every available backend on random inputs and checks they all agree with the python backend
+
+    :return: True if every backend agrees
+    :except AssertionError describing the first disagreement
+    """
+    rng = np.random.default_rng(seed)
+    reference = _backends['python']
+
+    for name, kernels in _backends.items():
+        for trial in range(trials):
+            x_tiles, y_tiles = int(rng.integers(1, 25)), int(rng.integers(1, 25))
+            board = _random_board(rng, x_tiles, y_tiles)
+            assert np.array_equal(kernels[0](*board), reference[0](*board)), f'{name} reachable_mask, trial {trial}'
+
+            sources = np.array([[board[1], board[2]]] + [[int(rng.integers(x_tiles)), int(rng.integers(y_tiles))]
+                                                          for _ in range(int(rng.integers(0, 3)))], dtype=np.int64)
+            assert np.array_equal(kernels[3](board[0], sources), reference[3](board[0], sources)), \
+                f'{name} distance_field, trial {trial}'
+            passable = board[0] < 999
+            assert np.array_equal(kernels[4](passable), reference[4](passable)), f'{name} region_labels, trial {trial}'
+
+            targets = rng.integers(0, max(x_tiles, y_tiles), size=(int(rng.integers(0, 6)), 2))
+            bits = int(rng.choice([2, 6, 4, 12, 1 << 10 | 1 << 3]))
+            assert np.array_equal(kernels[1](x_tiles, y_tiles, targets, bits),
+                                  reference[1](x_tiles, y_tiles, targets, bits)), \
+                f'{name} attack_tile_mask, trial {trial}'
+
+            n = int(rng.integers(1, 8))
+            attackers, defenders = _random_features(rng, n), _random_features(rng, n)
+            triangles = rng.choice(np.array([-1.0, 0.0, 1.0]), size=(n, 4)) * np.array([1, 0.15, 1, 0.15])
+            assert np.array_equal(kernels[2](attackers, defenders, triangles),
+                                  reference[2](attackers, defenders, triangles)), \
+                f'{name} combat_forecast, trial {trial}'
+
+    return True
+
+
+set_backend(os.environ.get('PYRE_KERNELS', 'auto'))
+
+
+if __name__ == '__main__':
+    print(f'Available backends: {available_backends()}')
+    validate_backends()
+    print('All backends agree')
+
+    rng = np.random.default_rng(1)
+    boards = [_random_board(rng, 20, 20) for _ in range(500)]
+    for backend_name in available_backends():
+        set_backend(backend_name)
+        reachable_mask(*boards[0])  # Compile before timing
+        start = time.perf_counter()
+        for b in boards:
+            reachable_mask(*b)
+        elapsed = time.perf_counter() - start
+        print(f'{backend_name}: {elapsed / len(boards) * 1e6:.1f} us per 20x20 reachability query')
+
+        distance_field(boards[0][0], np.array([[0, 0]]))
+        start = time.perf_counter()
+        for b in boards:
+            distance_field(b[0], np.array([[b[1], b[2]]]))
+        elapsed = time.perf_counter() - start
+        print(f'{backend_name}: {elapsed / len(boards) * 1e6:.1f} us per 20x20 distance field')
@@ -2,14 +2,35 @@ import environment
 import unit_populator
 from termcolor import colored
 import fedata
+import convergence
+import checkpoint
+import red_planner
+import rollout
+import trajectory
+import experience
+import prefetch
+import memory
+import os
 import sys
+import argparse
 from datetime import datetime
 import logging
+import logging.handlers
 
 class FESimulationTypeError(Exception):
     pass
 
 
+# The simulation modes: map sizes (x_min, x_max, y_min, y_max), team sizes (blue_low, blue_high, red_low, red_high),
+# and the turn limit. There are 19 non-lord blue characters, so a blue team has at most 20 units
+scenarios = {
+    'mini': {'dimensions': (15, 15, 15, 15), 'team_sizes': (2, 2, 5, 5), 'turn_limit': 65},
+    'big': {'dimensions': (18, 20, 18, 20), 'team_sizes': (5, 6, 15, 18), 'turn_limit': 65},
+    'large': {'dimensions': (30, 34, 30, 34), 'team_sizes': (10, 12, 40, 50), 'turn_limit': 100},
+    'huge': {'dimensions': (64, 64, 64, 64), 'team_sizes': (19, 19, 100, 120), 'turn_limit': 150}
+}
+
+
 def game_over_check(blue_length, red_length, info, env):
     if blue_length == 0:
         info['winner'] = 'Red'
@@ -30,119 +51,385 @@ def configure_logger():
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
     formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s')
-    file_handler = logging.FileHandler('exceptions.log')
+    # Rotated, so a long run that keeps logging errors can't fill the disk
+    file_handler = logging.handlers.RotatingFileHandler('exceptions.log', maxBytes=10 * 1024 * 1024, backupCount=3)
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(formatter)
     logger.addHandler(file_handler)
     return logger
 
 
-def main(simulation_mode, run_name, iterations):
-    if simulation_mode == 'big':
-        env = environment.Environment(18, 20, 18, 20)
-        unit_factory = unit_populator.UnitFactory(5, 6, 15, 18, run_name)
-    else:
-        env = environment.Environment(15, 15, 15, 15)
-        unit_factory = unit_populator.UnitFactory(2, 2, 5, 5, run_name)
-
-    # Establish SQLite database
-    data_aggregator = fedata.FEData(run_name)
-
-    for x in range(iterations):
-        print(colored(f'================ GAME {x + 1} ================', 'green', 'on_grey'))
-        start = datetime.now()
-
-        # Environment resetting has a (small) probabilistic chance to fail; mainly just when generating maps.
-        # For example, if there are no valid corners.
-        # Or if the corner chosen only has a grass tile and water surrounding
-        # This is a bit of a hack, but given my limited timeframe its a quick fix
-        valid = False
-        blue_team = []
-        red_team = []
-        info = {}
-
-        while not valid:
-            try:
-                env.reset()
-                blue_team = unit_factory.generate_blue_team(env.map)
-                red_team = unit_factory.generate_red_team(env.map, blue_team)
-                valid = True
-            except:
-                pass
-
-        done = False
-        blue_team_names = []
-        for unit in blue_team:
-            blue_team_names.append(unit.name)
-
-        while not done:
-            print(colored('== BLUE PHASE ==', 'blue', 'on_white'))
-            for agent in blue_team:
-                state = env.obtain_state(agent, blue_team, red_team)
+def create_simulation(simulation_mode, run_name, hyperparameters=None, read_only=False, red_policy='random'):
+    """
+    Creates the environment and unit factory for a simulation mode
+
+    :param simulation_mode: One of scenarios (ie, 'mini' or 'big')
+    :param run_name: The name of the run; q-tables are named after it
+    :param hyperparameters: Optional dictionary of BlueUnit hyper-parameter overrides (ie, {'alpha': 0.2})
+    :param read_only: If True the q-tables are loaded but never updated or saved
+    :param red_policy: How the red team plays; see red_planner.RedPhasePlanner.policies
+    :return: env, unit_factory
+    """
+    if simulation_mode not in scenarios:
+        raise FESimulationTypeError(f'{simulation_mode} is not a simulation mode; expected one of {tuple(scenarios)}')
+
+    scenario = scenarios[simulation_mode]
+    env = environment.Environment(*scenario['dimensions'], red_policy, turn_limit=scenario['turn_limit'])
+    unit_factory = unit_populator.UnitFactory(*scenario['team_sizes'], run_name, hyperparameters=hyperparameters,
+                                              read_only=read_only)
+
+    return env, unit_factory
+
+
+def setup_episode(env, unit_factory):
+    """
+    Resets the environment and deploys new blue and red teams on it
+
+    :return: blue_team, red_team
+    """
+    # Environment resetting has a (small) probabilistic chance to fail; mainly just when generating maps.
+    # For example, if there are no valid corners.
+    # Or if the corner chosen only has a grass tile and water surrounding
+    # This is a bit of a hack, but given my limited timeframe its a quick fix
+    valid = False
+    blue_team = []
+    red_team = []
+
+    while not valid:
+        try:
+            env.reset()
+            blue_team = unit_factory.generate_blue_team(env.map)
+            red_team = unit_factory.generate_red_team(env.map, blue_team)
+            valid = True
+        except:
+            pass
+
+    return blue_team, red_team
+
+
+def play_episode(env, blue_team, red_team, q_store, learning=True, planner=None, fast_forward=False):
+    """
+    Plays a game until one team wins or the turn limit is reached
+
+    :param env: The environment, already reset
+    :param blue_team: The blue team
+    :param red_team: The red team
+    :param q_store: The QStore shared by the blue team
+    :param learning: If False the blue team only exploits what it knows: no state-action history is kept and the
+    q-tables are not updated
+    :param planner: Optional rollout.RolloutPlanner. If given, blue units act on its plans instead of their q-tables
+    (they still learn from them)
+    :param fast_forward: If True, the game ends as soon as no unit can attack a unit of the other team before the turn
+    limit (see Environment.is_stalemate), with the result the remaining turns would have given
+    :return: info -> dictionary with information about how the game ended (info['winner'], info['method'], and
+    info['turns_skipped'] if the game was fast forwarded)
+    """
+    done = False
+    info = {}
+
+    while not done:
+        if fast_forward and env.is_stalemate(blue_team, red_team):
+            info = env.fast_forward()
+            break
+
+        print(colored('== BLUE PHASE ==', 'blue', 'on_white'))
+        for agent in blue_team:
+            state = env.obtain_state(agent, blue_team, red_team)
+            target = None
+            if planner is not None:
+                action, move, target = planner.plan(env, agent, blue_team, red_team)
+            else:
                 action = agent.determine_action(state, env, blue_team, red_team)
                 move = agent.determine_move(action, blue_team, red_team, env)
 
+            if learning:
                 # Save the history of state-actions in case of unit death
-                agent.state_action_history.append(state + (action,))
+                agent.remember(state, action, env, blue_team, red_team)
 
-                next_state, reward, done, info = env.step(agent, move, action, blue_team, red_team)
+            next_state, reward, done, info = env.step(agent, move, action, blue_team, red_team, target)
 
+            if learning:
                 agent.update_qtable(state, next_state, reward, action)
 
-                if done:
-                    break
-
-                done = game_over_check(len(blue_team), len(red_team), info, env)
-
-                if done:
-                    break
-
             if done:
                 break
 
-            print(colored('== RED PHASE ==', 'red', 'on_white'))
-            _, done, info = env.execute_red_phase(blue_team, red_team)
+            done = game_over_check(len(blue_team), len(red_team), info, env)
 
             if done:
                 break
 
-            done = game_over_check(len(blue_team), len(red_team), info, env)
-
-        ranks = env.obtain_metrics()
-        print(colored('VICTORY RANK: ', 'yellow') + ranks[0])
-        print('\t' + info['method'])
-        print(colored('SURVIVAL RANK: ', 'yellow') + str(ranks[1]))
-        print(colored('TACTIC RANK: ', 'yellow') + str(ranks[2]))
-
-        data_aggregator.add_entry(x, ranks[0], ranks[1], ranks[2], blue_team_names)
-
-        # Save Q-Tables to disk after episode
-        for unit in blue_team:
-            unit.close()
-
-        end = datetime.now()
-        diff = end - start
-        seconds = diff.total_seconds()
-        print(colored(f"\nGame {x} took {seconds} seconds", 'yellow'))
-
+        # Apply any q-table updates still buffered from this phase
+        q_store.flush()
+
+        if done:
+            break
+
+        print(colored('== RED PHASE ==', 'red', 'on_white'))
+        _, done, info = env.execute_red_phase(blue_team, red_team)
+
+        if done:
+            break
+
+        done = game_over_check(len(blue_team), len(red_team), info, env)
+
+    return info
+
+
+def main(simulation_mode, run_name, iterations, early_stopping=None, resume=False, checkpoint_every=0,
+         hyperparameters=None, red_policy='random', planner=None, record_path=None, replay_capacity=0,
+         replay_batches=0, replay_batch_size=256, prefetch_size=0, fast_forward=False, memory_every=0,
+         trace_allocations=False):
+    """
+    Trains the blue team for a number of games
+
+    :param simulation_mode: One of scenarios (ie, 'mini' or 'big')
+    :param run_name: The name of the run; q-tables and the database are named after it
+    :param iterations: How many games to play at most
+    :param early_stopping: Optional dictionary of keyword arguments for convergence.ConvergenceMonitor. If given, the
+    run stops as soon as the monitor decides it has converged
+    :param resume: If True, continue the run from its last checkpoint. A run with no checkpoint starts over from
+    scratch: the games in its database are deleted and the q-tables on disk are not read
+    :param checkpoint_every: Take a checkpoint every this many games. 0 means no checkpoints
+    :param hyperparameters: Optional dictionary of BlueUnit hyper-parameter overrides (ie, {'alpha': 0.2})
+    :param red_policy: How the red team plays; see red_planner.RedPhasePlanner.policies
+    :param planner: Optional rollout.RolloutPlanner the blue team plans its moves with
+    :param record_path: Optional trajectory file every step of every game is appended to
+    :param replay_capacity: If more than 0, keep this many of each character's latest transitions in a replay buffer,
+    saved to 'data/<run_name>_replay.npz' with every checkpoint and at the end of the run
+    :param replay_batches: Batches of replayed experience to learn from after every game
+    :param replay_batch_size: Transitions per replayed batch
+    :param prefetch_size: If more than 0, episode setups are generated in a background process, up to this many ahead
+    :param fast_forward: If True, games in a stalemate skip straight to the turn limit; see play_episode. The skipped
+    turns are neither played nor learned from
+    :param memory_every: If more than 0, sample the memory of the run every this many games and print its trend at the
+    end; see memory.MemoryMonitor
+    :param trace_allocations: If True (and memory_every is more than 0), also trace where memory is allocated
+    """
+    env, unit_factory = create_simulation(simulation_mode, run_name, hyperparameters, red_policy=red_policy)
+    if record_path is not None:
+        env.recorder = trajectory.TrajectoryWriter(record_path)
+
+    # Establish SQLite database. Results are written to disk each time a checkpoint is taken
+    data_aggregator = fedata.FEData(run_name, resume, buffer_size=max(checkpoint_every, 1))
+
+    first_game = 0
+    monitor = None
+    prefetch_random_states = None
+    saved = None
+    if resume:
+        saved = checkpoint.load_checkpoint(run_name)
+        if saved is not None:
+            first_game = saved.episode
+            monitor = saved.restore(unit_factory.q_store)
+            # Checkpoints from before prefetch states were saved have none
+            prefetch_random_states = getattr(saved, 'prefetch_random_states', None)
+            # Games played after the checkpoint will be played again
+            data_aggregator.truncate(first_game)
+            print(colored(f'Resuming {run_name} from game {first_game + 1}', 'green'))
+        else:
+            # Games are numbered from 1 again, so any the run played before can't be kept; nor can the q-tables on
+            # disk that learned from them. Every q-table counts as loaded, so none of them is read, and the fresh ones
+            # replace them on disk
+            data_aggregator.truncate(0)
+            unit_factory.q_store.loaded[...] = True
+            unit_factory.q_store.save()
+            print(colored(f'{run_name} has no checkpoint; starting it over', 'yellow'))
+
+    trainer = None
+    if replay_capacity > 0:
+        replay_path = experience.replay_buffer_path(run_name)
+        if saved is not None and os.path.exists(replay_path):
+            replay_buffer = experience.ReplayBuffer.load(replay_path)
+        else:
+            replay_buffer = experience.ReplayBuffer(replay_capacity)
+        unit_factory.q_store.replay_buffer = replay_buffer
+        trainer = experience.OfflineTrainer(unit_factory.q_store, replay_buffer, seed=first_game)
+
+    if early_stopping is not None and monitor is None:
+        monitor = convergence.ConvergenceMonitor(unit_factory.q_store, turn_limit=env.turn_limit, **early_stopping)
+    elif early_stopping is None:
+        monitor = None
+
+    turns_skipped = 0
+    prefetcher = None
+    if prefetch_size > 0:
+        prefetcher = prefetch.EpisodePrefetcher(env, unit_factory, prefetch_size, seed=first_game,
+                                                random_states=prefetch_random_states)
+
+    memory_monitor = None
+    if memory_every > 0:
+        memory_monitor = memory.MemoryMonitor(memory_every, trace=trace_allocations)
+
+    # Games finished before a crash are still written, as they were when every game was committed on its own
+    try:
+        for x in range(first_game, iterations):
+            print(colored(f'================ GAME {x + 1} ================', 'green', 'on_grey'))
+            start = datetime.now()
+
+            if prefetcher is not None:
+                blue_team, red_team = prefetcher.next_episode(env, unit_factory)
+            else:
+                blue_team, red_team = setup_episode(env, unit_factory)
+            if env.recorder is not None:
+                env.recorder.begin_game(x, env, blue_team, red_team)
+
+            blue_team_names = []
+            for unit in blue_team:
+                blue_team_names.append(unit.name)
+
+            info = play_episode(env, blue_team, red_team, unit_factory.q_store, planner=planner,
+                                fast_forward=fast_forward)
+            turns_skipped += info.get('turns_skipped', 0)
+
+            ranks = env.obtain_metrics()
+            print(colored('VICTORY RANK: ', 'yellow') + ranks[0])
+            print('\t' + info['method'])
+            print(colored('SURVIVAL RANK: ', 'yellow') + str(ranks[1]))
+            print(colored('TACTIC RANK: ', 'yellow') + str(ranks[2]))
+
+            surviving_names = {unit.name for unit in blue_team}
+            dead_names = [name for name in blue_team_names if name not in surviving_names]
+            data_aggregator.add_entry(x, ranks[0], ranks[1], ranks[2], blue_team_names, dead_names)
+
+            if trainer is not None and replay_batches > 0:
+                unit_factory.q_store.flush()
+                trainer.train(replay_batches, replay_batch_size)
+
+            # Save Q-Tables to disk after episode
+            for unit in blue_team:
+                unit.close()
+
+            end = datetime.now()
+            diff = end - start
+            seconds = diff.total_seconds()
+            print(colored(f"\nGame {x} took {seconds} seconds", 'yellow'))
+
+            converged = monitor is not None and monitor.update(ranks)
+            if memory_monitor is not None:
+                memory_monitor.update(x)
+
+            if checkpoint_every > 0 and ((x + 1) % checkpoint_every == 0 or converged or x + 1 == iterations):
+                data_aggregator.flush()
+                if env.recorder is not None:
+                    env.recorder.flush()
+                if trainer is not None:
+                    trainer.buffer.save(experience.replay_buffer_path(run_name))
+                unit_factory.q_store.save()
+                checkpoint.save_checkpoint(run_name, x + 1, unit_factory.q_store, monitor,
+                                           prefetcher.random_states if prefetcher is not None else None)
+
+            if converged:
+                print(colored(f'Converged after {x + 1} games; stopping early', 'green'))
+                break
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+        data_aggregator.flush()
+
+    if env.recorder is not None:
+        env.recorder.close()
+    if trainer is not None:
+        trainer.buffer.save(experience.replay_buffer_path(run_name))
+
+    if monitor is not None:
+        monitor.write_checkpoints(f'data/{run_name}_convergence.csv')
+
+    if fast_forward:
+        print(colored(f'Skipped {turns_skipped} turns of stalemated games', 'yellow'))
+    if memory_monitor is not None:
+        print(colored('MEMORY', 'yellow'))
+        print(memory_monitor.report())
+        memory_monitor.close()
     print('Done!')
 
 
 if __name__ == "__main__":
     sys.stderr = sys.stdout
     logger = configure_logger()
-    if len(sys.argv) != 4:
-        raise FESimulationTypeError(f'Correct usage: python {sys.argv[0]} <mini or big> <run name> <iterations>')
 
-    mini_arg = sys.argv[1].strip().lower()      # mini or big
-    run_name_arg = sys.argv[2].strip().lower()  # run name (qtable and db file get the name)
-    iterations = int(sys.argv[3])               # how many iterations to do (usually 200,000 is a decent starting point)
+    parser = argparse.ArgumentParser(description='Train the Pyre Emblem agents')
+    parser.add_argument('mode', help=f'simulation mode: {", ".join(scenarios)}')
+    parser.add_argument('run_name', help='run name (qtable and db file get the name)')
+    parser.add_argument('iterations', type=int,
+                        help='how many iterations to do (usually 200,000 is a decent starting point)')
+    parser.add_argument('--early-stop', action='store_true', help='stop once the q-tables and win rate plateau')
+    parser.add_argument('--window', type=int, default=1000, help='games per convergence checkpoint')
+    parser.add_argument('--min-games', type=int, default=10000, help='never stop early before this many games')
+    parser.add_argument('--delta-tolerance', type=float, default=1e-3,
+                        help='largest mean q-table change per game that still counts as converged')
+    parser.add_argument('--win-rate-tolerance', type=float, default=0.01,
+                        help='largest change in win rate between checkpoints that still counts as converged')
+    parser.add_argument('--patience', type=int, default=3, help='stable checkpoints in a row needed to stop')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the run from its last checkpoint (a run with none starts over)')
+    parser.add_argument('--checkpoint-every', type=int, default=1000,
+                        help='games between checkpoints (0 turns checkpoints off)')
+    parser.add_argument('--red-policy', default='random', choices=red_planner.RedPhasePlanner.policies,
+                        help='how the red team plays')
+    parser.add_argument('--td-lambda', type=int, default=None,
+                        help='recent state-actions that share each TD error (1, the default, is one-step Q-learning)')
+    parser.add_argument('--trace-decay', type=float, default=None,
+                        help='λ; how much the credit of a TD error decays per step back when --td-lambda is above 1')
+    parser.add_argument('--rollouts', type=int, default=0,
+                        help='plan blue moves with this many Monte Carlo rollouts per candidate (0 turns planning off)')
+    parser.add_argument('--rollout-depth', type=int, default=1, help='red phases played in each rollout')
+    parser.add_argument('--rollout-budget', type=float, default=None, help='seconds each planned move may take')
+    parser.add_argument('--rollout-workers', type=int, default=0, help='processes to play rollouts in')
+    parser.add_argument('--record', default=None, help='append every step of every game to this trajectory file')
+    parser.add_argument('--replay-capacity', type=int, default=0,
+                        help='transitions per character kept for experience replay (0 turns replay off)')
+    parser.add_argument('--replay-batches', type=int, default=0, help='replayed batches learned from after every game')
+    parser.add_argument('--replay-batch-size', type=int, default=256, help='transitions per replayed batch')
+    parser.add_argument('--fast-forward', action='store_true',
+                        help='end games as soon as no unit can reach the other team before the turn limit')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='generate up to this many episode setups ahead in a background process (0 turns it off)')
+    parser.add_argument('--memory-every', type=int, default=0,
+                        help='sample memory use every this many games and report its trend (0 turns it off)')
+    parser.add_argument('--trace-allocations', action='store_true',
+                        help='with --memory-every, also report where memory is allocated (slower)')
+    args = parser.parse_args()
+
+    mini_arg = args.mode.strip().lower()             # simulation mode (mini, big, ...)
+    run_name_arg = args.run_name.strip().lower()     # run name (qtable and db file get the name)
+    iterations = args.iterations                     # how many iterations to do
+
+    if mini_arg not in scenarios:
+        raise FESimulationTypeError(f'Correct usage: python {sys.argv[0]} <{" or ".join(scenarios)}> <run name> '
+                                    f'<iterations>')
+
+    early_stopping_arg = None
+    if args.early_stop:
+        early_stopping_arg = {
+            'window': args.window,
+            'min_episodes': args.min_games,
+            'delta_tolerance': args.delta_tolerance,
+            'win_rate_tolerance': args.win_rate_tolerance,
+            'patience': args.patience
+        }
+
+    hyperparameters_arg = {name: getattr(args, name) for name in ('td_lambda', 'trace_decay')
+                           if getattr(args, name) is not None}
+
+    planner_arg = None
+    if args.rollouts > 0:
+        planner_arg = rollout.RolloutPlanner(args.rollouts, args.rollout_depth, args.rollout_budget,
+                                             args.rollout_workers)
 
     simu_start = datetime.now()
     try:
-        main(mini_arg, run_name_arg, iterations)
+        main(mini_arg, run_name_arg, iterations, early_stopping_arg, args.resume, args.checkpoint_every,
+             hyperparameters=hyperparameters_arg, red_policy=args.red_policy, planner=planner_arg,
+             record_path=args.record, replay_capacity=args.replay_capacity, replay_batches=args.replay_batches,
+             replay_batch_size=args.replay_batch_size, prefetch_size=args.prefetch,
+             fast_forward=args.fast_forward, memory_every=args.memory_every,
+             trace_allocations=args.trace_allocations)
     except Exception as e:
         logger.exception(e)
+    finally:
+        if planner_arg is not None:
+            planner_arg.close()
 
     simu_end = datetime.now()
     simu_diff = simu_end - simu_start
@@ -1,7 +1,7 @@
 import random
 import numpy as np
 import feutils
-import math
+import kernels
 
 
 class Tile:
@@ -12,7 +12,6 @@ class Tile:
         self.defense = tile_data['def']
         del tile_data['avoid']
         del tile_data['def']
-        self.min_cost = math.inf
 
         self.movement_costs = tile_data
 
@@ -23,14 +22,43 @@ class Tile:
         return self.name
 
 
+# Tiles never change once made, so every map shares one Tile per terrain
+_tiles = {}
+
+
+def terrain_tile(tile_name):
+    """
+    :return: the shared Tile of a terrain
+    """
+    if tile_name not in _tiles:
+        _tiles[tile_name] = Tile(tile_name)
+    return _tiles[tile_name]
+
+
 class Map:
     def __init__(self, x_tiles, y_tiles, matrix_tile_names):
         self.x, self.y = x_tiles, y_tiles
         self.grid = [[0 for i in range(y_tiles)] for j in range(x_tiles)]
 
+        # Every tile of the same terrain has the same data, so cost grids are built per terrain kind
+        kinds = {}
+        self.kind_tiles = []
+        self.tile_kinds = np.zeros((x_tiles, y_tiles), dtype=np.int64)
         for i in range(x_tiles):
             for j in range(y_tiles):
-                self.grid[i][j] = Tile(matrix_tile_names[i, j])
+                tile = terrain_tile(str(matrix_tile_names[i, j]))
+                if tile.name not in kinds:
+                    kinds[tile.name] = len(kinds)
+                    self.kind_tiles.append(tile)
+                self.grid[i][j] = tile
+                self.tile_kinds[i, j] = kinds[tile.name]
+
+        # terrain group -> int array of the movement cost of every tile, built the first time it is needed
+        self.cost_grids = {}
+        # terrain group -> int array labelling the regions of tiles the group can move between; see precompute_terrain
+        self.regions = {}
+        # (terrain group, x, y) -> uint8 terrain only distance field from tile x, y; see get_distance_field
+        self.distance_fields = {}
 
     def __str__(self):
         result = ''
@@ -40,11 +68,79 @@ class Map:
             result += '\n'
         return result
 
-    def reset_visited(self):
-        for i in range(self.x):
-            for j in range(self.y):
-                tile = self.get_tile(i, j)
-                tile.min_cost = math.inf
+    def get_cost_grid(self, terrain_group):
+        """
+        :return: an int array with the shape of the map holding the cost for terrain_group to enter each tile
+        """
+        if terrain_group not in self.cost_grids:
+            kind_costs = np.array([tile.get_unit_cost(terrain_group) for tile in self.kind_tiles], dtype=np.int64)
+            self.cost_grids[terrain_group] = kind_costs[self.tile_kinds]
+
+        return self.cost_grids[terrain_group]
+
+    def precompute_terrain(self, terrain_groups=feutils._valid_move_types):
+        """
+        Builds the cost grid and the regions of every terrain group. The terrain never changes during a game, so this
+        is done once per map (by Environment.reset)
+        """
+        for terrain_group in terrain_groups:
+            self.get_regions(terrain_group)
+
+    def get_regions(self, terrain_group):
+        """
+        Labels the regions of the map a terrain group can move within: two tiles have the same label if and only if
+        a unit of the group could walk from one to the other, ignoring other units. Impassable tiles are labelled -1.
+
+        :return: an int32 array with the shape of the map
+        """
+        if terrain_group not in self.regions:
+            self.regions[terrain_group] = kernels.region_labels(self.get_cost_grid(terrain_group) < 999)
+
+        return self.regions[terrain_group]
+
+    def can_ever_reach(self, terrain_group, x1, y1, x2, y2):
+        """
+        Could a unit of terrain_group standing at x1, y1 ever walk to x2, y2, over any number of turns and ignoring
+        other units?
+        """
+        regions = self.get_regions(terrain_group)
+        return regions[x1, y1] != -1 and regions[x1, y1] == regions[x2, y2]
+
+    def get_distance_field(self, terrain_group, x, y):
+        """
+        The terrain only movement cost for a unit of terrain_group to go from x, y to every tile, computed the first
+        time it is needed and kept for the rest of the game. Other units are ignored.
+
+        :return: a uint8 array with the shape of the map; kernels.UNREACHABLE marks tiles it can never get to (or only
+        at a cost over kernels.MAX_DISTANCE)
+        """
+        key = terrain_group, x, y
+        if key not in self.distance_fields:
+            self.distance_fields[key] = kernels.distance_field(self.get_cost_grid(terrain_group),
+                                                               np.array([[x, y]], dtype=np.int64))
+        return self.distance_fields[key]
+
+    def get_terrain_distance_to_closest(self, terrain_group, x, y, units):
+        """
+        The terrain only movement cost for a unit of terrain_group to go from x, y to the tile of the closest of units
+
+        :return: the cost, or kernels.UNREACHABLE if none of units can be reached
+        """
+        costs = self.get_cost_grid(terrain_group)
+        closest = kernels.UNREACHABLE
+        for u in units:
+            # The field from the unit counts the cost of entering x, y rather than the unit's tile
+            cost = int(self.get_distance_field(terrain_group, u.x, u.y)[x, y])
+            if cost != kernels.UNREACHABLE:
+                closest = min(closest, cost - int(costs[x, y]) + int(costs[u.x, u.y]))
+        return closest
+
+    def get_attack_tile_mask(self, unit, target_units):
+        """
+        :return: a boolean array with the shape of the map; True where unit could stand to attack any of target_units
+        """
+        targets = np.array([(u.x, u.y) for u in target_units], dtype=np.int64).reshape(-1, 2)
+        return kernels.attack_tile_mask(self.x, self.y, targets, kernels.range_bits(unit.get_attack_range()))
 
     def get_tile(self, x, y) -> Tile:
         return self.grid[x][y]
@@ -81,11 +177,10 @@ class Map:
         if unit.has_consumable():
             valid_actions[1] = False
 
-        for x, y in all_move_coordinates:
-            attackable_units = feutils.get_attackable_units(unit, enemy_units, x, y)
-            if len(attackable_units) != 0:
+        if len(all_move_coordinates) > 0:
+            xs, ys = zip(*all_move_coordinates)
+            if np.any(self.get_attack_tile_mask(unit, enemy_units)[list(xs), list(ys)]):
                 valid_actions[2] = False
-                break
 
         return valid_actions
 
@@ -99,18 +194,7 @@ class Map:
         :param unit: The unit who we are checking
         :return: A set of tuples that represent x y pairs
         """
-        self.reset_visited()
-        movement = unit.move
-        terrain_group = unit.terrain_group
-
-        # The tile the unit is standing on is always assumed to be a valid move tile.
-        valid_tiles = set()
-        valid_tiles.add((unit.x, unit.y))
-
-        self.__calculate_tile__(unit.x + 1, unit.y, movement, terrain_group, 0, valid_tiles, enemy_units)
-        self.__calculate_tile__(unit.x - 1, unit.y, movement, terrain_group, 0, valid_tiles, enemy_units)
-        self.__calculate_tile__(unit.x, unit.y + 1, movement, terrain_group, 0, valid_tiles, enemy_units)
-        self.__calculate_tile__(unit.x, unit.y - 1, movement, terrain_group, 0, valid_tiles, enemy_units)
+        valid_tiles = self.get_reachable_coordinates(unit, enemy_units)
 
         for u in ally_units + enemy_units:
             if u is not unit:
@@ -120,56 +204,42 @@ class Map:
 
         return list(valid_tiles)
 
-    def __calculate_tile__(self, x, y, movement, terrain_group, accumulated_cost, valid_tiles, enemy_units):
-        if x < 0 or x >= self.x:
-            return
-
-        if y < 0 or y >= self.y:
-            return
+    def get_reachable_coordinates(self, unit, enemy_units):
+        """
+        Retrieves all the tiles the unit could pass through given their current position, movement stat, and movement
+        class. Enemy units block movement, but tiles occupied by other units are NOT removed, so not every tile in the
+        set is a valid move tile.
 
-        current_tile = self.get_tile(x, y)
-        accumulated_cost += current_tile.get_unit_cost(terrain_group)
+        :param unit: The unit who we are checking
+        :param enemy_units: list of Units that the unit is fighting (opposite team)
+        :return: A set of tuples that represent x y pairs
+        """
+        field = self.get_distance_field(unit.terrain_group, unit.x, unit.y)
+        in_reach = [enemy for enemy in enemy_units
+                    if field[enemy.x, enemy.y] <= unit.move and (enemy.x, enemy.y) != (unit.x, unit.y)]
 
-        if accumulated_cost > current_tile.min_cost:
-            return
+        if len(in_reach) == 0:
+            # No enemy is close enough to block any path, so the terrain alone decides
+            reachable = field <= unit.move
         else:
-            current_tile.min_cost = accumulated_cost
-
-        if accumulated_cost > movement:
-            return
-
-        for enemy in enemy_units:
-            if (enemy.x, enemy.y) == (x, y):
-                return
+            blocked = np.zeros((self.x, self.y), dtype=bool)
+            for enemy in in_reach:
+                blocked[enemy.x, enemy.y] = True
+            reachable = kernels.reachable_mask(self.get_cost_grid(unit.terrain_group), unit.x, unit.y, unit.move,
+                                               blocked)
 
-        valid_tiles.add((x, y))
-
-        self.__calculate_tile__(x + 1, y, movement, terrain_group, accumulated_cost, valid_tiles, enemy_units)
-        self.__calculate_tile__(x - 1, y, movement, terrain_group, accumulated_cost, valid_tiles, enemy_units)
-        self.__calculate_tile__(x, y + 1, movement, terrain_group, accumulated_cost, valid_tiles, enemy_units)
-        self.__calculate_tile__(x, y - 1, movement, terrain_group, accumulated_cost, valid_tiles, enemy_units)
+        xs, ys = np.nonzero(reachable)
+        return set(zip(xs.tolist(), ys.tolist()))
 
     def set_red_unit_start_coordinates(self, red_unit, red_team, blue_team):
-        candidate_coordinates = []
-        terrain_group = red_unit.terrain_group
-        for i in range(self.x):
-            for j in range(self.y):
-                terrain_cost = self.grid[i][j].get_unit_cost(terrain_group)
-                if terrain_cost != 999:
-                    candidate_coordinates.append((i, j))
-
-        for unit in red_team:
-            coords = (unit.x, unit.y)
-            if coords in candidate_coordinates:
-                candidate_coordinates.remove(coords)
-
-        for unit in blue_team:
-            coords = (unit.x, unit.y)
-            if coords in candidate_coordinates:
-                candidate_coordinates.remove(coords)
+        # Every tile the unit can stand on that no unit is at, in row order
+        candidates = self.get_cost_grid(red_unit.terrain_group) != 999
+        for unit in red_team + blue_team:
+            candidates[unit.x, unit.y] = False
+        candidate_coordinates = np.argwhere(candidates)
 
         chosen_coord = random.choice(candidate_coordinates)
-        red_unit.goto(chosen_coord[0], chosen_coord[1])
+        red_unit.goto(int(chosen_coord[0]), int(chosen_coord[1]))
 
     def get_valid_corners(self):
         all_corners = [
@@ -189,38 +259,41 @@ class Map:
         return valid_corners
 
     def __get_N_closest_tiles(self, starting_point, n):
-        closest = set()
-        x, y = starting_point
-
-        self.__recurse_on_tiles(x + 1, y, closest, n, 0)
-        self.__recurse_on_tiles(x - 1, y, closest, n, 0)
-        self.__recurse_on_tiles(x, y + 1, closest, n, 0)
-        self.__recurse_on_tiles(x, y - 1, closest, n, 0)
+        """
+        Every tile a foot unit can stand on at most n steps away from starting_point, walking only on such tiles
 
-        return list(closest)
+        The tiles are found depth first, trying the steps in the order x + 1, x - 1, y + 1, y - 1 (so their order in
+        the list is the same from one run to another). A tile reached again with no more steps left than a finished
+        earlier visit had is not walked from again: every tile past it was already found.
+        """
+        closest = set()
+        # Most steps left of a finished visit of each tile
+        finished = {}
 
-    def __recurse_on_tiles(self, x, y, closest_tiles, n, length):
-        if x < 0 or x >= self.x:
-            return
+        # Depth first search with an explicit stack; a tile is pushed again once its neighbours are done, to finish it
+        stack = [(x, y, n - 1, False) for x, y in self.__neighbours(*starting_point)[::-1]]
+        while len(stack) > 0:
+            x, y, steps_left, done = stack.pop()
+            if done:
+                finished[(x, y)] = max(finished.get((x, y), -1), steps_left)
+                continue
 
-        if y < 0 or y >= self.y:
-            return
+            if not (0 <= x < self.x and 0 <= y < self.y) or steps_left < 0 or finished.get((x, y), -1) >= steps_left:
+                continue
 
-        if length >= n:
-            return
+            # Limit valid starting coordinates to standable tiles for any unit, aka foot units
+            if self.grid[x][y].get_unit_cost("Foot") == 999:
+                continue
 
-        # Limit valid starting coordinates to standable tiles for any unit, aka foot units
-        cost = self.grid[x][y].get_unit_cost("Foot")
-        if cost == 999:
-            return
+            closest.add((x, y))
+            stack.append((x, y, steps_left, True))
+            stack += [(i, j, steps_left - 1, False) for i, j in self.__neighbours(x, y)[::-1]]
 
-        closest_tiles.add((x, y))
-        length += 1
+        return list(closest)
 
-        self.__recurse_on_tiles(x + 1, y, closest_tiles, n, length)
-        self.__recurse_on_tiles(x - 1, y, closest_tiles, n, length)
-        self.__recurse_on_tiles(x, y + 1, closest_tiles, n, length)
-        self.__recurse_on_tiles(x, y - 1, closest_tiles, n, length)
+    @staticmethod
+    def __neighbours(x, y):
+        return [(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)]
 
     def set_all_blue_start_coordinates(self, terminal_unit, blue_team):
         starting_point = random.choice(self.get_valid_corners())
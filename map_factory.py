@@ -1,7 +1,5 @@
 import random
 import numpy as np
-from matplotlib import pyplot, colors
-import copy
 from map import Map
 
 
@@ -48,44 +46,33 @@ class MapLayerFactory:
         :param x:
         :param y:
         """
-        for i in range(x):
-            for j in range(y):
-                grid[i, j] = bool(random.getrandbits(1))
+        # One random bit per cell, drawn row by row
+        grid[:, :] = np.array([random.getrandbits(1) for _ in range(x * y)], dtype=bool).reshape(x, y)
 
     def advance_generation(self, grid):
         """
         Advances the grid one generation according to the game of life algorithm
         :param grid: the matrix to advance
         """
-        grid_clone = copy.deepcopy(grid)
-
-        for i in range(len(grid_clone)):
-            for j in range(len(grid_clone[0])):
-                neighbors = self.count_alive_neighbors(grid_clone, i, j)
-                # Birth
-                if not grid_clone[i, j]:
-                    if self.birth_low <= neighbors <= self.birth_high:
-                        grid[i, j] = True
-                # Death
-                else:
-                    if neighbors < self.live_low or neighbors > self.live_high:
-                        grid[i, j] = False
-
-    def count_alive_neighbors(self, grid, x, y):
+        alive = grid != 0
+        neighbors = self.count_alive_neighbors(alive)
+
+        # Birth
+        grid[~alive & (self.birth_low <= neighbors) & (neighbors <= self.birth_high)] = True
+        # Death
+        grid[alive & ((neighbors < self.live_low) | (neighbors > self.live_high))] = False
+
+    def count_alive_neighbors(self, alive):
         """
-        Counts the alive neighbors (including self) at indices x and y
-        :param grid: The grid where x and y lives
-        :param x:
-        :param y:
-        :return: the count of alive neighbors
+        Counts the alive neighbors (including self) of every cell: the cell, and the cells before it on either axis
+        and on both
+        :param alive: A matrix of booleans
+        :return: a matrix of the counts of alive neighbors
         """
-        neighbors = 0
-        for i in range(-1, 1):
-            for j in range(-1, 1):
-                if i + x >= 0 and j + y >= 0:
-                    if grid[i + x, j + y]:
-                        neighbors += 1
-
+        neighbors = alive.astype(np.int64)
+        neighbors[1:, :] += alive[:-1, :]
+        neighbors[:, 1:] += alive[:, :-1]
+        neighbors[1:, 1:] += alive[:-1, :-1]
         return neighbors
 
 
@@ -115,26 +102,18 @@ class OutdoorMapFactory:
             forest_grid = self.forest_factory.generate_binary_map(x, y)
             mountain_grid = self.mountain_factory.generate_binary_map(x, y)
 
-            final_map = np.ndarray((x, y), dtype='<U8')
-            number_map = np.ndarray((x, y))
-
-            for i in range(x):
-                for j in range(y):
-                    # Alive represents lake, dead represents plains
-                    if grass_water_grid[i, j]:
-                        final_map[i, j] = 'Lake'
-                        number_map[i, j] = 1
-                    else:
-                        final_map[i, j] = 'Plain'
-                        number_map[i, j] = 0
+            # Alive represents lake, dead represents plains
+            lake = grass_water_grid != 0
+            forest = ~lake & (forest_grid != 0)
+            mountain = ~lake & (mountain_grid != 0)
 
-                    if final_map[i, j] == 'Plain' and forest_grid[i, j]:
-                        final_map[i, j] = 'Forest'
-                        number_map[i, j] = 2
+            final_map = np.where(lake, 'Lake', 'Plain').astype('<U8')
+            final_map[forest] = 'Forest'
+            final_map[mountain] = 'Mountain'
 
-                    if final_map[i, j] != 'Lake' and mountain_grid[i, j]:
-                        final_map[i, j] = 'Mountain'
-                        number_map[i, j] = 3
+            number_map = lake.astype(float)
+            number_map[forest] = 2
+            number_map[mountain] = 3
 
             candidate_map = Map(x, y, final_map)
             corners = candidate_map.get_valid_corners()
@@ -145,6 +124,8 @@ class OutdoorMapFactory:
 
 
 if __name__ == '__main__':
+    from matplotlib import pyplot, colors
+
     factory = OutdoorMapFactory(7, 12, 7, 12)
     fe_map, number_map = factory.generate_map()
     print(fe_map)
@@ -0,0 +1,135 @@
+import os
+import tracemalloc
+
+import numpy as np
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def rss_bytes():
+    """
+    :return: The resident set size of this process in bytes, or None if it can't be read on this platform
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def format_bytes(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            return f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}GiB'
+
+
+class MemoryMonitor:
+    """
+    Samples the memory of a run every `every` episodes: the RSS, and with trace=True the memory allocated by Python
+    (tracemalloc) and a snapshot of where it was allocated.
+
+    The samples are kept in a preallocated array of `capacity` rows. Once it is full every other sample is dropped and
+    the sampling interval doubles, so the trend of a run of any length fits in the same memory.
+    """
+    def __init__(self, every=1000, capacity=512, trace=False, top=10):
+        """
+        :param every: Episodes between samples
+        :param capacity: How many samples to keep at most (an even number)
+        :param trace: If True, trace Python allocations with tracemalloc. Tracing slows a run down noticeably
+        :param top: How many allocation sites the report lists
+        """
+        self.every = every
+        self.samples = np.zeros((capacity, 3), dtype=np.int64)     # episode, rss, traced bytes
+        self.size = 0
+        self.trace = trace
+        self.top = top
+
+        # The snapshot of the first sample; the report compares the latest snapshot to it
+        self.first_snapshot = None
+        self.top_allocations = []
+
+        self.started_tracing = trace and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+
+    def update(self, episode):
+        """
+        Call after every episode
+
+        :param episode: The number of the episode that just ended, counting from 0
+        """
+        if (episode + 1) % self.every == 0:
+            self.sample(episode + 1)
+
+    def sample(self, episode):
+        if self.size == len(self.samples):
+            self.samples[:self.size // 2] = self.samples[1:self.size:2]
+            self.size //= 2
+            self.every *= 2
+
+        rss = rss_bytes()
+        traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else -1
+        self.samples[self.size] = episode, rss if rss is not None else -1, traced
+        self.size += 1
+
+        if self.trace:
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')
+            ))
+            if self.first_snapshot is None:
+                self.first_snapshot = snapshot
+            else:
+                self.top_allocations = snapshot.compare_to(self.first_snapshot, 'lineno')[:self.top]
+
+    def trend(self):
+        """
+        :return: An array with a row (episode, rss, traced bytes) per sample, oldest first. Unknown values are -1
+        """
+        return self.samples[:self.size].copy()
+
+    def growth_per_episode(self, column=1):
+        """
+        :param column: 1 for the RSS, 2 for the memory traced by tracemalloc
+        :return: The slope of a least squares line through the samples, in bytes per episode; None if there are fewer
+        than 2 samples
+        """
+        samples = self.samples[:self.size]
+        samples = samples[samples[:, column] >= 0]
+        if len(samples) < 2:
+            return None
+        return float(np.polyfit(samples[:, 0], samples[:, column], 1)[0])
+
+    def report(self):
+        """
+        :return: The RSS trend of the run and, if tracing, the allocation sites that grew the most, as text
+        """
+        samples = self.samples[:self.size]
+        rss = samples[samples[:, 1] >= 0]
+        if len(rss) == 0:
+            return 'No memory samples'
+
+        lines = [f'RSS {format_bytes(rss[0, 1])} after game {rss[0, 0]}, {format_bytes(rss[-1, 1])} after game '
+                 f'{rss[-1, 0]}, peak {format_bytes(np.max(rss[:, 1]))}']
+        for column, name in ((1, 'RSS'), (2, 'Traced memory')):
+            growth = self.growth_per_episode(column)
+            if growth is not None:
+                lines.append(f'{name} growth: {format_bytes(growth * 1000)} per 1000 games')
+
+        if len(self.top_allocations) > 0:
+            lines.append(f'Top allocation growth since game {samples[0, 0]}:')
+            lines += [f'  {stat}' for stat in self.top_allocations]
+
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
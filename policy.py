@@ -0,0 +1,95 @@
+import numpy as np
+
+
+# Every possible action mask over the 3 action space (Wait, Item, Attack), keyed by its bit pattern.
+# Bit i is set when action i is masked (cannot be taken), matching the masks built by Map.get_all_valid_actions
+_action_count = 3
+_legal_action_table = tuple(
+    np.array([a for a in range(_action_count) if not (bits >> a) & 1], dtype=np.intp)
+    for bits in range(2 ** _action_count)
+)
+_mask_weights = 1 << np.arange(_action_count)
+
+
+def mask_to_key(action_mask):
+    """
+    Converts an action mask into the integer key used to look up its precomputed legal actions
+
+    :param action_mask: boolean array of size 3. True means the action is masked (cannot be taken)
+    :return: an int in the range [0, 8)
+    """
+    return int(np.dot(action_mask, _mask_weights))
+
+
+def legal_actions(action_mask):
+    """
+    Gets the precomputed array of legal action indexes for the given action mask.
+    The returned array is shared; do not modify it.
+
+    :param action_mask: boolean array of size 3. True means the action is masked (cannot be taken)
+    :return: a numpy array of the actions that can be taken, in ascending order
+    """
+    return _legal_action_table[mask_to_key(action_mask)]
+
+
+def random_legal_action(action_mask):
+    """
+    Samples an action uniformly from the legal actions of the mask.
+    Equivalent to feutils.get_random_unmasked_action, without rejection sampling.
+
+    :param action_mask: boolean array of size 3. True means the action is masked (cannot be taken)
+    :return: 0, 1, or 2
+    """
+    legal = legal_actions(action_mask)
+    return int(legal[np.random.randint(legal.size)])
+
+
+def greedy_action(q_values, action_mask):
+    """
+    Picks the action with the highest q-value among the legal actions. Ties go to the lowest action index,
+    the same as np.argmax over a numpy masked array.
+
+    :param q_values: q-values of the state, array of size 3
+    :param action_mask: boolean array of size 3. True means the action is masked (cannot be taken)
+    :return: 0, 1, or 2
+    """
+    return int(np.argmax(np.where(action_mask, -np.inf, q_values)))
+
+
+def select_action(q_values, action_mask, epsilon):
+    """
+    Epsilon-greedy action selection over the legal actions of a single state
+
+    :param q_values: q-values of the state, array of size 3
+    :param action_mask: boolean array of size 3. True means the action is masked (cannot be taken)
+    :param epsilon: exploration rate
+    :return: a tuple (action, explored). explored is True if the action was picked at random
+    """
+    if np.random.uniform(0, 1) < epsilon:
+        return random_legal_action(action_mask), True
+
+    return greedy_action(q_values, action_mask), False
+
+
+def batch_select_actions(q_values, action_masks, epsilon):
+    """
+    Epsilon-greedy action selection for many agents at once (every agent in a phase, or agents across
+    several vectorized games).
+
+    Exploring rows sample uniformly among their legal actions by taking the argmax of random keys
+    over the legal entries.
+
+    :param q_values: array of shape (n, 3); the q-values of each agent's current state
+    :param action_masks: boolean array of shape (n, 3). True means the action is masked (cannot be taken)
+    :param epsilon: exploration rate, either a float or an array of shape (n,)
+    :return: a tuple (actions, explored) of arrays of shape (n,)
+    """
+    q_values = np.asarray(q_values, dtype=float)
+    action_masks = np.asarray(action_masks, dtype=bool)
+    n = q_values.shape[0]
+
+    explored = np.random.uniform(0, 1, n) < epsilon
+    scores = np.where(explored[:, np.newaxis], np.random.uniform(0, 1, q_values.shape), q_values)
+    scores[action_masks] = -np.inf
+
+    return np.argmax(scores, axis=1), explored
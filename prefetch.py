@@ -0,0 +1,125 @@
+import contextlib
+import multiprocessing
+import os
+import queue
+import random
+
+import numpy as np
+
+
+class EpisodeSetup:
+    """
+    Everything needed to start an episode without generating it: the map, where each blue character starts,
+    and the red team (red units never touch the q-store, so they are sent whole). It also carries the state of the
+    prefetch process' random number generators once it was made, which the next setup is made from; a checkpoint
+    saves it so that a resumed run goes on with the same setups.
+    """
+    def __init__(self, tile_map, number_map, blue_positions, red_team, random_states):
+        self.map = tile_map
+        self.number_map = number_map
+        self.blue_positions = blue_positions    # list of (roster name, x, y), in blue team order
+        self.red_team = red_team
+        self.random_states = random_states      # (random.getstate(), np.random.get_state())
+
+
+def produce_setups(setups, stop, dimensions, team_sizes, run_name, seed, random_states=None):
+    """
+    Generates episode setups forever and puts them in the setups queue, blocking while it is full.
+    Runs in the prefetch process, with its own environment and a read only unit factory.
+
+    :param setups: a bounded multiprocessing Queue
+    :param stop: a multiprocessing Event; the producer returns once it is set
+    :param dimensions: (x_min, x_max, y_min, y_max) of the maps
+    :param team_sizes: (blue_low, blue_high, red_low, red_high)
+    :param run_name: The name of the run
+    :param seed: Seed of the producer's random number generators
+    :param random_states: Optional (python, numpy) random states to start from instead of seed; see
+    EpisodeSetup.random_states
+    """
+    import environment
+    import main
+    import unit_populator
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        env = environment.Environment(*dimensions)
+        # Setups wait in the queue while the next ones are made, so their units must not be reused
+        unit_factory = unit_populator.UnitFactory(*team_sizes, run_name, read_only=True, pool_units=False)
+
+        # Seeded only now, so that the saved states of a setup are exactly what the next one is made from
+        if random_states is not None:
+            random.setstate(random_states[0])
+            np.random.set_state(random_states[1])
+        else:
+            random.seed(seed)
+            np.random.seed(seed)
+
+        while not stop.is_set():
+            blue_team, red_team = main.setup_episode(env, unit_factory)
+            setup = EpisodeSetup(env.map, env.number_map, [(u.roster_name, u.x, u.y) for u in blue_team], red_team,
+                                 (random.getstate(), np.random.get_state()))
+
+            while not stop.is_set():
+                try:
+                    setups.put(setup, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+
+class EpisodePrefetcher:
+    """
+    Builds the setups of the next episodes (map generation and team deployment, including the retries when a
+    generated map is unusable) in a background process, while the current episode is being played. Finished setups
+    are handed over through a queue of at most `size` setups.
+
+    The prefetch process has its own random number generators, seeded with `seed`, so a run with prefetching is
+    reproducible but does not play the same games as a run without it. random_states is the state they were in after
+    making the last setup handed over; pass it back in to go on with the same setups (ie, when resuming a run).
+    """
+    def __init__(self, env, unit_factory, size=4, seed=0, random_states=None):
+        self.size = size
+        self.random_states = random_states
+        context = multiprocessing.get_context()
+        self.setups = context.Queue(maxsize=size)
+        self.stop = context.Event()
+
+        factory = env.map_factory
+        dimensions = factory.x_min, factory.x_max, factory.y_min, factory.y_max
+        team_sizes = unit_factory.blue_low, unit_factory.blue_high, unit_factory.red_low, unit_factory.red_high
+        self.process = context.Process(target=produce_setups, daemon=True,
+                                       args=(self.setups, self.stop, dimensions, team_sizes, unit_factory.run_name,
+                                             seed, random_states))
+        self.process.start()
+
+    def next_episode(self, env, unit_factory):
+        """
+        Resets the environment onto the next prefetched setup, waiting for one if none is ready
+
+        :return: blue_team, red_team
+        """
+        setup = self.setups.get()
+        self.random_states = setup.random_states
+        env.reset((setup.map, setup.number_map))
+
+        blue_team = []
+        for roster_name, x, y in setup.blue_positions:
+            unit = unit_factory.get_character(roster_name)
+            unit.goto(x, y)
+            blue_team.append(unit)
+
+        return blue_team, setup.red_team
+
+    def close(self):
+        """
+        Stops the prefetch process and drops the setups it had ready. They are read until the process has exited,
+        since it only exits once the setups it put in the queue are all written to the pipe (one left half written
+        would block the next read forever).
+        """
+        self.stop.set()
+        while self.process.is_alive():
+            try:
+                self.setups.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.process.join()
+        self.setups.close()
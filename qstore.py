@@ -0,0 +1,246 @@
+import os
+import numpy as np
+import feutils
+
+
+class QStore:
+    """
+    A single contiguous Q-tensor shared by every playable character, laid out as (n_characters, 10, 10, 3) and
+    indexed by the character ids in feutils.
+
+    Transitions are buffered and applied together in one vectorized update when the buffer fills up, or when
+    flush() is called (for example at the end of a phase or episode). With a batch size of 1 every transition is
+    applied immediately, which is exactly the sequential greedy-Q update that each BlueUnit used to do on its own
+    q-table.
+
+    A transition can also carry a trace: the state-actions that came before it in the episode. Its TD error is then
+    credited to each of them too, decayed by γλ per step back (a truncated Q(λ) with accumulating traces; BlueUnit
+    cuts its traces at exploratory actions, as in Watkins's Q(λ)). This lets rewards for deaths and kills propagate
+    back through an episode instead of one step at a time.
+
+    Each character's table is still saved to and loaded from its own file in 'qtables/', so existing q-tables keep
+    working.
+    """
+    def __init__(self, run_name, alpha=0.1, gamma=0.6, version="5", batch_size=1, directory='qtables',
+                 read_only=False):
+        self.run_name = run_name
+        self.alpha = alpha
+        self.gamma = gamma
+        self.version = version
+        self.directory = directory
+
+        # A read only store loads q-tables but ignores transitions and never writes to disk (ie, when evaluating)
+        self.read_only = read_only
+
+        self.state_space = np.array([10, 10])
+        self.action_space = np.array([3])
+
+        n_characters = len(feutils.playable_characters())
+        self.q = np.zeros(np.concatenate(([n_characters], self.state_space, self.action_space)))
+        self.loaded = np.zeros(n_characters, dtype=bool)
+
+        self.batch_size = batch_size
+        self.allocate_buffer()
+
+        # Optional experience.ReplayBuffer that keeps a copy of every recorded transition
+        self.replay_buffer = None
+
+    _buffer_attributes = ('_characters', '_states', '_actions', '_rewards', '_next_states', '_terminals',
+                          '_trace_rows', '_trace_state_actions', '_trace_weights')
+
+    def allocate_buffer(self):
+        """
+        Makes an empty transition buffer of batch_size rows
+        """
+        # Buffered transitions; one row per transition
+        self.pending = 0
+        self._characters = np.zeros(self.batch_size, dtype=np.intp)
+        self._states = np.zeros((self.batch_size, 2), dtype=np.intp)
+        self._actions = np.zeros(self.batch_size, dtype=np.intp)
+        self._rewards = np.zeros(self.batch_size)
+        self._next_states = np.zeros((self.batch_size, 2), dtype=np.intp)
+        self._terminals = np.zeros(self.batch_size, dtype=bool)
+
+        # Earlier state-actions credited by buffered transitions: their transition row, (E, N, action) and weight
+        self._trace_rows = []
+        self._trace_state_actions = []
+        self._trace_weights = []
+
+    def __getstate__(self):
+        # A pickled store is a copy to read q-values from (ie, in a rollout worker), so the replay buffer and the
+        # buffered transitions are left behind; the copy starts with an empty buffer
+        state = self.__dict__.copy()
+        state['replay_buffer'] = None
+        for attribute in self._buffer_attributes:
+            del state[attribute]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.allocate_buffer()
+
+    def table_name(self, name):
+        return f'{name}_qtable_v{self.version}_{self.run_name}_{self.alpha}-{self.gamma}.npy'
+
+    def saved_characters(self):
+        """
+        :return: The playable characters that have a q-table of this run on disk
+        """
+        return [name for name in feutils.playable_characters()
+                if os.path.exists(os.path.join(self.directory, self.table_name(name)))]
+
+    def table(self, name):
+        """
+        Gets the q-table of a character, loading it from disk the first time it is asked for.
+        The returned table is a view into the shared tensor.
+
+        :param name: The character's name (ie, 'Lyn')
+        :return: a 10x10x3 nd array
+        """
+        i = feutils.character_id(name)
+        if not self.loaded[i]:
+            path = os.path.join(self.directory, self.table_name(name))
+            if os.path.exists(path):
+                self.q[i] = np.load(path)
+            self.loaded[i] = True
+
+        return self.q[i]
+
+    def record(self, name, state, action, reward, next_state, terminal=False, trace=None, trace_decay=0.0):
+        """
+        Buffers a transition. The buffer is flushed once it holds batch_size transitions.
+
+        :param name: The character who made the transition
+        :param state: The state before the action, as a tuple (E, N)
+        :param action: The action taken (0, 1, or 2)
+        :param reward: The reward given by the environment
+        :param next_state: The state after the action, as a tuple (E, N)
+        :param terminal: True if there is no next state (the unit died); max(Q(next_state)) is treated as 0
+        :param trace: optional sequence of (E, N, action) tuples that came before this transition, oldest first.
+        Each one receives the TD error of this transition scaled by (γλ)^k, k being how many steps back it is
+        :param trace_decay: λ, the trace decay
+        """
+        if self.read_only:
+            return
+
+        if self.replay_buffer is not None:
+            self.replay_buffer.add(name, state, action, reward, next_state, terminal)
+
+        i = self.pending
+        self._characters[i] = feutils.character_id(name)
+        self._states[i] = state
+        self._actions[i] = action
+        self._rewards[i] = reward
+        self._next_states[i] = next_state
+        self._terminals[i] = terminal
+
+        if trace is not None and len(trace) > 0 and trace_decay > 0:
+            steps_back = np.arange(len(trace), 0, -1)
+            self._trace_rows.append(np.full(len(trace), i))
+            self._trace_state_actions.append(np.asarray(trace, dtype=np.intp))
+            self._trace_weights.append((self.gamma * trace_decay) ** steps_back)
+
+        self.pending += 1
+
+        if self.pending == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Applies every buffered transition in one vectorized update.
+        Q(s,a) <- Q(s,a) + α[R + γ max(Q(s', a)) - Q(s,a)]
+
+        All TD errors in a batch are computed from the q-values as they were before the batch, so a state-action
+        updated by several transitions of the batch gets the mean of their updates (see apply). The credit one
+        transition gives its own trace is still accumulated.
+        """
+        n = self.pending
+        if n == 0:
+            return
+
+        characters = self._characters[:n]
+        state_actions, td_error = self.td_errors(characters, self._states[:n], self._actions[:n], self._rewards[:n],
+                                                 self._next_states[:n], self._terminals[:n])
+
+        transitions = np.arange(n)
+        if len(self._trace_rows) > 0:
+            rows = np.concatenate(self._trace_rows)
+            traced = np.concatenate(self._trace_state_actions)
+            weights = np.concatenate(self._trace_weights)
+
+            state_actions = tuple(np.concatenate((primary, extra)) for primary, extra in
+                                  zip(state_actions, (characters[rows], traced[:, 0], traced[:, 1], traced[:, 2])))
+            td_error = np.concatenate((td_error, td_error[rows] * weights))
+            transitions = np.concatenate((transitions, rows))
+
+            self._trace_rows = []
+            self._trace_state_actions = []
+            self._trace_weights = []
+
+        self.apply(state_actions, td_error, transitions)
+        self.pending = 0
+
+    def apply(self, state_actions, td_error, transitions):
+        """
+        Adds alpha * td_error to the q-values of state_actions. The TD errors of a batch all come from the q-values
+        as they were before it, so summing the updates of a state-action that k transitions share would take a step
+        of k * alpha (and a sampled replay batch, with many copies of a common transition, diverges). Each
+        state-action is instead moved by the mean of the transitions' updates to it.
+
+        :param state_actions: tuple of index arrays (character, E, N, action) into q
+        :param td_error: the update of every entry of state_actions
+        :param transitions: the transition every entry comes from; the entries of one transition (ie, its trace)
+        are summed
+        """
+        if len(td_error) == 0:
+            return
+
+        flat = np.ravel_multi_index(state_actions, self.q.shape)
+        cells, inverse = np.unique(flat, return_inverse=True)
+        n_transitions = int(np.max(transitions)) + 1
+        touched = np.unique(inverse * n_transitions + transitions)
+        counts = np.bincount(touched // n_transitions, minlength=len(cells))
+
+        np.add.at(self.q, state_actions, self.alpha * td_error / counts[inverse])
+
+    def td_errors(self, characters, states, actions, rewards, next_states, terminals):
+        """
+        Computes the TD errors of a batch of transitions from the current q-values
+
+        :return: state_actions, td_error
+            state_actions -> tuple of index arrays (character, E, N, action) into q
+            td_error -> R + γ max(Q(s', a)) - Q(s,a) of every transition
+        """
+        state_actions = (characters, states[:, 0], states[:, 1], actions)
+        qmax = np.max(self.q[characters, next_states[:, 0], next_states[:, 1]], axis=-1)
+        qmax[terminals] = 0
+        return state_actions, rewards + (self.gamma * qmax) - self.q[state_actions]
+
+    def update(self, characters, states, actions, rewards, next_states, terminals):
+        """
+        Applies a batch of transitions right away in one vectorized update, bypassing the buffer (ie, replayed
+        experience). A state-action several transitions of the batch share gets the mean of their updates (see
+        apply). Takes arrays with one row per transition; characters are ids from feutils.character_id.
+
+        :return: the TD error of every transition, from before the update
+        """
+        state_actions, td_error = self.td_errors(characters, states, actions, rewards, next_states, terminals)
+        if not self.read_only:
+            self.apply(state_actions, td_error, np.arange(len(td_error)))
+        return td_error
+
+    def save(self, name=None):
+        """
+        Flushes pending transitions and saves q-tables to disk
+
+        :param name: The character whose table will be saved. If None, every loaded table is saved
+        """
+        if self.read_only:
+            return
+
+        self.flush()
+        names = feutils.playable_characters() if name is None else [name]
+        for n in names:
+            i = feutils.character_id(n)
+            if self.loaded[i]:
+                np.save(os.path.join(self.directory, self.table_name(n)), self.q[i])
@@ -0,0 +1,168 @@
+import random
+import combat
+import feutils
+
+
+class FERedPolicyError(Exception):
+    pass
+
+
+class RedPhasePlanner:
+    """
+    Plans the red phase for every red unit, sharing the expensive work between them.
+
+    At the start of the phase it computes each red unit's reach (blocked by blue units) and, for each attack range,
+    a target map of the tiles from which blue units can be attacked. Red units never block each other, so moving a
+    red unit only changes which tiles are occupied. When a blue unit dies it is dropped from the target maps, and
+    only red units that could have been blocked by it get their reach recomputed.
+
+    Policies:
+        'random' -> The original red AI: attack if possible, then pick a random valid tile and a random target
+        'nearest-target' -> Attack the closest blue unit from the closest tile; otherwise move towards the blue team
+        'best-forecast' -> Attack from the tile and at the target with the best expected damage trade; otherwise
+                           move towards the blue team
+    """
+    policies = ('random', 'nearest-target', 'best-forecast')
+
+    def __init__(self, env, red_team, blue_team, policy='random'):
+        if policy not in self.policies:
+            raise FERedPolicyError(f'Red policy must be one of {self.policies}, not: [ {policy} ]')
+
+        self.env = env
+        self.map = env.map
+        self.red_team = red_team
+        self.blue_team = blue_team
+        self.policy = policy
+
+        # red unit -> set of tiles it could pass through this phase
+        self.reach = {}
+        for red_unit in red_team:
+            self.reach[red_unit] = self.map.get_reachable_coordinates(red_unit, blue_team)
+
+        # attack range tuple -> {tile: [blue units attackable from that tile]}
+        self.target_maps = {}
+
+    def target_map(self, attack_range):
+        """
+        Gets the tiles from which a unit with the given attack range could attack blue units, built once per phase.
+        Targets are listed in blue team order.
+
+        :param attack_range: sorted list of attack ranges (ie, [1, 2])
+        :return: a dictionary of tile -> list of blue units
+        """
+        key = tuple(attack_range)
+        if key not in self.target_maps:
+            targets = {}
+            for blue_unit in self.blue_team:
+                for r in key:
+                    for dx in range(-r, r + 1):
+                        dy = r - abs(dx)
+                        for x, y in {(blue_unit.x + dx, blue_unit.y + dy), (blue_unit.x + dx, blue_unit.y - dy)}:
+                            if 0 <= x < self.map.x and 0 <= y < self.map.y:
+                                targets.setdefault((x, y), []).append(blue_unit)
+            self.target_maps[key] = targets
+
+        return self.target_maps[key]
+
+    def valid_moves(self, red_unit):
+        """
+        :return: The tiles red_unit can move to right now, in the same order as Map.get_valid_move_coordinates
+        """
+        occupied = {(u.x, u.y) for u in self.red_team + self.blue_team if u is not red_unit}
+        return [tile for tile in self.reach[red_unit] if tile not in occupied]
+
+    def plan(self, red_unit):
+        """
+        Decides what red_unit does this phase
+
+        :param red_unit: The red unit whose turn it is
+        :return: action, move, target
+            action -> 0, 1, or 2
+            move -> tuple x,y to move to
+            target -> The blue unit to attack if action is 2, otherwise None
+        """
+        health_percent = red_unit.current_hp / red_unit.hp_max
+        if health_percent <= 0.35 and red_unit.has_consumable():
+            return 1, self.choose_idle_move(red_unit, self.valid_moves(red_unit)), None
+
+        valid_moves = self.valid_moves(red_unit)
+        targets = self.target_map(red_unit.get_attack_range())
+        attack_moves = [tile for tile in valid_moves if tile in targets]
+
+        if len(attack_moves) == 0:
+            return 0, self.choose_idle_move(red_unit, valid_moves), None
+
+        if self.policy == 'random':
+            move = random.choice(attack_moves)
+            return 2, move, random.choice(targets[move])
+
+        if self.policy == 'nearest-target':
+            candidates = [(tile, target) for tile in attack_moves for target in targets[tile]]
+            tile, target = min(candidates, key=lambda c: (
+                feutils.manhattan_distance(red_unit.x, red_unit.y, c[1].x, c[1].y),
+                feutils.manhattan_distance(red_unit.x, red_unit.y, c[0][0], c[0][1])))
+            return 2, tile, target
+
+        return (2,) + self.best_forecast(red_unit, attack_moves, targets)
+
+    def choose_idle_move(self, red_unit, valid_moves):
+        if self.policy == 'random' or len(self.blue_team) == 0:
+            return random.choice(valid_moves)
+
+        # Close in on the blue team, by how far it is to walk there. If the terrain cuts red_unit off from every blue
+        # unit it still closes in as the crow flies
+        group = red_unit.terrain_group
+        if any(self.map.can_ever_reach(group, red_unit.x, red_unit.y, u.x, u.y) for u in self.blue_team):
+            return min(valid_moves, key=lambda tile: self.map.get_terrain_distance_to_closest(group, tile[0], tile[1],
+                                                                                             self.blue_team))
+        return min(valid_moves, key=lambda tile: feutils.get_closest_unit_manhattan(tile[0], tile[1], self.blue_team))
+
+    def best_forecast(self, red_unit, attack_moves, targets):
+        """
+        Finds the tile and target with the best expected damage dealt minus expected damage taken
+
+        :return: tile, target
+        """
+        candidates = [(tile, target) for tile in attack_moves for target in targets[tile]]
+        summaries = combat.get_combat_stats_batch(red_unit, candidates, self.map)
+
+        best, best_score = None, float('-inf')
+        for candidate, summary in zip(candidates, summaries):
+            score = expected_damage(summary.attacker_summary) - expected_damage(summary.defender_summary)
+            if score > best_score:
+                best, best_score = candidate, score
+
+        return best
+
+    def update(self, red_unit, target):
+        """
+        Updates the shared state after red_unit acted. Call this after Environment.step
+
+        :param red_unit: The red unit that just acted
+        :param target: The blue unit it attacked, if any
+        """
+        if red_unit not in self.red_team:  # The red unit died attacking
+            del self.reach[red_unit]
+
+        if target is not None and target not in self.blue_team:
+            for targets in self.target_maps.values():
+                for tile, tile_targets in list(targets.items()):
+                    if target in tile_targets:
+                        tile_targets.remove(target)
+                        if len(tile_targets) == 0:
+                            del targets[tile]
+
+            # The dead unit no longer blocks movement for red units that could have reached its tile
+            for other, reach in self.reach.items():
+                if feutils.manhattan_distance(other.x, other.y, target.x, target.y) <= other.move:
+                    self.reach[other] = self.map.get_reachable_coordinates(other, self.blue_team)
+
+
+def expected_damage(summary):
+    """
+    :param summary: A combat.Combat for one side of a battle
+    :return: The damage that side is expected to deal
+    """
+    strikes = 2 if summary.doubling else 1
+    return strikes * summary.hit_chance * summary.might * (1 + 2 * summary.crit_chance)
+
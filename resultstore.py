@@ -0,0 +1,162 @@
+import argparse
+import glob
+import os
+import sqlite3
+
+from termcolor import colored
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Run results are stored as Parquet files partitioned by run and by block of games:
+#   <root>/run=<run name>/block=<first game of the block>/part.parquet
+# so readers only open the runs and blocks they ask for, and only read the columns they ask for.
+DEFAULT_ROOT = 'data/results'
+BLOCK_SIZE = 10000
+
+
+class FEResultStoreError(Exception):
+    pass
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise FEResultStoreError('The results store needs pyarrow; install it with: pip install pyarrow')
+
+
+def _schema():
+    return pa.schema([
+        ('game_number', pa.int64()),
+        ('victory', pa.bool_()),
+        ('survival_rank', pa.int16()),
+        ('tactic_rank', pa.int16()),
+        ('units', pa.string()),
+        ('dead_units', pa.string())
+    ])
+
+
+def block_path(run_name, first_game, root=DEFAULT_ROOT):
+    return os.path.join(root, f'run={run_name}', f'block={first_game}', 'part.parquet')
+
+
+def export_run(run_name, block_size=BLOCK_SIZE, root=DEFAULT_ROOT):
+    """
+    Exports the results database of a run ('data/<run_name>.db') to Parquet, one file per block of games. Blocks
+    that were already exported and are full are skipped, so exporting a run again only writes its new games.
+    The database is read one block at a time.
+
+    :return: how many blocks were written
+    """
+    _require_pyarrow()
+
+    conn = sqlite3.connect(f'data/{run_name}.db')
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(FEstats)')]
+    dead_column = 'dead_units' if 'dead_units' in columns else 'NULL'
+    last_game = conn.execute('SELECT MAX(game_number) FROM FEstats').fetchone()[0]
+
+    written = 0
+    if last_game is not None:
+        for first_game in range(0, last_game + 1, block_size):
+            path = block_path(run_name, first_game, root)
+            if os.path.exists(path) and first_game + block_size <= last_game and \
+                    pq.read_metadata(path).num_rows == block_size:
+                continue
+
+            rows = conn.execute(f'''SELECT game_number, victory_rank = 'S', survival_rank, tactic_rank, units,
+                                           {dead_column}
+                                    FROM FEstats WHERE game_number >= ? AND game_number < ?
+                                    ORDER BY game_number''', (first_game, first_game + block_size)).fetchall()
+            if len(rows) == 0:
+                continue
+
+            table = pa.Table.from_arrays([pa.array(column) for column in zip(*rows)], schema=_schema())
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pq.write_table(table, path + '.tmp', compression='zstd')
+            os.replace(path + '.tmp', path)
+            written += 1
+
+    conn.close()
+    return written
+
+
+def dataset(root=DEFAULT_ROOT):
+    """
+    Opens every exported run as one lazy dataset; nothing is read until it is scanned.
+    The partition columns 'run' and 'block' are part of the dataset.
+    """
+    _require_pyarrow()
+    return ds.dataset(root, format='parquet', partitioning='hive', exclude_invalid_files=True)
+
+
+def scan(runs=None, columns=None, first_game=None, last_game=None, root=DEFAULT_ROOT):
+    """
+    Lazily reads selected columns of selected runs. Only the matching partitions and columns are read.
+
+    :param runs: run names to read, or None for every run
+    :param columns: columns to read, or None for every column ('run' is always added)
+    :param first_game: optional first game number to read
+    :param last_game: optional last game number to read
+    :return: a generator of pyarrow RecordBatches
+    """
+    results = dataset(root)
+
+    condition = None
+    for clause in ((ds.field('run').isin(list(runs)) if runs is not None else None),
+                   (ds.field('game_number') >= first_game if first_game is not None else None),
+                   (ds.field('game_number') <= last_game if last_game is not None else None)):
+        if clause is not None:
+            condition = clause if condition is None else condition & clause
+
+    if columns is not None and 'run' not in columns:
+        columns = ['run'] + list(columns)
+
+    return results.to_batches(columns=columns, filter=condition)
+
+
+def load(runs=None, columns=None, first_game=None, last_game=None, root=DEFAULT_ROOT):
+    """
+    scan, collected into one pandas DataFrame
+    """
+    results = dataset(root)
+    batches = list(scan(runs, columns, first_game, last_game, root))
+    if len(batches) == 0:
+        return pa.Table.from_batches([], schema=results.schema).to_pandas()
+    return pa.Table.from_batches(batches).to_pandas()
+
+
+def compare_runs(runs=None, root=DEFAULT_ROOT):
+    """
+    Compares runs side by side with a column scan of the ranks
+
+    :return: a pyarrow Table with one row per run: games, win rate, and mean survival and tactic ranks
+    """
+    table = pa.Table.from_batches(list(scan(runs, ['victory', 'survival_rank', 'tactic_rank'], root=root)),
+                                  schema=pa.schema([('run', pa.string()), ('victory', pa.bool_()),
+                                                    ('survival_rank', pa.int16()), ('tactic_rank', pa.int16())]))
+    table = table.set_column(1, 'victory', table.column('victory').cast(pa.float64()))
+    summary = table.group_by('run').aggregate([('victory', 'count'), ('victory', 'mean'), ('survival_rank', 'mean'),
+                                               ('tactic_rank', 'mean')])
+    names = {'victory_count': 'games', 'victory_mean': 'win_rate', 'survival_rank_mean': 'mean_survival_rank',
+             'tactic_rank_mean': 'mean_tactic_rank', 'run': 'run'}
+    summary = summary.rename_columns([names[name] for name in summary.column_names])
+    return summary.select(['run', 'games', 'win_rate', 'mean_survival_rank', 'mean_tactic_rank']).sort_by('run')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export run results to Parquet and compare runs')
+    parser.add_argument('command', choices=('export', 'compare'))
+    parser.add_argument('runs', nargs='*', help="run names; exporting with no runs exports every 'data/*.db'")
+    parser.add_argument('--root', default=DEFAULT_ROOT)
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        run_names = args.runs or [os.path.splitext(os.path.basename(p))[0] for p in sorted(glob.glob('data/*.db'))]
+        for run in run_names:
+            print(colored(f'{run}: ', 'yellow') + f'{export_run(run, args.block_size, args.root)} blocks written')
+    else:
+        print(compare_runs(args.runs or None, args.root).to_pandas().to_string(index=False))
@@ -0,0 +1,308 @@
+import argparse
+import contextlib
+import os
+import pickle
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from termcolor import colored
+
+import policy
+
+# Value of a finished game on top of the hp balance; see position_value
+WIN_VALUE = 10.0
+
+
+class FERolloutError(Exception):
+    pass
+
+
+def position_value(blue_team, red_team, info):
+    """
+    Values a position for the blue team: the blue team's remaining hp minus the red team's, each unit counting as
+    its fraction of max hp, plus WIN_VALUE if the game was won (or minus it if it was lost)
+
+    :param info: The info of the last step; info['winner'] is set if the game is over
+    :return: a float, higher is better for blue
+    """
+    value = sum(u.current_hp / u.hp_max for u in blue_team) - sum(u.current_hp / u.hp_max for u in red_team)
+    if info.get('winner') == 'Blue':
+        value += WIN_VALUE
+    elif info.get('winner') == 'Red':
+        value -= WIN_VALUE
+    return value
+
+
+def game_over(blue_team, red_team, info):
+    if len(red_team) == 0:
+        info['winner'] = 'Blue'
+        return True
+    if len(blue_team) == 0:
+        info['winner'] = 'Red'
+        return True
+    return False
+
+
+def play_blue_units(env, agents, blue_team, red_team):
+    """
+    Lets each blue unit in agents act with its own policy, without learning, in order
+
+    :return: done, info
+    """
+    for agent in agents:
+        if agent not in blue_team:  # Died earlier in the phase
+            continue
+
+        state = env.obtain_state(agent, blue_team, red_team)
+        action = agent.determine_action(state, env, blue_team, red_team)
+        move = agent.determine_move(action, blue_team, red_team, env)
+        _, _, done, info = env.step(agent, move, action, blue_team, red_team)
+
+        if done or game_over(blue_team, red_team, info):
+            return True, info
+
+    return False, {}
+
+
+def rollout(env, blue_team, red_team, unit_index, candidate, depth):
+    """
+    Plays one candidate of the blue unit at unit_index, then the rest of the blue phase and `depth` red phases
+    (with full blue phases in between), using each side's own policy.
+
+    :param candidate: (action, move, target index in red_team or None)
+    :return: the position_value reached
+    """
+    agent = blue_team[unit_index]
+    pending = tuple(blue_team[unit_index + 1:])
+    action, move, target_index = candidate
+    target = red_team[target_index] if target_index is not None else None
+
+    _, _, done, info = env.step(agent, move, action, blue_team, red_team, target)
+    done = done or game_over(blue_team, red_team, info)
+    if not done:
+        done, info = play_blue_units(env, pending, blue_team, red_team)
+
+    for turn in range(depth):
+        if done:
+            break
+
+        _, done, info = env.execute_red_phase(blue_team, red_team)
+        done = done or game_over(blue_team, red_team, info)
+        if done or turn == depth - 1:
+            break
+
+        done, info = play_blue_units(env, tuple(blue_team), blue_team, red_team)
+
+    return position_value(blue_team, red_team, info)
+
+
+def evaluate_candidates(env, blue_team, red_team, unit_index, candidates, seed, depth, rounds=1, deadline=None):
+    """
+    Plays rounds of one rollout per candidate from the current position, rewinding the game after each one. In
+    round r every candidate is played with seed + r (common random numbers), so they are compared on the same dice
+    rolls.
+
+    The first round is always played in full. After it, play stops as soon as the deadline passes, even in the middle
+    of a round.
+
+    The q-store is switched to read only while rolling out, game output is silenced, and the random number
+    generators are put back as they were afterwards.
+
+    :param deadline: Optional time.time() after which no more rollouts are started
+    :return: totals, counts -> arrays with the summed values of each candidate's rollouts and how many it got
+    """
+    q_store = blue_team[unit_index].q_store
+    read_only = q_store.read_only
+    random_states = random.getstate(), np.random.get_state()
+    game_snapshot = env.snapshot(blue_team, red_team)
+    totals = np.zeros(len(candidates))
+    counts = np.zeros(len(candidates), dtype=np.int64)
+
+    # Rollouts are not part of the game; keep them out of its trajectory
+    recorder, env.recorder = env.recorder, None
+    q_store.read_only = True
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for r in range(rounds):
+                for i, candidate in enumerate(candidates):
+                    if r > 0 and deadline is not None and time.time() >= deadline:
+                        return totals, counts
+
+                    random.seed(seed + r)
+                    np.random.seed(seed + r)
+                    totals[i] += rollout(env, blue_team, red_team, unit_index, candidate, depth)
+                    counts[i] += 1
+                    env.restore(game_snapshot)
+    finally:
+        env.recorder = recorder
+        q_store.read_only = read_only
+        random.setstate(random_states[0])
+        np.random.set_state(random_states[1])
+
+    return totals, counts
+
+
+def evaluate_candidates_remote(game_state, unit_index, candidates, seed, depth, rounds, deadline):
+    """
+    evaluate_candidates for a worker process; game_state is the pickled (env, blue_team, red_team)
+    """
+    env, blue_team, red_team = pickle.loads(game_state)
+    return evaluate_candidates(env, blue_team, red_team, unit_index, candidates, seed, depth, rounds, deadline)
+
+
+class RolloutPlanner:
+    """
+    Picks a blue unit's action, move and target by Monte Carlo rollouts instead of the q-table.
+
+    Every candidate (action, tile, target) is played out several times with Environment.step and
+    Environment.execute_red_phase from a snapshot of the game, and the candidate with the best mean position_value
+    wins. Rollouts are played in rounds of one rollout per candidate; rounds stop after `rollouts` of them or once
+    the latency budget of the decision is spent (at least one round is always played). With workers, the candidates
+    are split across a process pool: every worker is sent the pickled game once per decision and plays all the rounds
+    of its share of the candidates.
+
+    Planning does not consume the game's random number generators, so enabling it only changes the moves blue makes.
+    """
+    def __init__(self, rollouts=8, depth=1, budget=None, workers=0, max_tiles=4, seed=0):
+        """
+        :param rollouts: Most rollouts per candidate
+        :param depth: Red phases played in each rollout
+        :param budget: Seconds a decision may take (checked before every rollout after the first round). None means
+        no limit
+        :param workers: Processes to roll out in. 0 rolls out in this process
+        :param max_tiles: Most tiles tried per action (plus the tile the unit's own heuristic picks)
+        :param seed: Seed of the rollouts' random numbers
+        """
+        if rollouts < 1 or depth < 1:
+            raise FERolloutError(f'rollouts and depth must be at least 1, not: [ {rollouts}, {depth} ]')
+
+        self.rollouts = rollouts
+        self.depth = depth
+        self.budget = budget
+        self.workers = workers
+        self.max_tiles = max_tiles
+        self.rng = random.Random(seed)
+        self.pool = None
+
+        self.decisions = 0
+        self.rollouts_played = 0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def candidates(self, env, unit, blue_team, red_team):
+        """
+        Lists the candidates of unit: for every action it can take, the tile its own heuristic would pick plus up to
+        max_tiles other tiles, and for attacks every target in range of those tiles
+
+        :return: a list of (action, move, target index in red_team or None)
+        """
+        options = env.enumerate_options(unit, blue_team, red_team)
+        candidates = []
+
+        for action in policy.legal_actions(options.action_mask).tolist():
+            preferred = unit.determine_move(action, blue_team, red_team, env)
+            tiles = [tile for tile in options.valid_moves(action) if tile != preferred]
+            tiles = [preferred] + self.rng.sample(tiles, min(self.max_tiles, len(tiles)))
+
+            for tile in tiles:
+                if action != 2:
+                    candidates.append((action, tile, None))
+                    continue
+
+                for target in options.targets.get(tile, []):
+                    candidates.append((action, tile, red_team.index(target)))
+
+        return candidates
+
+    def plan(self, env, unit, blue_team, red_team):
+        """
+        Decides what unit does on its turn
+
+        :return: action, move, target
+            target -> The red unit to attack if action is 2, otherwise None
+        """
+        deadline = time.time() + self.budget if self.budget is not None else None
+        candidates = self.candidates(env, unit, blue_team, red_team)
+        unit_index = blue_team.index(unit)
+        seed = self.rng.randrange(2 ** 31)
+
+        if self.workers > 0 and len(candidates) > 1:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            recorder, env.recorder = env.recorder, None
+            game_state = pickle.dumps((env, blue_team, red_team), protocol=pickle.HIGHEST_PROTOCOL)
+            env.recorder = recorder
+
+            chunks = [chunk for chunk in np.array_split(np.arange(len(candidates)), self.workers) if len(chunk) > 0]
+            futures = [self.pool.submit(evaluate_candidates_remote, game_state, unit_index,
+                                        [candidates[i] for i in chunk], seed, self.depth, self.rollouts, deadline)
+                       for chunk in chunks]
+            results = [future.result() for future in futures]
+            totals = np.concatenate([result[0] for result in results])
+            counts = np.concatenate([result[1] for result in results])
+        else:
+            totals, counts = evaluate_candidates(env, blue_team, red_team, unit_index, candidates, seed, self.depth,
+                                                 self.rollouts, deadline)
+
+        self.decisions += 1
+        self.rollouts_played += int(np.sum(counts))
+
+        action, move, target_index = candidates[int(np.argmax(totals / counts))]
+        print(f'{unit.name} planned {action} at {move} over {int(np.sum(counts))} rollouts of {len(candidates)} '
+              f'candidates')
+        return action, move, red_team[target_index] if target_index is not None else None
+
+
+def benchmark(simulation_mode, run_name, decisions, planner):
+    """
+    Measures how many decisions per second a planner makes on freshly generated games
+
+    :return: decisions per second, rollouts per second
+    """
+    import main
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        env, unit_factory = main.create_simulation(simulation_mode, run_name, read_only=True)
+        elapsed = 0.0
+        made = 0
+        start_rollouts = planner.rollouts_played
+
+        while made < decisions:
+            blue_team, red_team = main.setup_episode(env, unit_factory)
+            for unit in list(blue_team):
+                start = time.perf_counter()
+                planner.plan(env, unit, blue_team, red_team)
+                elapsed += time.perf_counter() - start
+                made += 1
+                if made == decisions:
+                    break
+
+    return made / elapsed, (planner.rollouts_played - start_rollouts) / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the rollout planner in decisions per second')
+    parser.add_argument('mode', help='simulation mode (see main.scenarios)')
+    parser.add_argument('run_name', help='run name of the q-tables the blue team plays rollouts with')
+    parser.add_argument('--decisions', type=int, default=20)
+    parser.add_argument('--rollouts', type=int, nargs='+', default=[4, 8])
+    parser.add_argument('--depth', type=int, default=1)
+    parser.add_argument('--budget', type=float, default=None, help='seconds per decision')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, os.cpu_count()])
+    args = parser.parse_args()
+
+    for worker_count in args.workers:
+        for rollout_count in args.rollouts:
+            random.seed(0)
+            np.random.seed(0)
+            rollout_planner = RolloutPlanner(rollout_count, args.depth, args.budget, worker_count)
+            rates = benchmark(args.mode.strip().lower(), args.run_name.strip().lower(), args.decisions,
+                              rollout_planner)
+            rollout_planner.close()
+            print(colored(f'workers={worker_count} rollouts={rollout_count}: ', 'yellow') +
+                  f'{rates[0]:.2f} decisions/s, {rates[1]:.1f} rollouts/s')
@@ -0,0 +1,86 @@
+import argparse
+import contextlib
+import gc
+import io
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+# Counts the units, items and tiles constructed per episode setup (map generation and team deployment), and the
+# garbage collections they cause, with the unit factory pooling its units and without.
+# Usage (from anywhere): python scripts/allocation_benchmark.py [--episodes N] [--mode mini|big] [--seed S]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import environment  # noqa: E402,F401  (imported before the other modules, which need it)
+import item  # noqa: E402
+import main  # noqa: E402
+import map  # noqa: E402
+import unit  # noqa: E402
+
+COUNTED_CLASSES = {'Unit': unit.Unit, 'Item': item.Item, 'Tile': map.Tile}
+
+
+@contextlib.contextmanager
+def count_constructions(counts):
+    """
+    Counts every call of the counted classes' __init__ into counts (class name -> count) while active
+    """
+    originals = {name: cls.__init__ for name, cls in COUNTED_CLASSES.items()}
+
+    def counting(name, original):
+        def __init__(self, *args, **kwargs):
+            counts[name] += 1
+            original(self, *args, **kwargs)
+        return __init__
+
+    for name, cls in COUNTED_CLASSES.items():
+        cls.__init__ = counting(name, originals[name])
+    try:
+        yield
+    finally:
+        for name, cls in COUNTED_CLASSES.items():
+            cls.__init__ = originals[name]
+
+
+def benchmark(episodes, mode, seed, pool_units):
+    """
+    Sets up episodes with a read only unit factory
+
+    :return: dictionary of class name -> constructions per episode, plus 'gc' (generation 0 collections per episode)
+    and 'seconds' (per episode)
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        env, unit_factory = main.create_simulation(mode, 'zzallocation', read_only=True)
+        unit_factory.pool_units = pool_units
+        main.setup_episode(env, unit_factory)
+
+        counts = {name: 0 for name in COUNTED_CLASSES}
+        collections = gc.get_stats()[0]['collections']
+        start = time.perf_counter()
+        with count_constructions(counts):
+            for _ in range(episodes):
+                main.setup_episode(env, unit_factory)
+        seconds = time.perf_counter() - start
+
+    result = {name: count / episodes for name, count in counts.items()}
+    result['gc'] = (gc.get_stats()[0]['collections'] - collections) / episodes
+    result['seconds'] = seconds / episodes
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the objects constructed per episode setup')
+    parser.add_argument('--episodes', type=int, default=500)
+    parser.add_argument('--mode', choices=tuple(main.scenarios), default='mini')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for label, pooled in (('pooled', True), ('not pooled', False)):
+        per_episode = benchmark(args.episodes, args.mode, args.seed, pooled)
+        print(f'{label}: ' + ', '.join(f'{per_episode[name]:.1f} {name}' for name in COUNTED_CLASSES) +
+              f", {per_episode['gc']:.2f} gen 0 collections, {per_episode['seconds'] * 1000:.2f}ms per episode")
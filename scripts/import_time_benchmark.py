@@ -0,0 +1,55 @@
+import argparse
+import os
+import subprocess
+import sys
+
+# Measures how long importing an entry point module takes in a fresh interpreter, and fails if it imports a module
+# that should only be imported by the code paths that need it.
+# Usage (from anywhere): python scripts/import_time_benchmark.py [module] [--runs N] [--max-seconds S]
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFERRED_MODULES = ('pandas', 'matplotlib', 'tkinter', 'pyarrow')
+
+
+def import_times(module):
+    """
+    Imports module in a new interpreter with -X importtime
+
+    :return: dictionary of imported module name -> cumulative import time in seconds
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=REPO_ROOT,
+                            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the import time of an entry point')
+    parser.add_argument('module', nargs='?', default='main')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=None, help='fail if the median import time is higher')
+    args = parser.parse_args()
+
+    runs = [import_times(args.module) for _ in range(args.runs)]
+    totals = sorted(run[args.module] for run in runs)
+    median = totals[len(totals) // 2]
+
+    print(f'import {args.module}: median {median:.3f}s, min {totals[0]:.3f}s, max {totals[-1]:.3f}s')
+    print('Slowest imports:')
+    for name, seconds in sorted(runs[-1].items(), key=lambda item: -item[1])[1:11]:
+        print(f'  {name}: {seconds:.3f}s')
+
+    failed = False
+    deferred = [name for name in runs[-1] if name.split('.')[0] in DEFERRED_MODULES and '.' not in name]
+    if len(deferred) > 0:
+        print(f'FAIL: import {args.module} imports {", ".join(deferred)}')
+        failed = True
+    if args.max_seconds is not None and median > args.max_seconds:
+        print(f'FAIL: median import time {median:.3f}s is over {args.max_seconds}s')
+        failed = True
+
+    sys.exit(1 if failed else 0)
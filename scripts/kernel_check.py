@@ -0,0 +1,36 @@
+import argparse
+import os
+import sys
+
+# Checks that every available kernel backend gives the same results as the python backend on random boards, units
+# and combats (kernels.validate_backends), and fails if one disagrees. Run it after changing a kernel.
+# Usage (from anywhere): python scripts/kernel_check.py [--trials N] [--seed N] [--require-numba]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import kernels  # noqa: E402
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check that every kernel backend agrees with the python backend')
+    parser.add_argument('--trials', type=int, default=200, help='random inputs per kernel and backend')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--require-numba', action='store_true',
+                        help='fail if the numba backend is not available, instead of only checking the python one')
+    args = parser.parse_args()
+
+    if not __debug__:
+        parser.error('the backends are compared with assert statements; run without -O')
+
+    backends = kernels.available_backends()
+    if 'numba' not in backends:
+        if args.require_numba:
+            print('FAIL: numba is not installed, so the numba backend could not be checked')
+            sys.exit(1)
+        print('numba is not installed; only the python backend is checked')
+
+    try:
+        kernels.validate_backends(args.trials, args.seed)
+    except AssertionError as e:
+        print(f'FAIL: {e} disagrees with the python backend')
+        sys.exit(1)
+    print(f'OK: {", ".join(backends)} agree on {args.trials} random inputs per kernel')
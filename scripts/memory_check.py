@@ -0,0 +1,101 @@
+import argparse
+import contextlib
+import gc
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+# Plays games with learning on (q-tables are updated, and saved to a temporary directory that is deleted afterwards;
+# every transition is also kept in a replay buffer) and fails if the memory allocated by Python keeps growing once the
+# run has warmed up, ie if some state grows with every game.
+# The growth is the slope of a line fitted through the samples. What the game being played holds at a sample varies by
+# tens of KiB, so runs shorter than MIN_GAMES games (or with fewer than MIN_SAMPLES samples) can't tell that noise from
+# a leak of a few hundred bytes per game, and are refused.
+# Usage (from anywhere): python scripts/memory_check.py [--games N] [--warmup N] [--max-growth BYTES]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import environment  # noqa: E402,F401  (imported before the other modules, which need it)
+import experience  # noqa: E402
+import main  # noqa: E402
+import memory  # noqa: E402
+
+MIN_GAMES = 500
+MIN_SAMPLES = 5
+
+
+def measure(games, warmup, mode, every, seed, replay_capacity, q_directory):
+    """
+    Plays warmup games, then games more while sampling memory
+
+    :param q_directory: Where the q-tables are saved
+    :return: a memory.MemoryMonitor with the samples of the measured games
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        env, unit_factory = main.create_simulation(mode, 'zzmemorycheck')
+        unit_factory.q_store.directory = q_directory
+        if replay_capacity > 0:
+            unit_factory.q_store.replay_buffer = experience.ReplayBuffer(replay_capacity)
+
+        def play(game):
+            blue_team, red_team = main.setup_episode(env, unit_factory)
+            main.play_episode(env, blue_team, red_team, unit_factory.q_store)
+            env.obtain_metrics()
+            for unit in blue_team:
+                unit.close()
+
+        # Memory allocated before tracing starts is never traced, so the warm-up is traced too; otherwise the
+        # first sample would miss the memory every game reallocates, and the samples after it would look like growth
+        tracemalloc.start()
+        for game in range(warmup):
+            play(game)
+
+        monitor = memory.MemoryMonitor(every, trace=False)
+        devnull.flush()
+        gc.collect()
+        monitor.sample(0)
+        for game in range(games):
+            play(game)
+            if (game + 1) % every == 0:
+                # The prints of the games wait in devnull's buffer; they would count as traced memory
+                devnull.flush()
+                gc.collect()
+            monitor.update(game)
+        tracemalloc.stop()
+
+    return monitor
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check that memory stays flat over a long run')
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--warmup', type=int, default=200, help='games played before measuring')
+    parser.add_argument('--mode', choices=tuple(main.scenarios), default='mini')
+    parser.add_argument('--every', type=int, default=50, help='games between samples')
+    parser.add_argument('--max-growth', type=float, default=128, help='bytes per game the traced memory may grow by')
+    parser.add_argument('--replay-capacity', type=int, default=10000,
+                        help='transitions per character kept in a replay buffer (0 for none)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.games < MIN_GAMES or args.games // args.every < MIN_SAMPLES:
+        parser.error(f'measure at least {MIN_GAMES} games and {MIN_SAMPLES} samples (--games / --every)')
+
+    with tempfile.TemporaryDirectory() as q_tables:
+        memory_monitor = measure(args.games, args.warmup, args.mode, args.every, args.seed, args.replay_capacity,
+                                 q_tables)
+    print(memory_monitor.report())
+
+    growth = memory_monitor.growth_per_episode(column=2)
+    if growth is None:
+        print('FAIL: no traced memory samples to measure growth from')
+        sys.exit(1)
+    if growth > args.max_growth:
+        print(f'FAIL: traced memory grows by {growth:.1f} bytes per game (at most {args.max_growth} allowed)')
+        sys.exit(1)
+    print(f'OK: traced memory grows by {growth:.1f} bytes per game')
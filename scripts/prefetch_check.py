@@ -0,0 +1,93 @@
+import argparse
+import contextlib
+import os
+import random
+import sys
+
+import numpy as np
+
+# Checks that the episode prefetcher deploys the teams its background process generated: the same characters (by
+# roster, so Wil is not swapped for Rebecca, who has his character code), on the same tiles, each one a separate
+# unit. The prefetch process' teams are generated again here with the same seed to compare against. Also checks that
+# a prefetcher started from the random states of a handed over setup goes on with the same setups, as a resumed
+# run does.
+# Usage (from anywhere): python scripts/prefetch_check.py [--mode big] [--games N] [--seed N]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import environment  # noqa: E402
+import main  # noqa: E402
+import prefetch  # noqa: E402
+import unit_populator  # noqa: E402
+
+
+def team_signature(blue_team):
+    return [(unit.roster_name, unit.character_code, unit.job_code, unit.x, unit.y) for unit in blue_team]
+
+
+def produced_teams(mode, games, seed):
+    """
+    :return: the signature of every blue team the prefetch process makes with seed, made in this process
+    """
+    scenario = main.scenarios[mode]
+    env = environment.Environment(*scenario['dimensions'])
+    unit_factory = unit_populator.UnitFactory(*scenario['team_sizes'], 'zzprefetchcheck', read_only=True,
+                                              pool_units=False)
+    random.seed(seed)
+    np.random.seed(seed)
+    return [team_signature(main.setup_episode(env, unit_factory)[0]) for _ in range(games)]
+
+
+def prefetched_teams(mode, games, seed, random_states=None):
+    """
+    :return: the signature of the first games blue teams a prefetcher deploys, and the prefetcher's random states
+    after each one
+    """
+    env, unit_factory = main.create_simulation(mode, 'zzprefetchcheck', read_only=True)
+    prefetcher = prefetch.EpisodePrefetcher(env, unit_factory, seed=seed, random_states=random_states)
+    teams = []
+    states = []
+    try:
+        for _ in range(games):
+            blue_team, _ = prefetcher.next_episode(env, unit_factory)
+            if len({id(unit) for unit in blue_team}) != len(blue_team):
+                raise AssertionError(f'a unit is deployed twice: {[unit.roster_name for unit in blue_team]}')
+            teams.append(team_signature(blue_team))
+            states.append(prefetcher.random_states)
+    finally:
+        prefetcher.close()
+    return teams, states
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check that prefetched episodes deploy the teams that were generated')
+    parser.add_argument('--mode', choices=tuple(main.scenarios), default='big')
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        expected = produced_teams(args.mode, args.games, args.seed)
+        try:
+            actual, random_states = prefetched_teams(args.mode, args.games, args.seed)
+        except AssertionError as e:
+            actual, random_states = None, None
+            failure = str(e)
+
+        resumed = None
+        if actual is not None:
+            half = args.games // 2
+            resumed, _ = prefetched_teams(args.mode, args.games - half, args.seed + 1, random_states[half - 1])
+
+    if actual is None:
+        print(f'FAIL: {failure}')
+        sys.exit(1)
+    for game, (produced, deployed) in enumerate(zip(expected, actual)):
+        if produced != deployed:
+            print(f'FAIL: game {game} was generated with {produced} but deployed {deployed}')
+            sys.exit(1)
+    if resumed != actual[args.games // 2:]:
+        print('FAIL: a prefetcher resumed from saved random states made different setups')
+        sys.exit(1)
+
+    wil = sum(any(unit[0] == 'Wil' for unit in team) for team in actual)
+    print(f'OK: {args.games} prefetched teams match the generated ones (Wil in {wil}); resuming continues the setups')
@@ -0,0 +1,119 @@
+import argparse
+import contextlib
+import csv
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# Measures how episode setup and turns slow down, and how memory grows, as the map and the teams get bigger.
+# One curve grows the map with the teams fixed, the other grows the red team with the map fixed; the exponent of a
+# power law fitted to each curve shows the asymptotic behavior (ie, 1 is linear, 2 quadratic).
+# Usage (from anywhere): python scripts/stress_test.py [--sizes 16 32 64] [--red-units 10 50 100] [--turns N]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import environment  # noqa: E402
+import main  # noqa: E402
+import memory  # noqa: E402
+import unit_populator  # noqa: E402
+
+
+def measure(size, blue_units, red_units, games, turns, trace_memory):
+    """
+    Plays games of at most `turns` turns on size x size maps
+
+    :return: dictionary with the mean seconds per setup and per turn, the RSS after the games, and the peak memory
+    allocated by Python while playing (None unless trace_memory)
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        env = environment.Environment(size, size, size, size, turn_limit=turns + 1)
+        unit_factory = unit_populator.UnitFactory(blue_units - 1, blue_units - 1, red_units, red_units, 'zzstress',
+                                                  read_only=True)
+        # Not measured: the first game also compiles kernels and loads the q-tables
+        blue_team, red_team = main.setup_episode(env, unit_factory)
+        main.play_episode(env, blue_team, red_team, unit_factory.q_store)
+
+        if trace_memory:
+            tracemalloc.start()
+
+        setup_seconds = 0.0
+        turn_seconds = 0.0
+        turns_played = 0
+        for _ in range(games):
+            start = time.perf_counter()
+            blue_team, red_team = main.setup_episode(env, unit_factory)
+            setup_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            main.play_episode(env, blue_team, red_team, unit_factory.q_store)
+            turn_seconds += time.perf_counter() - start
+            turns_played += env.turn_count
+
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    return {'size': size, 'blue_units': blue_units, 'red_units': red_units, 'setup_seconds': setup_seconds / games,
+            'turn_seconds': turn_seconds / turns_played, 'rss': memory.rss_bytes(), 'peak_traced': peak}
+
+
+def scaling_exponent(xs, ys):
+    """
+    :return: k of the power law y = c * x^k fitted to the points, or None if there are fewer than 2
+    """
+    if len(xs) < 2:
+        return None
+    return float(np.polyfit(np.log(xs), np.log(ys), 1)[0])
+
+
+def print_curve(title, results, variable, x_of):
+    print(f'{title}:')
+    for result in results:
+        peak_text = f", peak {memory.format_bytes(result['peak_traced'])} traced" \
+            if result['peak_traced'] is not None else ''
+        print(f"  {result['size']}x{result['size']} map, {result['blue_units']} blue, {result['red_units']} red: "
+              f"setup {result['setup_seconds'] * 1000:.1f}ms, turn {result['turn_seconds'] * 1000:.1f}ms, "
+              f"RSS {memory.format_bytes(result['rss'] or 0)}{peak_text}")
+
+    xs = [x_of(result) for result in results]
+    for key, name in (('setup_seconds', 'setup'), ('turn_seconds', 'turn')):
+        exponent = scaling_exponent(xs, [result[key] for result in results])
+        if exponent is not None:
+            print(f'  {name} time ~ {variable}^{exponent:.2f}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure how setup and turn time scale with map size and unit count')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 24, 32, 48, 64], help='map sides to measure')
+    parser.add_argument('--red-units', type=int, nargs='+', default=[10, 25, 50, 100],
+                        help='red team sizes to measure')
+    parser.add_argument('--fixed-size', type=int, default=32, help='map side while the red team grows')
+    parser.add_argument('--fixed-red-units', type=int, default=20, help='red team size while the map grows')
+    parser.add_argument('--blue-units', type=int, default=6, help='blue team size, lord included (at most 20)')
+    parser.add_argument('--games', type=int, default=2, help='games per measurement')
+    parser.add_argument('--turns', type=int, default=3, help='turns per game at most')
+    parser.add_argument('--trace-memory', action='store_true', help='also measure peak Python memory (slower)')
+    parser.add_argument('--csv', default=None, help='also write every measurement to this CSV file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+
+    map_curve = [measure(size, args.blue_units, args.fixed_red_units, args.games, args.turns, args.trace_memory)
+                 for size in args.sizes]
+    print_curve('Growing the map', map_curve, 'tiles', lambda result: result['size'] ** 2)
+
+    unit_curve = [measure(args.fixed_size, args.blue_units, red_units, args.games, args.turns, args.trace_memory)
+                  for red_units in args.red_units]
+    print_curve('Growing the red team', unit_curve, 'units', lambda result: result['blue_units'] + result['red_units'])
+
+    if args.csv is not None:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(map_curve[0]))
+            writer.writeheader()
+            writer.writerows(map_curve + unit_curve)
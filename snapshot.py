@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class GameSnapshot:
+    """
+    A compact copy of everything that changes while a game is played, so a game can be rewound after trying moves
+    out (ie, for lookahead search).
+
+    Units, items, maps and team lists are immutable apart from a handful of fields, so the snapshot keeps references
+    to the objects themselves and copies only those fields:
+        - the members and order of both teams (units are removed from the teams when they die)
+        - every unit's position and current hp, as one int array
+        - every unit's inventory order and the uses left on its consumables
+        - the length of every blue unit's state-action history
+        - the environment's map and turn and battle counters
+
+    The random number generators are NOT part of the snapshot.
+    """
+    __slots__ = ('blue_team', 'red_team', 'blue_units', 'red_units', 'unit_array', 'inventories', 'item_uses',
+                 'history_lengths', 'map', 'number_map', 'counters')
+
+    def __init__(self, env, blue_team, red_team):
+        self.blue_team = blue_team
+        self.red_team = red_team
+        self.blue_units = tuple(blue_team)
+        self.red_units = tuple(red_team)
+
+        units = self.blue_units + self.red_units
+        self.unit_array = np.array([(u.x, u.y, u.current_hp) for u in units], dtype=np.int64).reshape(-1, 3)
+        self.inventories = tuple(tuple(u.inventory) for u in units)
+        self.item_uses = tuple(tuple(i.info['uses'] for i in inventory if 'uses' in i.info)
+                               for inventory in self.inventories)
+        self.history_lengths = tuple(len(u.state_action_history) for u in self.blue_units)
+
+        self.map = env.map
+        self.number_map = env.number_map
+        self.counters = (env.turn_count, env.blue_victory, env.red_victory, env.dead_blue_units, env.total_battles)
+
+    def restore(self, env):
+        """
+        Puts the game back in the state it was in when the snapshot was taken. The team lists are restored in place,
+        so every reference to them sees the restored teams.
+
+        :param env: The environment the snapshot was taken from
+        :return: blue_team, red_team
+        """
+        self.blue_team[:] = self.blue_units
+        self.red_team[:] = self.red_units
+
+        units = self.blue_units + self.red_units
+        for unit, (x, y, hp), inventory, uses in zip(units, self.unit_array.tolist(), self.inventories,
+                                                      self.item_uses):
+            unit.x, unit.y, unit.current_hp = x, y, hp
+            unit.inventory[:] = inventory
+            consumables = (i for i in inventory if 'uses' in i.info)
+            for item, item_uses in zip(consumables, uses):
+                item.info['uses'] = item_uses
+
+        for unit, length in zip(self.blue_units, self.history_lengths):
+            unit.state_action_history.truncate(length)
+
+        env.map = self.map
+        env.number_map = self.number_map
+        env.turn_count, env.blue_victory, env.red_victory, env.dead_blue_units, env.total_battles = self.counters
+
+        return self.blue_team, self.red_team
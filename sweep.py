@@ -0,0 +1,189 @@
+import argparse
+import contextlib
+import hashlib
+import itertools
+import json
+import logging
+import os
+import random
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import numpy as np
+from termcolor import colored
+
+import feutils
+import main
+
+
+def expand_grid(grid):
+    """
+    Expands a parameter grid into every combination of its values
+
+    :param grid: dictionary of hyper-parameter name -> list of values (ie, {'alpha': [0.1, 0.2], 'gamma': [0.6]})
+    :return: a list of dictionaries, one per configuration
+    """
+    names = list(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def configuration_run_name(sweep_name, index, hyperparameters, seed):
+    """
+    Each configuration is trained as its own run, so it gets its own q-tables and database. The name ends in a hash
+    of the configuration's values and seed, so re-running a sweep with another grid starts new runs instead of
+    resuming ones trained with other values
+    """
+    values = json.dumps({'hyperparameters': hyperparameters, 'seed': seed}, sort_keys=True)
+    return f'{sweep_name}_{index:03d}_{hashlib.sha1(values.encode()).hexdigest()[:8]}'
+
+
+def train_configuration(simulation_mode, run_name, iterations, hyperparameters, seed, checkpoint_every=1000,
+                        early_stopping=None):
+    """
+    Trains one configuration of a sweep. Runs inside a worker process with the game output silenced.
+    Configurations resume from their last checkpoint, so re-running an interrupted sweep only plays the games
+    that are missing.
+
+    :return: how many seconds training took
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+
+    start = datetime.now()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        main.main(simulation_mode, run_name, iterations, early_stopping, resume=True,
+                  checkpoint_every=checkpoint_every, hyperparameters=hyperparameters)
+
+    return (datetime.now() - start).total_seconds()
+
+
+def summarize_run(run_name, final_fraction=0.1):
+    """
+    Summarizes the results database of a run
+
+    :param run_name: The name of the run
+    :param final_fraction: The fraction of the last games used for the final win rate
+    :return: a dictionary with the number of games, overall and final win rates, and mean survival and tactic ranks
+    """
+    conn = sqlite3.connect(f'data/{run_name}.db')
+    games, win_rate, survival, tactic, last_game = conn.execute(
+        '''SELECT COUNT(*), AVG(victory_rank = 'S'), AVG(survival_rank), AVG(tactic_rank), MAX(game_number)
+           FROM FEstats''').fetchone()
+
+    final_win_rate = None
+    if games > 0:
+        first_final_game = last_game - max(int(games * final_fraction), 1) + 1
+        final_win_rate = conn.execute("SELECT AVG(victory_rank = 'S') FROM FEstats WHERE game_number >= ?",
+                                      (first_final_game,)).fetchone()[0]
+    conn.close()
+
+    return {
+        'games': games,
+        'win_rate': win_rate,
+        'final_win_rate': final_win_rate,
+        'mean_survival_rank': survival,
+        'mean_tactic_rank': tactic
+    }
+
+
+def run_sweep(simulation_mode, sweep_name, iterations, grid, workers=None, seed=0, checkpoint_every=1000,
+              early_stopping=None):
+    """
+    Trains every configuration of a parameter grid across a pool of processes and combines their results.
+
+    :param simulation_mode: 'mini' or 'big'
+    :param sweep_name: The name of the sweep. Configuration i is trained as the run '<sweep_name>_<i>_<hash>'; see
+    configuration_run_name
+    :param iterations: How many games to train each configuration for
+    :param grid: dictionary of BlueUnit hyper-parameter name -> list of values to try
+    :param workers: How many processes to use. Defaults to every core
+    :param seed: Base seed; configuration i is seeded with seed + i
+    :param checkpoint_every: Games between checkpoints of each configuration
+    :param early_stopping: Optional dictionary of keyword arguments for convergence.ConvergenceMonitor
+    :return: a pandas DataFrame with one row per configuration. It is also saved to 'data/<sweep_name>_sweep.csv'
+    """
+    import pandas as pd
+
+    configurations = expand_grid(grid)
+    results = []
+
+    # Read the game data before forking, so every worker inherits it
+    feutils.preload_game_data()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for i, hyperparameters in enumerate(configurations):
+            run_name = configuration_run_name(sweep_name, i, hyperparameters, seed + i)
+            future = pool.submit(train_configuration, simulation_mode, run_name, iterations, hyperparameters,
+                                 seed + i, checkpoint_every, early_stopping)
+            futures[future] = (run_name, hyperparameters)
+
+        for future in as_completed(futures):
+            run_name, hyperparameters = futures[future]
+            row = {'run_name': run_name, **hyperparameters}
+            try:
+                row['seconds'] = future.result()
+                row.update(summarize_run(run_name))
+                print(colored(f'{run_name} finished: {hyperparameters}', 'green'))
+            except Exception as e:
+                logging.getLogger().exception(e)
+                row['error'] = repr(e)
+                print(colored(f'{run_name} failed: {e!r}', 'red'))
+            results.append(row)
+
+    table = pd.DataFrame(results).sort_values('run_name').reset_index(drop=True)
+    table.to_csv(f'data/{sweep_name}_sweep.csv', index=False)
+    return table
+
+
+if __name__ == "__main__":
+    logger = main.configure_logger()
+
+    parser = argparse.ArgumentParser(description='Train every combination of a hyper-parameter grid in parallel')
+    parser.add_argument('mode', help=f'simulation mode: {", ".join(main.scenarios)}')
+    parser.add_argument('sweep_name',
+                        help='sweep name; each configuration is trained as the run <sweep name>_<i>_<hash>')
+    parser.add_argument('iterations', type=int, help='how many games to train each configuration for')
+    parser.add_argument('--alpha', type=float, nargs='+')
+    parser.add_argument('--gamma', type=float, nargs='+')
+    parser.add_argument('--epsilon', type=float, nargs='+')
+    parser.add_argument('--td-lambda', type=int, nargs='+')
+    parser.add_argument('--trace-decay', type=float, nargs='+')
+    parser.add_argument('--tau', type=float, nargs='+')
+    parser.add_argument('--zeta', type=float, nargs='+')
+    parser.add_argument('--phi', type=float, nargs='+')
+    parser.add_argument('--workers', type=int, default=None, help='processes to use (defaults to every core)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--checkpoint-every', type=int, default=1000)
+    parser.add_argument('--early-stop', action='store_true',
+                        help='stop each configuration once its q-tables and win rate plateau')
+    parser.add_argument('--window', type=int, default=1000, help='games per convergence checkpoint')
+    parser.add_argument('--min-games', type=int, default=10000, help='never stop early before this many games')
+    parser.add_argument('--delta-tolerance', type=float, default=1e-3,
+                        help='largest mean q-table change per game that still counts as converged')
+    parser.add_argument('--win-rate-tolerance', type=float, default=0.01,
+                        help='largest change in win rate between checkpoints that still counts as converged')
+    parser.add_argument('--patience', type=int, default=3, help='stable checkpoints in a row needed to stop')
+    args = parser.parse_args()
+
+    early_stopping_arg = None
+    if args.early_stop:
+        early_stopping_arg = {
+            'window': args.window,
+            'min_episodes': args.min_games,
+            'delta_tolerance': args.delta_tolerance,
+            'win_rate_tolerance': args.win_rate_tolerance,
+            'patience': args.patience
+        }
+
+    parameter_grid = {}
+    for parameter in ('alpha', 'gamma', 'epsilon', 'td_lambda', 'trace_decay', 'tau', 'zeta', 'phi'):
+        values = getattr(args, parameter)
+        if values is not None:
+            parameter_grid[parameter] = values
+
+    sweep_start = datetime.now()
+    combined = run_sweep(args.mode.strip().lower(), args.sweep_name.strip().lower(), args.iterations, parameter_grid,
+                         args.workers, args.seed, args.checkpoint_every, early_stopping_arg)
+    print(combined.to_string(index=False))
+    print(f'Sweep took {(datetime.now() - sweep_start).total_seconds()} seconds')
@@ -0,0 +1,304 @@
+import argparse
+import struct
+
+import numpy as np
+from combat import CombatResults
+
+# A trajectory file is a sequence of chunks, so runs can keep appending to it. Every chunk starts with a 4 byte tag:
+#   b'FEMP' -> the map of a game: game (uint32), x, y (uint16), then x*y uint8 tile numbers (Environment.number_map)
+#   b'FEST' -> a block of steps: row count (uint32), then every column of STEP_COLUMNS, one after the other
+# All numbers are little endian. The map of a game is always written before any of its steps.
+MAP_TAG = b'FEMP'
+STEPS_TAG = b'FEST'
+
+STEP_COLUMNS = (
+    ('game', '<u4'),
+    ('turn', '<u2'),
+    ('team', 'u1'),             # 0 blue, 1 red
+    ('unit', '<u2'),            # Id of the unit in its game (its deployment order, blue team first)
+    ('character', '<u2'),       # Unit.character_code
+    ('action', 'i1'),           # 0 wait, 1 item, 2 attack, DEPLOY when the unit is placed on the map
+    ('x', '<u2'),               # Tile the unit moved to
+    ('y', '<u2'),
+    ('target', '<i2'),          # Unit id of the attacked unit, or -1
+    ('combat_result', 'i1'),    # combat.CombatResults value, or -1 if there was no combat
+    ('state_e', 'i1'),          # The unit's state before the step, that it chose the action in
+    ('state_n', 'i1'),          # (Environment.obtain_state); -1 for deployments
+    ('reward', '<f4'),
+    ('hp', '<i2'),              # The unit's hp after the step
+    ('target_hp', '<i2')        # The target's hp after the step, or -1
+)
+COLUMN_DTYPES = {name: np.dtype(dtype) for name, dtype in STEP_COLUMNS}
+
+DEPLOY = -1
+BLUE_TEAM, RED_TEAM = 0, 1
+
+
+class FETrajectoryError(Exception):
+    pass
+
+
+class TrajectoryWriter:
+    """
+    Appends game trajectories to a trajectory file.
+
+    Steps are buffered column by column and written as one chunk every chunk_size steps (and on flush/close).
+    Attach a writer to an Environment (Environment.recorder) and call begin_game after deploying the teams of every
+    game; Environment.step then records every step of both teams.
+    """
+    def __init__(self, path, chunk_size=4096):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.file = open(path, 'ab')
+
+        self.columns = {name: np.zeros(chunk_size, dtype=dtype) for name, dtype in COLUMN_DTYPES.items()}
+        self.rows = 0
+        self.pending_maps = []
+
+        self.game = None
+        self.unit_ids = {}
+        self.unit_teams = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def begin_game(self, game, env, blue_team, red_team):
+        """
+        Starts recording a game: writes its map and a DEPLOY step for every unit
+
+        :param game: The game number
+        :param env: The environment, already reset
+        :param blue_team: The deployed blue team
+        :param red_team: The deployed red team
+        """
+        self.game = game
+        number_map = np.asarray(env.number_map, dtype=np.uint8)
+        self.pending_maps.append(MAP_TAG + struct.pack('<IHH', game, *number_map.shape) + number_map.tobytes())
+
+        self.unit_ids = {}
+        self.unit_teams = {}
+        for team, units in ((BLUE_TEAM, blue_team), (RED_TEAM, red_team)):
+            for unit in units:
+                self.unit_ids[unit] = len(self.unit_ids)
+                self.unit_teams[unit] = team
+                self.append(env.turn_count, unit, DEPLOY, unit.x, unit.y)
+
+    def record_step(self, turn, unit, action, move, target=None, result=None, state=None, reward=0.0):
+        """
+        Records a step of the current game. Called by Environment.step
+
+        :param state: The unit's state before the step, as a tuple (E, N)
+        """
+        if unit not in self.unit_ids:
+            raise FETrajectoryError(f'{unit.name} was not deployed in the game being recorded; call begin_game first')
+
+        self.append(turn, unit, action, move[0], move[1], target, result, state, reward)
+
+    def append(self, turn, unit, action, x, y, target=None, result=None, state=None, reward=0.0):
+        i = self.rows
+        c = self.columns
+        c['game'][i] = self.game
+        c['turn'][i] = turn
+        c['team'][i] = self.unit_teams[unit]
+        c['unit'][i] = self.unit_ids[unit]
+        c['character'][i] = unit.character_code
+        c['action'][i] = action
+        c['x'][i], c['y'][i] = x, y
+        c['target'][i] = self.unit_ids[target] if target is not None else -1
+        c['combat_result'][i] = result.value if result is not None else -1
+        c['state_e'][i], c['state_n'][i] = state if state is not None else (-1, -1)
+        c['reward'][i] = reward
+        c['hp'][i] = unit.current_hp
+        c['target_hp'][i] = target.current_hp if target is not None else -1
+
+        self.rows += 1
+        if self.rows == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered maps and steps to the end of the file
+        """
+        for chunk in self.pending_maps:
+            self.file.write(chunk)
+        self.pending_maps = []
+
+        if self.rows > 0:
+            self.file.write(STEPS_TAG + struct.pack('<I', self.rows))
+            for name, _ in STEP_COLUMNS:
+                self.file.write(self.columns[name][:self.rows].tobytes())
+            self.rows = 0
+
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+
+
+class TrajectoryReader:
+    """
+    Streams a trajectory file chunk by chunk, so only one chunk is ever in memory
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def chunks(self, columns=None):
+        """
+        :param columns: The step columns to read (defaults to every column); the others are skipped
+        :return: a generator of ('map', game, number_map) and ('steps', {column name: array}) tuples, in file order
+        """
+        columns = set(columns) if columns is not None else set(COLUMN_DTYPES)
+
+        with open(self.path, 'rb') as f:
+            while True:
+                tag = f.read(4)
+                if len(tag) == 0:
+                    return
+
+                if tag == MAP_TAG:
+                    game, x, y = struct.unpack('<IHH', f.read(8))
+                    number_map = np.frombuffer(f.read(x * y), dtype=np.uint8).reshape(x, y)
+                    yield 'map', game, number_map
+                elif tag == STEPS_TAG:
+                    rows = struct.unpack('<I', f.read(4))[0]
+                    block = {}
+                    for name, dtype in COLUMN_DTYPES.items():
+                        size = rows * dtype.itemsize
+                        if name in columns:
+                            block[name] = np.frombuffer(f.read(size), dtype=dtype)
+                        else:
+                            f.seek(size, 1)
+                    yield 'steps', block
+                else:
+                    raise FETrajectoryError(f'{self.path} is not a trajectory file or is corrupt (chunk tag {tag!r})')
+
+    def steps(self, columns=None):
+        """
+        :return: a generator of {column name: array} blocks of steps
+        """
+        for chunk in self.chunks(columns):
+            if chunk[0] == 'steps':
+                yield chunk[1]
+
+    def rows(self, columns=None):
+        """
+        :return: a generator of one dictionary per step
+        """
+        for block in self.steps(columns):
+            names = list(block.keys())
+            for values in zip(*(block[name].tolist() for name in names)):
+                yield dict(zip(names, values))
+
+    def maps(self):
+        """
+        :return: a generator of (game, number_map)
+        """
+        for chunk in self.chunks(columns=()):
+            if chunk[0] == 'map':
+                yield chunk[1], chunk[2]
+
+
+class ReplayUnit:
+    """
+    A unit on a replayed board
+    """
+    def __init__(self, unit_id, team, character_code, x, y, hp):
+        self.unit_id = unit_id
+        self.team = team
+        self.character_code = character_code
+        self.x, self.y = x, y
+        self.current_hp = hp
+
+
+def replay(path, game):
+    """
+    Replays one recorded game step by step. The board is updated in place, so copy it to keep a frame around.
+
+    If a game was recorded more than once (ie, a resumed run played it again) the last recording is replayed from
+    where it starts.
+
+    :param path: The trajectory file
+    :param game: The game number to replay
+    :return: a generator of (number_map, board, step); board is a dictionary of unit id -> ReplayUnit holding the
+    units alive after the step, and step is the step's row as a dictionary
+    """
+    reader = TrajectoryReader(path)
+    recordings = sum(1 for recorded_game, _ in reader.maps() if recorded_game == game)
+    number_map = None
+    board = {}
+
+    for chunk in reader.chunks():
+        if chunk[0] == 'map':
+            if chunk[1] == game:
+                recordings -= 1
+                # Earlier recordings of the game are skipped; their steps come before the last one's map
+                if recordings == 0:
+                    number_map = chunk[2]
+            continue
+
+        block = chunk[1]
+        rows = np.nonzero(block['game'] == game)[0]
+        if number_map is None or len(rows) == 0:
+            continue
+
+        names = list(block.keys())
+        for i in rows.tolist():
+            step = {name: block[name][i].item() for name in names}
+            if step['action'] == DEPLOY:
+                board[step['unit']] = ReplayUnit(step['unit'], step['team'], step['character'], step['x'], step['y'],
+                                                 step['hp'])
+            else:
+                unit = board[step['unit']]
+                unit.x, unit.y, unit.current_hp = step['x'], step['y'], step['hp']
+                if step['target'] != -1:
+                    board[step['target']].current_hp = step['target_hp']
+
+                for unit_id in [u for u in (step['unit'], step['target']) if u in board]:
+                    if board[unit_id].current_hp <= 0:
+                        del board[unit_id]
+
+            yield number_map, board, step
+
+
+def summarize(path):
+    """
+    Summarizes a trajectory file by streaming it
+
+    :return: a dictionary with the number of games and steps, and the steps, attacks, kills and mean reward per team
+    """
+    games = set()
+    totals = {team: {'steps': 0, 'attacks': 0, 'kills': 0, 'reward': 0.0} for team in ('blue', 'red')}
+
+    for block in TrajectoryReader(path).steps(('game', 'team', 'action', 'combat_result', 'reward')):
+        games.update(np.unique(block['game']).tolist())
+        played = block['action'] != DEPLOY
+        for team_id, team in ((BLUE_TEAM, 'blue'), (RED_TEAM, 'red')):
+            rows = played & (block['team'] == team_id)
+            totals[team]['steps'] += int(np.sum(rows))
+            totals[team]['attacks'] += int(np.sum(rows & (block['action'] == 2)))
+            totals[team]['kills'] += int(np.sum(rows & (block['combat_result'] == CombatResults.DEFENDER_DEATH.value)))
+            totals[team]['reward'] += float(np.sum(block['reward'][rows]))
+
+    for team in totals.values():
+        team['mean_reward'] = team.pop('reward') / team['steps'] if team['steps'] > 0 else 0.0
+
+    return {'games': len(games), 'steps': sum(t['steps'] for t in totals.values()), **totals}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize or print a recorded trajectory file')
+    parser.add_argument('path', help='trajectory file')
+    parser.add_argument('--game', type=int, default=None, help='print every step of this game')
+    args = parser.parse_args()
+
+    if args.game is None:
+        print(summarize(args.path))
+    else:
+        for _, replay_board, replay_step in replay(args.path, args.game):
+            print(replay_step, f'({len(replay_board)} units on the board)')
@@ -1,16 +1,19 @@
 import abc
 import random
 from abc import ABC
-import os
 import combat
 import item
 from item_type import *
 import numpy as np
-import numpy.ma as npma
 import feutils
-from feutils import FEAttackRangeError
+import policy
+import qstore
+from feutils import FEAttackRangeError, FEHyperparameterError
 from termcolor import colored
 
+# How many state-actions a blue unit's history keeps beyond the td_lambda it needs; see StateActionHistory
+HISTORY_REWIND = 64
+
 
 class Unit(ABC):
     """
@@ -27,6 +30,24 @@ class Unit(ABC):
         self.character_code = character_code
         self.x = x
         self.y = y
+        self.name = feutils.character_name_table(self.character_code)
+
+        # Starting inventories this object has had, by item codes, so a reused unit doesn't make its items again
+        self.inventories = {}
+        self.set_stats(level, job_code, hp_max, strength, skill, spd, luck, defense, res, magic, ally, inventory_codes)
+
+        self.run_name = run_name
+
+    def __str__(self):
+        return self.name
+
+    def set_stats(self, level, job_code, hp_max, strength, skill, spd, luck, defense, res, magic, ally,
+                  inventory_codes: list):
+        """
+        Sets the class, stats and starting inventory of the unit, and restores its hp. Used by __init__, and to
+        reuse a unit object as a different unit of the same character (ie, a pooled red unit).
+        The items of an inventory are only made the first time the object gets it.
+        """
         self.level = level
         self.hp_max = hp_max
         self.current_hp = hp_max
@@ -38,9 +59,16 @@ class Unit(ABC):
         self.defense = defense
         self.res = res
 
-        self.inventory = item.construct_unit_inventory(inventory_codes)
+        codes = tuple(inventory_codes)
+        if codes not in self.inventories:
+            self.inventories[codes] = item.construct_unit_inventory(inventory_codes)
+        # The items the unit starts a game with, in order; see reset
+        self.starting_inventory = self.inventories[codes]
+        self.inventory = list(self.starting_inventory)
+        for i in self.inventory:
+            i.reset()
 
-        self.name = feutils.character_name_table(self.character_code)
+        self.job_code = job_code
         self.job = feutils.class_table(job_code)
         self.move = feutils.movement_table(self.job)
         self.terrain_group = feutils.job_terrain_group(self.job)
@@ -50,10 +78,16 @@ class Unit(ABC):
         else:
             self.con = feutils.job_constitution_table(self.job)
 
-        self.run_name = run_name
-
-    def __str__(self):
-        return self.name
+    def reset(self, x=0, y=0):
+        """
+        Puts the unit back as it was made, in place, so the same object can play another game: full hp, its starting
+        inventory with every item's uses restored, at x, y
+        """
+        self.x, self.y = x, y
+        self.current_hp = self.hp_max
+        self.inventory[:] = self.starting_inventory
+        for i in self.inventory:
+            i.reset()
 
     def equip_item(self, index):
         self.inventory[0], self.inventory[index] = self.inventory[index], self.inventory[0]
@@ -123,7 +157,7 @@ class Unit(ABC):
         pass
 
     @abc.abstractmethod
-    def determine_target(self, env, enemy_team):
+    def determine_target(self, env, enemy_team, targets=None):
         pass
 
     @abc.abstractmethod
@@ -147,19 +181,19 @@ class RedUnit(Unit):
         if health_percent <= 0.35 and consumable_count > 0:
             return 1
 
-        action_mask = env.generate_action_mask(self, ally_team, enemy_team)
-        if not action_mask[2]:  # If action_mask[2] is false, that means the unit can attack! So do it
+        options = env.enumerate_options(self, ally_team, enemy_team)
+        if not options.action_mask[2]:  # If action_mask[2] is false, that means the unit can attack! So do it
             return 2
 
         return 0  #
 
     def determine_move(self, action, ally_team, enemy_team, env):
-        valid_moves = env.generate_valid_moves(action, self, ally_team, enemy_team)
+        valid_moves = env.enumerate_options(self, ally_team, enemy_team).valid_moves(action)
         choice = random.choice(valid_moves)
         return choice
 
-    def determine_target(self, env, enemy_team):
-        attackable_targets = feutils.attackable_units(self, enemy_team)
+    def determine_target(self, env, enemy_team, targets=None):
+        attackable_targets = targets if targets is not None else feutils.attackable_units(self, enemy_team)
         if len(attackable_targets) == 0:
             raise FEAttackRangeError(f"No units were in attack range of {self.name} at coordinate {self.x},{self.y}")
 
@@ -173,6 +207,71 @@ class RedUnit(Unit):
         return False
 
 
+class FEHistoryError(Exception):
+    pass
+
+
+class StateActionHistory:
+    """
+    The state-actions (E, N, action) a blue unit took this game, in a preallocated ring of `capacity` rows: only the
+    latest `capacity` are kept, so the history takes the same memory however long a game goes on. Each one is marked
+    if its action was exploratory, which cuts the trace there (see trace).
+
+    len is how many state-actions were recorded since the last clear, including the ones no longer kept.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.state_actions = np.zeros((capacity, 3), dtype=np.int8)
+        self.exploratory = np.zeros(capacity, dtype=bool)
+        self.start = 0      # The oldest state-action still kept
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, state_action, exploratory=False):
+        if self.count - self.start == self.capacity:
+            self.start += 1
+        self.state_actions[self.count % self.capacity] = state_action
+        self.exploratory[self.count % self.capacity] = exploratory
+        self.count += 1
+
+    def clear(self):
+        self.start = 0
+        self.count = 0
+
+    def truncate(self, length):
+        """
+        Forgets every state-action recorded after the first `length`, ie to rewind a game to a snapshot
+
+        :except FEHistoryError if the history can't be rewound that far because the ring has wrapped around since
+        """
+        if not self.start <= length <= self.count:
+            raise FEHistoryError(f'Cannot rewind the history to {length} state-actions; only state-actions '
+                                 f'{self.start} to {self.count} are kept')
+        self.count = length
+
+    def latest(self, n=1):
+        """
+        :return: A list of the latest n (at most) state-actions as tuples (E, N, action), oldest first
+        """
+        n = min(n, self.count - self.start)
+        rows = [(self.count - n + i) % self.capacity for i in range(n)]
+        return [tuple(row) for row in self.state_actions[rows].tolist()]
+
+    def trace(self, n):
+        """
+        :return: A list of the latest n (at most) state-actions as tuples (E, N, action), oldest first, going back
+        no further than the latest exploratory one
+        """
+        n = min(n, self.count - self.start)
+        rows = [(self.count - n + i) % self.capacity for i in range(n)]
+        exploratory = np.nonzero(self.exploratory[rows])[0]
+        if len(exploratory) > 0:
+            rows = rows[exploratory[-1]:]
+        return [tuple(row) for row in self.state_actions[rows].tolist()]
+
+
 class BlueUnit(Unit):
     """
     Class that represents the reinforcement learning agents.
@@ -180,8 +279,10 @@ class BlueUnit(Unit):
     This class implements the abstract methods in the Unit class that allow for learning to take place.
     To find justifications for some algorithms here, see 'research/algorithms.md'
     """
+    hyperparameter_names = ('alpha', 'gamma', 'epsilon', 'td_lambda', 'trace_decay', 'tau', 'zeta', 'phi')
+
     def __init__(self, character_code, x, y, level, job_code, hp_max, strength, skill, spd, luck, defense, res, magic,
-                 ally, inventory_codes: list, terminal_condition, run_name):
+                 ally, inventory_codes: list, terminal_condition, run_name, q_store=None, hyperparameters=None):
         super().__init__(character_code, x, y, level, job_code, hp_max, strength, skill, spd, luck, defense, res, magic,
                          ally, inventory_codes, terminal_condition, run_name)
 
@@ -194,30 +295,60 @@ class BlueUnit(Unit):
         self.alpha = 0.1    # Learning rate
         self.gamma = 0.6    # Discount rate (how important the next move is when calculating expected value) (0 underplanning, 1 overplanning)
         self.epsilon = 0.1  # Exploration rate; how often do we explore vs exploit
-        self.td_lambda = 1  # Temporal difference count
+        self.td_lambda = 1  # Temporal difference count; how many recent state-actions share each TD error
+                            # (1 is greedy-Q)
+        self.trace_decay = 0.9  # λ; how much the credit of a TD error decays per step back when td_lambda > 1
 
         # Heuristic hyper-parameters
         self.tau = 0.9      # Used in combat heuristic: how much do we care about enemy combat stats vs our own?
         self.zeta = 0.3     # HP threshold for low HP; used in movement heuristic
         self.phi = 3        # Valuation constant for movement heuristic
 
-        # Maintain a history of state-action pairs. We use this if the unit dies on the enemy turn
-        self.state_action_history = []
+        # Override any of the hyper-parameters above (ie, when sweeping over them)
+        if hyperparameters is not None:
+            self.set_hyperparameters(hyperparameters)
 
-        self.table_name = f'{self.name}_qtable_v{self._version}_{self.run_name}_{self.alpha}-{self.gamma}.npy'
+        # Maintain a history of state-action pairs. We use this if the unit dies on the enemy turn, and for td_lambda.
+        # The extra room lets a game be rewound to a snapshot taken up to HISTORY_REWIND state-actions ago
+        self.state_action_history = StateActionHistory(max(self.td_lambda, 1) + HISTORY_REWIND)
+
+        # The q-table lives in a QStore, which is usually shared by the whole team
+        if q_store is None:
+            q_store = qstore.QStore(self.run_name, self.alpha, self.gamma, self._version)
+        self.q_store = q_store
+
+        self.table_name = self.q_store.table_name(self.name)
 
         self.q_table = self.init_q_table()
 
+    def reset(self, x=0, y=0):
+        """
+        Unit.reset, which also forgets the state-actions of the last game
+        """
+        super().reset(x, y)
+        self.state_action_history.clear()
+        self.q_table = self.init_q_table()
+
+    def set_hyperparameters(self, hyperparameters):
+        """
+        Overrides hyper-parameters of this unit
+
+        :param hyperparameters: dictionary of hyper-parameter name -> value. Valid names are in hyperparameter_names
+        :except FEHyperparameterError if a name is not a hyper-parameter
+        """
+        for name, value in hyperparameters.items():
+            if name not in self.hyperparameter_names:
+                raise FEHyperparameterError(f'{name} is not a hyper-parameter; expected one of '
+                                            f'{self.hyperparameter_names}')
+            setattr(self, name, value)
+
     def init_q_table(self):
         """
         Either loads q-table on disk if it exists or creates a new one
 
-        :return: a q-table (nd array that is 10x10x3)
+        :return: a q-table (nd array that is 10x10x3); a view into the unit's QStore
         """
-        if not os.path.exists(f'qtables/{self.table_name}'):
-            return np.zeros(np.concatenate((self.state_space, self.action_space)))
-        else:
-            return np.load(f'qtables/{self.table_name}')
+        return self.q_store.table(self.name)
 
     def close(self, reward=None):
         """
@@ -226,16 +357,14 @@ class BlueUnit(Unit):
 
         :return: True in all cases
         """
-        if reward is not None:
+        if reward is not None and len(self.state_action_history) > 0:
             # Grab last state action if unit incurred negative reward for episode ending
-            last_state_action = self.state_action_history[-1]
-            dummy = 0
-            current = self.q_table[last_state_action]
+            last_state_action = self.state_action_history.latest()[0]
+            state, action = last_state_action[:2], last_state_action[2]
+            self.q_store.record(self.name, state, action, reward, state, terminal=True,
+                                trace=self.earlier_state_actions(), trace_decay=self.trace_decay)
 
-            new_value = current + self.alpha * (reward + (self.gamma * dummy) - current)
-            self.q_table[last_state_action] = new_value
-
-        np.save(f'qtables/{self.table_name}', self.q_table)
+        self.q_store.save(self.name)
         return True
 
     def update_qtable(self, state, next_state, reward, action):
@@ -243,19 +372,47 @@ class BlueUnit(Unit):
         Updates q-table greedily using q-learning algorithm.
         Q(s,a) <- Q(s,a) + α[R + γ max(Q(s, a)) - Q(s,a)]
 
+        The update is buffered in the unit's QStore, which applies it right away unless it batches transitions.
+        If td_lambda is greater than 1, the TD error is also credited to the state-actions that came before,
+        decayed by γλ per step back (Watkins's Q(λ) over state_action_history; see earlier_state_actions).
+
         :param next_state:
         :param state:
         :param reward:
         :param action:
         :return:
         """
-        state_action = state + (action,)
+        self.q_store.record(self.name, state, action, reward, next_state,
+                            trace=self.earlier_state_actions(), trace_decay=self.trace_decay)
+
+    def earlier_state_actions(self):
+        """
+        Gets the state-actions eligible for credit besides the latest one, oldest first.
+        Assumes the latest state-action has already been appended to state_action_history.
+
+        The TD error backs up the greedy policy's value, so state-actions from before an exploratory action are not
+        credited with it (the trace is cut there, as in Watkins's Q(λ)); the exploratory state-action itself is.
 
-        qmax = np.max(self.q_table[next_state])
-        current = self.q_table[state_action]
+        :return: A list of at most td_lambda - 1 tuples (E, N, action)
+        """
+        if self.td_lambda <= 1:
+            return None
+        return self.state_action_history.trace(self.td_lambda)[:-1]
 
-        new_value = current + self.alpha * (reward + (self.gamma * qmax) - current)
-        self.q_table[state_action] = new_value
+    def remember(self, state, action, env, ally_team, enemy_team):
+        """
+        Appends a state-action to state_action_history, marking it if the action was exploratory: worth less than
+        the best legal action in the q-table. Only traces (td_lambda > 1) use the mark, so it is only worked out then
+
+        :param state: The state the action was taken in, as a tuple (E, N)
+        :param action: The action taken (0, 1, or 2)
+        """
+        exploratory = False
+        if self.td_lambda > 1:
+            action_mask = env.enumerate_options(self, ally_team, enemy_team).action_mask
+            q_values = self.q_table[state]
+            exploratory = bool(q_values[action] < np.max(np.where(action_mask, -np.inf, q_values)))
+        self.state_action_history.append(state + (action,), exploratory)
 
     def determine_action(self, state, env, ally_team, enemy_team):
         """
@@ -273,21 +430,15 @@ class BlueUnit(Unit):
         """
 
         # Mask invalid Q-Table entries (actions that cannot be taken given the state of the environment)
-        # They will be masked as -inf and will not be selectable by get_random_unmasked_action or argmax
-        action_mask = env.generate_action_mask(self, ally_team, enemy_team)
-        state_action_space = npma.masked_array(self.q_table[state],
-                                               fill_value=float('-inf'),
-                                               mask=action_mask,
-                                               copy=True)
-
-        if np.random.uniform(0, 1) < self.epsilon:
-            action = feutils.get_random_unmasked_action(state_action_space)  # Explore action space
-            text = colored('(EXPLORE)', 'yellow')
-            print(f'{self.name} chose {action} {text}')
+        # They will never be picked by exploration or exploitation
+        action_mask = env.enumerate_options(self, ally_team, enemy_team).action_mask
+        action, explored = policy.select_action(self.q_table[state], action_mask, self.epsilon)
+
+        if explored:
+            text = colored('(EXPLORE)', 'yellow')  # Explore action space
         else:
-            action = np.argmax(state_action_space)  # Exploit learned value
-            text = colored('(EXPLOIT)', 'magenta')
-            print(f'{self.name} chose {action} {text}')
+            text = colored('(EXPLOIT)', 'magenta')  # Exploit learned value
+        print(f'{self.name} chose {action} {text}')
 
         return action  # 0, 1, or 2
 
@@ -305,9 +456,10 @@ class BlueUnit(Unit):
         :param env: The environment of the game
         :return: A tuple representing a x,y pair to move to on the grid.
         """
-        valid_moves = env.generate_valid_moves(action, self, ally_team, enemy_team)
+        options = env.enumerate_options(self, ally_team, enemy_team)
+        valid_moves = options.valid_moves(action)
         if action == 2:
-            return self.move_attack_heuristic(valid_moves, enemy_team, env)
+            return self.move_attack_heuristic(valid_moves, enemy_team, env, options.targets)
         else:  # We can treat both 1 (Item) and 0 (Wait) pretty similarly heuristic-wise
             return self.move_wait_heuristic(valid_moves, enemy_team, ally_team, env)
 
@@ -338,7 +490,7 @@ class BlueUnit(Unit):
 
         return best_coords
 
-    def move_attack_heuristic(self, valid_moves, enemy_units, env):
+    def move_attack_heuristic(self, valid_moves, enemy_units, env, targets=None):
         """
         Determine which tile to move to, given that we want to attack.
         This is accomplished by simply finding the tile where the combat heuristic is maximized
@@ -346,13 +498,18 @@ class BlueUnit(Unit):
         :param valid_moves:
         :param enemy_units:
         :param env:
+        :param targets: Optional dictionary of tile -> attackable enemy units (UnitOptions.targets); if not given
+        the attackable units of every tile are looked up
         :return:
         """
         best_coords = self.x, self.y
         best_h = float('-inf')
 
         for x, y in valid_moves:
-            attackables = feutils.get_attackable_units(self, enemy_units, x, y)
+            if targets is not None:
+                attackables = targets.get((x, y), [])
+            else:
+                attackables = feutils.get_attackable_units(self, enemy_units, x, y)
             for unit in attackables:
                 h = self.combat_heuristic(unit, env)
                 if h > best_h:
@@ -361,7 +518,7 @@ class BlueUnit(Unit):
 
         return best_coords
 
-    def determine_target(self, env, enemy_team):
+    def determine_target(self, env, enemy_team, targets=None):
         """
         Determine which unit to attack in this unit's attack range.
         NOTE: when this method is called it is assumed the unit is already moved to the tile that they will attack from
@@ -369,11 +526,13 @@ class BlueUnit(Unit):
 
         :param env:
         :param enemy_team:
+        :param targets: Optional list of the enemy units attackable from the current position, if already known
+        (UnitOptions.targets); otherwise they are looked up
         :except FEAttackRangeError if no enemy units could be attacked from the current position
         :return: A Unit object that self will attack
         """
 
-        attackable_targets = feutils.attackable_units(self, enemy_team)
+        attackable_targets = targets if targets is not None else feutils.attackable_units(self, enemy_team)
         if len(attackable_targets) == 0:
             raise FEAttackRangeError(f"No units were in attack range of {self.name} at coordinate {self.x},{self.y}")
 
@@ -3,48 +3,99 @@ import random
 from unit import BlueUnit, RedUnit
 from map import Map
 import numpy as np
+import qstore
+
+
+# BlueUnit arguments of every character, up to the run name: character code, x, y, level, class code, hp, strength,
+# skill, speed, luck, defense, resistance, magic, ally, inventory codes, terminal condition
+_nonterminal_units = {
+    'Sain': (0xd2f8, 0, 0, 1, 0xe7c, 19, 8, 4, 6, 4, 6, 0, 0, True, [0x14, 0x6b], False),
+    'Kent': (0xd2c4, 0, 0, 1, 0xe7c, 20, 6, 6, 7, 2, 5, 1, 0, True, [0x1, 0x6b], False),
+    'Florina': (0xd3fc, 0, 0, 1, 0x11c4, 17, 5, 7, 9, 7, 4, 4, 0, True, [0x14, 0x6b], False),
+    'Wil': (0xd0f0, 0, 0, 2, 0x93c, 20, 6, 5, 5, 6, 5, 0, 0, True, [0x2c, 0x6b], False),
+    'Dorcas': (0xcfb8, 0, 0, 3, 0x744, 30, 7, 7, 6, 3, 3, 0, 0, True, [0x28, 0x6b], False),
+    'Erk': (0xd1f4, 0, 0, 1, 0xbdc, 17, 0, 6, 7, 3, 2, 4, 5, True, [0x37, 0x6b], False),
+    'Rath': (0xd3c8, 0, 0, 7, 0x1074, 25, 8, 9, 10, 5, 7, 2, 0, True, [0x2c, 0x6b, 0x6b], False),
+    'Matthew': (0xd534, 0, 0, 2, 0x150c, 19, 4, 6, 11, 2, 4, 1, 0, True, [0x1, 0x6b], False),
+    'Lucius': (0xd158, 0, 0, 3, 0xa8c, 18, 0, 6, 10, 2, 1, 6, 7, True, [0x3e, 0x6b], False),
+    'Marcus': (0xd360, 0, 0, 1, 0xf24, 31, 15, 15, 11, 8, 10, 8, 0, True, [0x17, 0x6b], False),
+    'Lowen': (0xd32c, 0, 0, 2, 0xe7c, 23, 7, 5, 7, 3, 7, 0, 0, True, [0x1c, 0x6b], False),
+    'Rebecca': (0xd0f0, 0, 0, 1, 0x990, 20, 6, 7, 6, 6, 3, 1, 0, True, [0x2c, 0x6b], False),
+    'Bartre': (0xcfec, 0, 0, 2, 0x744, 29, 9, 5, 3, 4, 4, 0, 0, True, [0x1f, 0x6b], False),
+    'Oswin': (0xd054, 0, 0, 9, 0x7ec, 29, 13, 9, 5, 3, 13, 3, 0, True, [0x14, 0x6c], False),
+    'Guy': (0xcf50, 0, 0, 3, 0x5f4, 21, 6, 11, 11, 5, 5, 0, 0, True, [0xd, 0x6c], False),
+    'Raven': (0xcee8, 0, 0, 5, 0x4a4, 25, 8, 11, 13, 2, 5, 1, 0, True, [0x3, 0x6c], False),
+    'Canas': (0xd290, 0, 0, 8, 0xd2c, 21, 0, 9, 8, 7, 5, 8, 10, True, [0x44, 0x6c], False),
+    'Dart': (0xd874, 0, 0, 8, 0x1464, 34, 12, 8, 8, 3, 6, 1, 0, True, [0x20, 0x6c], False),
+    'Heath': (0xd498, 0, 0, 7, 0x126c, 28, 11, 8, 7, 7, 10, 1, 0, True, [0x16, 0x6c], False)
+}
+
+_terminal_units = {
+    'Lyn': (0xceb4, 0, 0, 1, 0x204, 16, 4, 7, 9, 5, 2, 0, 0, True, [0xa, 0x6c], True),
+    'Eliwood': (0xce4c, 0, 0, 1, 0x1b0, 18, 5, 5, 7, 7, 5, 0, 0, True, [0x9, 0x6c], True),
+    'Hector': (0xce80, 0, 0, 1, 0x258, 19, 7, 4, 5, 3, 8, 0, 0, True, [0x8d, 0x6c], True)
+}
 
 
 class UnitFactory:
-    def __init__(self, blue_low, blue_high, red_low, red_high, run_name):
+    def __init__(self, blue_low, blue_high, red_low, red_high, run_name, q_batch_size=1, hyperparameters=None,
+                 read_only=False, pool_units=True):
         self.blue_low = blue_low
         self.blue_high = blue_high
         self.red_low = red_low
         self.red_high = red_high
         self.run_name = run_name
 
+        # With pooling, units are made once and reset in place for every game instead of being made again: blue units
+        # once per character, red units once per place in the red team (up to red_high). Units deployed by the
+        # previous game are reused, so don't keep them around across games if pooling is on
+        self.pool_units = pool_units
+        self.blue_pool = {}
+        self.red_pool = []
+
+        # Overrides for the BlueUnit hyper-parameters; see BlueUnit.hyperparameter_names
+        self.hyperparameters = hyperparameters
+
+        # Every blue unit made by this factory shares one Q-store, so q-tables are only loaded from disk once a run
+        learning_rates = {name: value for name, value in (hyperparameters or {}).items() if name in ('alpha', 'gamma')}
+        self.q_store = qstore.QStore(run_name, batch_size=q_batch_size, read_only=read_only, **learning_rates)
+
     def get_nonterminal_unit_base_stats(self, unit_name):
-        character_dict = {
-            'Sain': BlueUnit(0xd2f8, 0, 0, 1, 0xe7c, 19, 8, 4, 6, 4, 6, 0, 0, True, [0x14, 0x6b], False, self.run_name),
-            'Kent': BlueUnit(0xd2c4, 0, 0, 1, 0xe7c, 20, 6, 6, 7, 2, 5, 1, 0, True, [0x1, 0x6b], False, self.run_name),
-            'Florina': BlueUnit(0xd3fc, 0, 0, 1, 0x11c4, 17, 5, 7, 9, 7, 4, 4, 0, True, [0x14, 0x6b], False, self.run_name),
-            'Wil': BlueUnit(0xd0f0, 0, 0, 2, 0x93c, 20, 6, 5, 5, 6, 5, 0, 0, True, [0x2c, 0x6b], False, self.run_name),
-            'Dorcas': BlueUnit(0xcfb8, 0, 0, 3, 0x744, 30, 7, 7, 6, 3, 3, 0, 0, True, [0x28, 0x6b], False, self.run_name),
-            'Erk': BlueUnit(0xd1f4, 0, 0, 1, 0xbdc, 17, 0, 6, 7, 3, 2, 4, 5, True, [0x37, 0x6b], False, self.run_name),
-            'Rath': BlueUnit(0xd3c8, 0, 0, 7, 0x1074, 25, 8, 9, 10, 5, 7, 2, 0, True, [0x2c, 0x6b, 0x6b], False, self.run_name),
-            'Matthew': BlueUnit(0xd534, 0, 0, 2, 0x150c, 19, 4, 6, 11, 2, 4, 1, 0, True, [0x1, 0x6b], False, self.run_name),
-            'Lucius': BlueUnit(0xd158, 0, 0, 3, 0xa8c, 18, 0, 6, 10, 2, 1, 6, 7, True, [0x3e, 0x6b], False, self.run_name),
-            'Marcus': BlueUnit(0xd360, 0, 0, 1, 0xf24, 31, 15, 15, 11, 8, 10, 8, 0, True, [0x17, 0x6b], False, self.run_name),
-            'Lowen': BlueUnit(0xd32c, 0, 0, 2, 0xe7c, 23, 7, 5, 7, 3, 7, 0, 0, True, [0x1c, 0x6b], False, self.run_name),
-            'Rebecca': BlueUnit(0xd0f0, 0, 0, 1, 0x990, 20, 6, 7, 6, 6, 3, 1, 0, True, [0x2c, 0x6b], False, self.run_name),
-            'Bartre': BlueUnit(0xcfec, 0, 0, 2, 0x744, 29, 9, 5, 3, 4, 4, 0, 0, True, [0x1f, 0x6b], False, self.run_name),
-            'Oswin': BlueUnit(0xd054, 0, 0, 9, 0x7ec, 29, 13, 9, 5, 3, 13, 3, 0, True, [0x14, 0x6c], False, self.run_name),
-            'Guy': BlueUnit(0xcf50, 0, 0, 3, 0x5f4, 21, 6, 11, 11, 5, 5, 0, 0, True, [0xd, 0x6c], False, self.run_name),
-            'Raven': BlueUnit(0xcee8, 0, 0, 5, 0x4a4, 25, 8, 11, 13, 2, 5, 1, 0, True, [0x3, 0x6c], False, self.run_name),
-            'Canas': BlueUnit(0xd290, 0, 0, 8, 0xd2c, 21, 0, 9, 8, 7, 5, 8, 10, True, [0x44, 0x6c], False, self.run_name),
-            'Dart': BlueUnit(0xd874, 0, 0, 8, 0x1464, 34, 12, 8, 8, 3, 6, 1, 0, True, [0x20, 0x6c], False, self.run_name),
-            'Heath': BlueUnit(0xd498, 0, 0, 7, 0x126c, 28, 11, 8, 7, 7, 10, 1, 0, True, [0x16, 0x6c], False, self.run_name)
-        }
-        return character_dict[unit_name]
+        return self.get_blue_unit(unit_name, _nonterminal_units[unit_name])
 
     def get_terminal_unit_base_stats(self, unit_name):
-        character_dict = {
-            'Lyn': BlueUnit(0xceb4, 0, 0, 1, 0x204, 16, 4, 7, 9, 5, 2, 0, 0, True, [0xa, 0x6c], True, self.run_name),
-            'Eliwood': BlueUnit(0xce4c, 0, 0, 1, 0x1b0, 18, 5, 5, 7, 7, 5, 0, 0, True, [0x9, 0x6c], True, self.run_name),
-            'Hector': BlueUnit(0xce80, 0, 0, 1, 0x258, 19, 7, 4, 5, 3, 8, 0, 0, True, [0x8d, 0x6c], True, self.run_name)
-        }
-        return character_dict[unit_name]
+        return self.get_blue_unit(unit_name, _terminal_units[unit_name])
+
+    def get_character(self, unit_name):
+        """
+        Gets a blue unit of any character, lord or not
+
+        :except KeyError if unit_name is not a playable character
+        """
+        if unit_name in _terminal_units:
+            return self.get_terminal_unit_base_stats(unit_name)
+        return self.get_nonterminal_unit_base_stats(unit_name)
+
+    def get_blue_unit(self, unit_name, stats):
+        """
+        Gets a blue unit ready to be deployed. With pooling, every character is made once per factory and reset
+        in place for every game it plays
 
+        :param unit_name: The character's name, as a key of _nonterminal_units or _terminal_units
+        :param stats: The character's BlueUnit arguments, from _nonterminal_units or _terminal_units
+        """
+        if unit_name in self.blue_pool:
+            unit = self.blue_pool[unit_name]
+            unit.reset()
+            return unit
+
+        unit = BlueUnit(*stats, self.run_name, self.q_store, self.hyperparameters)
+        # unit.name comes from the character code, which two rosters share (Wil has Rebecca's); this is the key the
+        # unit can be made again with (see get_character)
+        unit.roster_name = unit_name
+        if self.pool_units:
+            self.blue_pool[unit_name] = unit
+        return unit
 
     def get_unit_growths(self, unit_name):
         character_dict = {
@@ -73,8 +124,13 @@ class UnitFactory:
         }
         return character_dict[unit_name]
 
-    def generate_random_enemy(self):
-        character_code = 0xdab0
+    def generate_random_enemy(self, unit=None):
+        """
+        Rolls a random enemy
+
+        :param unit: Optional RedUnit to reuse; it is set up as the new enemy in place
+        :return: a RedUnit
+        """
         level = random.randint(1, 3)
         hp = random.randint(23, 28)
         power = random.randint(5, 7)
@@ -84,51 +140,59 @@ class UnitFactory:
         secondary_reduction = random.randint(2, 3)
         luck = random.randint(2, 5)
 
-        return random.choice([
+        # class code, hp, strength, skill, speed, luck, defense, resistance, magic, inventory codes
+        stats = random.choice([
             # Mercenary
-            RedUnit(character_code, 0, 0, level, 0x4a4, hp, power + 2, skill + 4, spd + 2,
-                    luck, reduction, secondary_reduction, 0, False, [0x1], False, self.run_name),
+            (0x4a4, hp, power + 2, skill + 4, spd + 2, luck, reduction, secondary_reduction, 0, [0x1]),
             # Myrmidon
-            RedUnit(character_code, 0, 0, level, 0x5f4, hp, power, skill + 3, spd + 4,
-                    luck, reduction, secondary_reduction, 0, False, [0x1], False, self.run_name),
+            (0x5f4, hp, power, skill + 3, spd + 4, luck, reduction, secondary_reduction, 0, [0x1]),
             # Fighter
-            RedUnit(character_code, 0, 0, level, 0x744, hp, power, skill, spd,
-                    luck, reduction, secondary_reduction, 0, False, [0x1f], False, self.run_name),
+            (0x744, hp, power, skill, spd, luck, reduction, secondary_reduction, 0, [0x1f]),
             # Knight
-            RedUnit(character_code, 0, 0, level, 0x7ec, hp, power + 2, skill, spd - 1,
-                    luck, reduction + 5, secondary_reduction, 0, False, [0x14], False, self.run_name),
+            (0x7ec, hp, power + 2, skill, spd - 1, luck, reduction + 5, secondary_reduction, 0, [0x14]),
             # Archer
-            RedUnit(character_code, 0, 0, level, 0x93c, hp, power, skill + 1, spd + 1,
-                    luck, reduction, secondary_reduction, 0, False, [0x2c], False, self.run_name),
+            (0x93c, hp, power, skill + 1, spd + 1, luck, reduction, secondary_reduction, 0, [0x2c]),
             # Mage
-            RedUnit(character_code, 0, 0, level, 0xbdc, hp, 0, skill, spd,
-                    luck, secondary_reduction, reduction, power, False, [0x37], False, self.run_name),
+            (0xbdc, hp, 0, skill, spd, luck, secondary_reduction, reduction, power, [0x37]),
             # Shaman
-            RedUnit(character_code, 0, 0, level, 0xd2c, hp, 0, skill, spd,
-                    luck, secondary_reduction + 2, reduction, power, False, [0x44], False, self.run_name),
+            (0xd2c, hp, 0, skill, spd, luck, secondary_reduction + 2, reduction, power, [0x44]),
             # Cavalier w/ lance
-            RedUnit(character_code, 0, 0, level, 0xe7c, hp, power + 1, skill + 1, spd + 1,
-                    luck, reduction + 1, secondary_reduction + 1, 0, False, [0x14], False, self.run_name),
+            (0xe7c, hp, power + 1, skill + 1, spd + 1, luck, reduction + 1, secondary_reduction + 1, 0, [0x14]),
             # Cavalier w/ sword
-            RedUnit(character_code, 0, 0, level, 0xe7c, hp, power + 1, skill + 1, spd + 1,
-                    luck, reduction + 1, secondary_reduction + 1, 0, False, [0x1], False, self.run_name),
+            (0xe7c, hp, power + 1, skill + 1, spd + 1, luck, reduction + 1, secondary_reduction + 1, 0, [0x1]),
             # Soldier
-            RedUnit(character_code, 0, 0, level, 0x13bc, hp, power - 1, skill - 2, spd - 2,
-                    0, max(reduction - 2, 0), max(secondary_reduction - 1, 0), 0, False, [0x14], False, self.run_name),
+            (0x13bc, hp, power - 1, skill - 2, spd - 2, 0, max(reduction - 2, 0), max(secondary_reduction - 1, 0), 0,
+             [0x14]),
             # Wyvern Rider
-            RedUnit(character_code, 0, 0, level, 0x126c, hp, power + 1, skill, spd,
-                    luck, reduction + 1, secondary_reduction, 0, False, [0x14], False, self.run_name),
+            (0x126c, hp, power + 1, skill, spd, luck, reduction + 1, secondary_reduction, 0, [0x14]),
             # Brigand w/ Iron axe
-            RedUnit(character_code, 0, 0, level, 0x1410, hp, power + 1, skill - 1, spd,
-                    luck, reduction - 1, secondary_reduction, 0, False, [0x1f], False, self.run_name),
+            (0x1410, hp, power + 1, skill - 1, spd, luck, reduction - 1, secondary_reduction, 0, [0x1f]),
             # Brigand w/ hand axe
-            RedUnit(character_code, 0, 0, level, 0x1410, hp, power + 1, skill - 1, spd,
-                    luck, reduction - 1, secondary_reduction, 0, False, [0x28], False, self.run_name),
+            (0x1410, hp, power + 1, skill - 1, spd, luck, reduction - 1, secondary_reduction, 0, [0x28]),
             # Pirate
-            RedUnit(character_code, 0, 0, level, 0x1464, hp, power + 1, skill - 2, spd,
-                    luck, reduction - 1, secondary_reduction, 0, False, [0x1f], False, self.run_name)
-
+            (0x1464, hp, power + 1, skill - 2, spd, luck, reduction - 1, secondary_reduction, 0, [0x1f])
         ])
+        return self.get_red_unit(level, stats, unit)
+
+    def get_red_unit(self, level, stats, unit=None):
+        """
+        Makes an enemy with the given stats
+
+        :param level: The enemy's level
+        :param stats: class code, hp, strength, skill, speed, luck, defense, resistance, magic, inventory codes
+        :param unit: Optional RedUnit to reuse; it is set up as the new enemy in place
+        :return: a RedUnit
+        """
+        character_code = 0xdab0
+        job_code, hp, strength, skill, spd, luck, defense, res, magic, inventory_codes = stats
+
+        if unit is None:
+            return RedUnit(character_code, 0, 0, level, job_code, hp, strength, skill, spd, luck, defense, res, magic,
+                           False, inventory_codes, False, self.run_name)
+
+        unit.reset()
+        unit.set_stats(level, job_code, hp, strength, skill, spd, luck, defense, res, magic, False, inventory_codes)
+        return unit
 
     def generate_blue_team(self, tile_map: Map):
         """
@@ -157,8 +221,14 @@ class UnitFactory:
 
     def generate_red_team(self, tile_map: Map, blue_team):
         deploy = []
-        for _ in range(random.randint(self.red_low, self.red_high)):
-            deploy.append(self.generate_random_enemy())
+        for i in range(random.randint(self.red_low, self.red_high)):
+            if not self.pool_units:
+                deploy.append(self.generate_random_enemy())
+            elif i < len(self.red_pool):
+                deploy.append(self.generate_random_enemy(self.red_pool[i]))
+            else:
+                self.red_pool.append(self.generate_random_enemy())
+                deploy.append(self.red_pool[i])
 
         for red_unit in deploy:
             tile_map.set_red_unit_start_coordinates(red_unit, deploy, blue_team)
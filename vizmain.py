@@ -2,16 +2,18 @@ import environment
 import unit_populator
 from termcolor import colored
 import fedata
+import trajectory
 import sys
 from datetime import datetime
 import tkinter as tk
 
 
 class BoardVisualization(tk.Tk):
-    def __init__(self):
+    def __init__(self, replay_path=None, game=0):
         tk.Tk.__init__(self)
         self.env = environment.Environment(15, 20, 15, 20)
         self.tile_map = self.env.number_map
+        self.frames = None
         self.colors = ['green2', 'blue', 'forest green', 'sienna4']
         self.canvas = tk.Canvas(self, width=700, height=700, borderwidth=0, highlightthickness=0)
         self.canvas.pack(side="top", fill="both", expand="true")
@@ -24,6 +26,11 @@ class BoardVisualization(tk.Tk):
         self.reset()
         self.current_blue_unit = 0
 
+        # Replays a recorded game instead; press space to step through it
+        if replay_path is not None:
+            self.load_replay(replay_path, game)
+            self.bind("<space>", lambda event: self.step())
+
     def reset(self):
         unit_factory = unit_populator.UnitFactory(5, 6, 15, 18, self.run_name)
         valid = False
@@ -38,8 +45,35 @@ class BoardVisualization(tk.Tk):
 
         self.current_blue_unit = 0
 
+    def load_replay(self, replay_path, game):
+        """
+        Shows a game recorded by trajectory.TrajectoryWriter, starting from its first move
+
+        :param replay_path: The trajectory file
+        :param game: The game number to replay
+        """
+        self.frames = trajectory.replay(replay_path, game)
+        self.blue_team, self.red_team = [], []
+        self.step()
+        while self.frames is not None and self.current_step['action'] == trajectory.DEPLOY:
+            self.step()
+
     def step(self):
-        pass
+        if self.frames is None:
+            return
+
+        try:
+            number_map, board, self.current_step = next(self.frames)
+        except StopIteration:
+            self.frames = None
+            return
+
+        self.tile_map = number_map
+        self.rows, self.columns = number_map.shape
+        self.blue_team = [u for u in board.values() if u.team == trajectory.BLUE_TEAM]
+        self.red_team = [u for u in board.values() if u.team == trajectory.RED_TEAM]
+        self.title(f"Turn {self.current_step['turn']}")
+        self.redraw()
 
     def redraw(self, event=None):
         self.canvas.delete("rect")
@@ -76,5 +110,9 @@ class BoardVisualization(tk.Tk):
 
 
 if __name__ == "__main__":
-    board = BoardVisualization()
+    # python vizmain.py [trajectory file] [game number]
+    if len(sys.argv) > 1:
+        board = BoardVisualization(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    else:
+        board = BoardVisualization()
     board.mainloop()